@@ -1,10 +1,12 @@
+import asyncio
+import time
 from discord.message import Message
 from discord.ext import tasks
 from discord import app_commands
 from utilities import *
 from commands.hello import command_hello
 from commands.commands import command_commands
-from commands.search import command_search
+from commands.search import command_search, search_cache
 from commands.collections import command_collections
 from commands.solve import command_solve
 from commands.unsolve import command_unsolve
@@ -12,9 +14,20 @@ from commands.open import command_open
 from commands.close import command_close
 from commands.status import command_status
 from commands.info import command_info
+from commands.profile import command_profile
 from events.event_on_message import event_on_message
 from events.event_handle_reaction import event_handle_reaction
+from events.event_on_message_edit import event_on_raw_message_edit
 from task_loop.task_loop import execute_task_loop
+from task_loop.subscription import PendingMessageSubscription
+from task_loop.scheduler import poll_scheduler
+from task_loop.claims import answer_claims
+from write_behind import write_spool, edit_writer, vote_coalescer
+from catalog import collection_catalog
+from config import guild_configs
+from profiling import loop_watchdog
+from metrics import (metrics, MetricsServer, discord_trace_config, command_seconds, handler_seconds,
+                     task_loop_seconds)
 import discord
 
 # Define which intents we want to use (in this case, messages in guilds)
@@ -24,15 +37,96 @@ intents.message_content = True
 intents.guilds = True  # Subscribe to guild events
 intents.reactions = True
 
-client = discord.Client(intents=intents)
-tree = app_commands.CommandTree(client)
+# Shards are managed in this process, by default as many as Discord recommends. The trace times every Discord REST
+# request and counts its status, including 429s discord.py retries internally, and feeds the rate limit headers of
+# every send to the send scheduler.
+http_trace = discord_trace_config()
+http_trace.on_request_end.append(send_scheduler.on_request_end)
+client = discord.AutoShardedClient(intents=intents,
+                                   shard_count=SHARD_COUNT,
+                                   shard_ids=SHARD_IDS,
+                                   http_trace=http_trace)
+# Commands are registered globally, unless COMMAND_GUILD_ID is set for development.
+COMMAND_GUILD = discord.Object(id=COMMAND_GUILD_ID) if COMMAND_GUILD_ID else None
+# Used to measure how long it takes from process start until the bot is ready.
+startup_started = time.perf_counter()
+startup_seconds = None
+
+
+class CommandTree(app_commands.CommandTree):
+    """
+    A command tree that times every slash command and autocomplete it handles.
+    """
+
+    async def _call(self, interaction: discord.Interaction):
+        with command_seconds.time((interaction.data or {}).get("name", "unknown"), interaction.type.name):
+            await super()._call(interaction)
+
+
+tree = CommandTree(client)
+rest_calls.install(client.http)
+
+pending_messages = None
+if DELIVERY_MODE == "subscription":
+    pending_messages = PendingMessageSubscription(url=GRAPHQL_WS_URL,
+                                                  headers=GRAPHQL_HEADERS,
+                                                  session_factory=graphql_client.open,
+                                                  safety_poll_interval=SUBSCRIPTION_SAFETY_POLL_SECONDS)
+
+metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+metrics.gauge("discord_send_queue_depth", "Outbound Discord sends waiting in the send scheduler.",
+              send_scheduler.queue_depth)
+metrics.gauge("discord_send_buckets", "Rate limit buckets with sends queued or in flight.",
+              lambda: len(send_scheduler.buckets))
+metrics.gauge("write_spool_depth", "Writes spooled locally and waiting to be replayed to Hasura.",
+              lambda: write_spool.depth)
+metrics.gauge("write_spool_lag_seconds", "How long the oldest spooled write has been waiting.", write_spool.lag)
+metrics.gauge("vote_reactions_spooled", "Vote reactions spooled since startup.", lambda: vote_coalescer.events)
+metrics.gauge("vote_writes", "Vote writes the spooled reactions were folded into since startup.",
+              lambda: vote_coalescer.writes)
+metrics.gauge("vote_events_per_write", "Vote reactions folded into each vote write on average.",
+              lambda: vote_coalescer.stats()["events_per_write"])
+metrics.gauge("vote_last_folded", "Vote reactions folded into the last vote write.", lambda: vote_coalescer.last_folded)
+metrics.gauge("edit_buffer_rows", "Edited messages waiting to be written to Hasura.", lambda: len(edit_writer.pending))
+metrics.gauge("guild_configs_loaded", "Guilds whose configuration is cached.", lambda: len(guild_configs.loaded()))
+metrics.gauge("discord_shards", "Shards run by this process.", lambda: len(client.shards))
+metrics.gauge("search_cache_entries", "/search results cached in memory.", lambda: len(search_cache.entries))
+metrics.gauge("search_cache_lookups", "/search cache lookups since startup by result (hit, miss, or coalesced with a "
+              "lookup already in flight).",
+              lambda: {("hit",): search_cache.hits, ("miss",): search_cache.misses,
+                       ("coalesced",): search_cache.coalesced},
+              ("result",))
+metrics.gauge("search_cache_hit_ratio", "The share of /search cache lookups served without a new search request.",
+              lambda: search_cache.stats()["hit_rate"])
+metrics.gauge("task_loop_poll_interval_seconds", "How long the task loop waits before polling for answers again.",
+              lambda: poll_scheduler.interval)
+metrics.gauge("task_loop_backlog", "Answers claimed by the last task loop poll.", lambda: poll_scheduler.backlog)
+metrics.gauge("delivery_claims", "Answer claims since startup by event (claimed, stolen from another partition, lost "
+              "to another worker, acked, lease lost before the ack, released).",
+              lambda: {(event,): answer_claims.stats()[event]
+                       for event in ("claimed", "stolen", "lost_races", "acked", "lost_leases", "released")},
+              ("event",))
+metrics.gauge("discord_rest_operations", "Bot operations counted by the REST call counter since startup, by operation.",
+              lambda: {(name,): count for name, count in rest_calls.operations.items()},
+              ("operation",))
+metrics.gauge("discord_rest_calls", "Discord REST calls since startup, by the operation that made them (\"other\" for "
+              "calls made outside one).",
+              lambda: {(name,): count for name, count in rest_calls.calls.items()},
+              ("operation",))
+metrics.gauge("discord_rest_calls_per_operation", "Discord REST calls per bot operation on average, by operation.",
+              lambda: {(name,): stats["calls_per_operation"] for name, stats in rest_calls.stats().items()},
+              ("operation",))
+metrics.gauge("hasura_persisted_query_known", "Whether Hasura has confirmed it knows the persisted query hash, by "
+              "operation name.",
+              lambda: {(name,): int(stats["persisted"]) for name, stats in graphql_operations.stats().items()},
+              ("operation",))
 
 
 # tree.command is how you create commands
 
 @tree.command(name="hello",
               description="Say hello",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _hello(interaction: discord.Interaction.response):
     """
     This is a test command. Hello World.
@@ -44,7 +138,7 @@ async def _hello(interaction: discord.Interaction.response):
 
 @tree.command(name="commands",
               description="List commands",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _commands(interaction: discord.Interaction.response):
     """
     This command lists the available commands
@@ -56,7 +150,7 @@ async def _commands(interaction: discord.Interaction.response):
 
 @tree.command(name="search",
               description="Search our documentation!",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _search(interaction: discord.Interaction.response, query: str, collection: str, limit: int = 10):
     """
     This command performs a cosine similarity vector search across a collection of embedded documents via an API.
@@ -70,9 +164,23 @@ async def _search(interaction: discord.Interaction.response, query: str, collect
     return await command_search(interaction, query, collection, limit)
 
 
+@_search.autocomplete("collection")
+async def _search_collection_autocomplete(interaction: discord.Interaction,
+                                          current: str) -> list[app_commands.Choice[str]]:
+    """
+    Suggests collections for /search. This is served from the in-memory catalog, well within Discord's 3 second limit.
+
+    :param interaction: The incoming interaction
+    :param current: What the user has typed so far
+    :return: The matching collections
+    """
+    return [app_commands.Choice(name=collection, value=collection)
+            for collection in collection_catalog.matching(current)]
+
+
 @tree.command(name="collections",
               description="See which collections are available to search.",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _collections(interaction: discord.Interaction.response):
     """
     Lists all available collections that can be searched
@@ -84,7 +192,7 @@ async def _collections(interaction: discord.Interaction.response):
 
 @tree.command(name="open",
               description="Opens a closed forum thread",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _open(interaction: discord.Interaction.response):
     """
     Opens a closed forum thread. Only runnable by staff or the author.
@@ -97,7 +205,7 @@ async def _open(interaction: discord.Interaction.response):
 
 @tree.command(name="close",
               description="Closes an open forum thread",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _close(interaction: discord.Interaction):
     """
     Closes an open forum thread. Runnable only by staff or the author.
@@ -109,7 +217,7 @@ async def _close(interaction: discord.Interaction):
 
 @tree.command(name="solve",
               description="Marks a forum thread as solved",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _solve(interaction: discord.Interaction):
     """
     Marks a forum thread as solved. Runnable only by staff or the author.
@@ -121,7 +229,7 @@ async def _solve(interaction: discord.Interaction):
 
 @tree.command(name="unsolve",
               description="Reverts a forum thread's status from solved",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _unsolve(interaction: discord.Interaction):
     """
     Reverts a forum thread's status from solved to its previous state. Runnable only by staff or the author.
@@ -133,7 +241,7 @@ async def _unsolve(interaction: discord.Interaction):
 
 @tree.command(name="status",
               description="Gets the status of the thread.",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _status(interaction: discord.Interaction):
     """
     Gets the status of a thread when run in the thread.
@@ -145,7 +253,7 @@ async def _status(interaction: discord.Interaction):
 
 @tree.command(name="update",
               description="Updates the bot commands to the latest version.",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _update(interaction: discord.Interaction.response):
     """
     Gets the status of a thread when run in the thread.
@@ -153,13 +261,13 @@ async def _update(interaction: discord.Interaction.response):
     :param interaction: The incoming interaction
     """
     await interaction.response.defer()
-    await tree.sync(guild=discord.Object(id=GUILD_ID))
-    return await interaction.followup.send(embed=discord.Embed(title="The commands have been synced."))
+    await sync_commands()
+    return await send_followup(interaction, embed=discord.Embed(title="The commands have been synced."))
 
 
 @tree.command(name="info",
               description="Displays some usage info about the bot.",
-              guild=discord.Object(id=GUILD_ID))
+              guild=COMMAND_GUILD)
 async def _info(interaction: discord.Interaction.response):
     """
     Displays usage info about the bot.
@@ -170,32 +278,97 @@ async def _info(interaction: discord.Interaction.response):
     return await command_info(interaction)
 
 
+@tree.command(name="profile",
+              description="Profiles the bot for a few seconds. Staff only.",
+              guild=COMMAND_GUILD)
+async def _profile(interaction: discord.Interaction, seconds: int = 10):
+    """
+    Samples the running bot and replies with where its time goes. Runnable only by staff.
+
+    :param interaction: The incoming interaction
+    :param seconds: How long to sample for
+    """
+    return await command_profile(interaction, seconds)
+
+
+async def sync_commands():
+    """
+    Registers the commands with Discord, globally or to COMMAND_GUILD_ID.
+    """
+    await tree.sync(guild=COMMAND_GUILD)
+    if COMMAND_GUILD is None and GUILD_ID:
+        # Commands used to be registered to the home guild. The tree has none for it, so this removes them there, or
+        # they would show up twice.
+        await tree.sync(guild=discord.Object(id=GUILD_ID))
+
+
 @client.event
 async def on_ready():
     """
     Occurs when the bot connects or re-connects.
     :return:
     """
-    await log(f'The bot has logged in as {client.user}', LOGGING_CHANNEL, client)
+    global startup_seconds
+    # Startup is logged to the home guild, if there is one.
+    home = guild_configs.cached(GUILD_ID) if GUILD_ID else None
+    ready_message = (f'The bot has logged in as {client.user} on {len(client.shards)} shards, '
+                     f'in {len(client.guilds)} guilds')
+    print(ready_message)
+    if home is not None:
+        await log(ready_message, home.logging_channel, client)
+    if startup_seconds is None:
+        startup_seconds = time.perf_counter() - startup_started
+        if home is not None:
+            store = guild_configs.stores[GUILD_ID]
+            await log(f'Startup took {startup_seconds:.2f} seconds, the configuration was loaded from '
+                      f'{store.source} in {store.load_seconds:.2f} seconds', home.logging_channel, client)
+    if not thread_index.warm:
+        await thread_index.warm_up()
+    collection_catalog.start()
     if SYNC_ON_STARTUP:
-        await tree.sync(guild=discord.Object(id=GUILD_ID))
+        await sync_commands()
+    if pending_messages is not None:
+        pending_messages.start()
     if not task_loop.is_running():
         task_loop.start()
 
 
-@tasks.loop(seconds=1, count=None, reconnect=True)
+async def log_config_change(config, changes: list[str]):
+    """
+    Logs configuration changes picked up by a guild's config store to that guild's logging channel.
+
+    :param config: The new configuration
+    :param changes: A line per change
+    """
+    await log("The configuration was reloaded:\n" + "\n".join(changes), config.logging_channel, client)
+
+
+guild_configs.listeners.append(log_config_change)
+
+
+@tasks.loop(seconds=0, count=None, reconnect=True)
 async def task_loop():
     """
     The main task loop.
 
-    This is an event loop that runs every 1 second. It runs a transactional mutation to collect any unpublished messages
+    This is an event loop that polls on an adaptive schedule: immediately again while answers keep coming back, and
+    backing off from TASK_LOOP_SECONDS to TASK_LOOP_MAX_SECONDS when idle, except for a while after a question that will
+    be answered arrives. When DELIVERY_MODE is "subscription" it also runs as soon as the pending message subscription
+    sees a new answer. It leases a batch of unpublished messages and acknowledges each one once it has been sent.
 
-    If for some reason the task_loop fails, the message won't get sent. This is not a huge deal, the user can ask again.
-    That shouldn't happen, however, doing this on a transactional poll like this is useful to ensure no more than
-    once delivery, and aim for at least once.
+    If the task_loop fails (or the bot stops) before a message is sent, its lease expires and it is claimed again, by
+    this replica or another one, so answers are delivered at least once.
     :return: The linked task loop
     """
-    return await execute_task_loop(client)
+    with task_loop_seconds.time():
+        results = await execute_task_loop(client)
+    delay = poll_scheduler.record(len(results))
+    if delay == 0:
+        return
+    if pending_messages is None:
+        await poll_scheduler.wait(delay)
+    else:
+        await pending_messages.wait(delay)
 
 
 @client.event
@@ -206,19 +379,34 @@ async def on_message(message: Message):
     :param message: The incoming message
     :return: The return from the linked handler function
     """
-    if message.author.id in BANNED:
-        await message.channel.send(content=f"Silly <@{message.author.id}>, you've misbehaved and have been BANNED. 🔨")
-        return
-    return await event_on_message(client, message)
+    with handler_seconds.time("on_message"):
+        if message.guild is None:
+            return
+        config = await get_config(message.guild.id)
+        if config is not None and message.author.id in config.banned:
+            await message.channel.send(
+                content=f"Silly <@{message.author.id}>, you've misbehaved and have been BANNED. 🔨")
+            return
+        with rest_calls.operation("message"):
+            return await event_on_message(client, message)
+
 
+@client.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    """
+    Each time a message is edited, this fires, even if the message isn't cached. Edits are debounced per message and
+    written in batches.
 
-# TODO: Forward edits to the database
-# @client.event
-# async def on_message_edit(before: Message, after: Message):
-#     print(before.id)
-#     print(after.id)
-#     print(before.content)
-#     print(after.content)
+    :param payload: The raw edit event
+    :return: The return from the linked handler function
+    """
+    with handler_seconds.time("on_raw_message_edit"):
+        if payload.guild_id is None:
+            return
+        config = await get_config(payload.guild_id)
+        if config is not None and int(payload.data.get("author", {}).get("id", 0)) in config.banned:
+            return
+        return await event_on_raw_message_edit(client, payload)
 
 
 @client.event
@@ -230,9 +418,12 @@ async def on_raw_reaction_add(reaction: discord.RawReactionActionEvent):
     :param reaction: The incoming reaction
     :return: The response from the linked handler function
     """
-    if reaction.user_id in BANNED:
-        return
-    return await event_handle_reaction(reaction, client, 1)
+    with handler_seconds.time("on_raw_reaction_add"):
+        config = await get_config(reaction.guild_id)
+        if config is None or reaction.user_id in config.banned:
+            return
+        with rest_calls.operation("reaction"):
+            return await event_handle_reaction(reaction, client, 1)
 
 
 @client.event
@@ -243,10 +434,45 @@ async def on_raw_reaction_remove(reaction: discord.RawReactionActionEvent):
     :param reaction: The incoming reaction
     :return: The response from the linked handler function
     """
-    if reaction.user_id in BANNED:
-        return
-    return await event_handle_reaction(reaction, client, -1)
+    with handler_seconds.time("on_raw_reaction_remove"):
+        config = await get_config(reaction.guild_id)
+        if config is None or reaction.user_id in config.banned:
+            return
+        with rest_calls.operation("reaction"):
+            return await event_handle_reaction(reaction, client, -1)
+
+
+async def main():
+    """
+    Loads the home guild's configuration and runs the bot until it is stopped. Then it replays the write spool (anything
+    left is replayed on the next start), and closes the shared GraphQL client so pooled connections shut down cleanly.
+    """
+    discord.utils.setup_logging()
+    try:
+        loop_watchdog.start()
+        write_spool.start()
+        if metrics_server is not None:
+            await metrics_server.start()
+        async with client:
+            # Log in to Discord while the home guild's configuration loads. Every other guild's configuration is loaded
+            # the first time the bot sees an event from it.
+            await asyncio.gather(get_config(GUILD_ID), client.login(CLIENT_SECRET))
+            await client.connect()
+    finally:
+        await loop_watchdog.stop()
+        await guild_configs.close()
+        if pending_messages is not None:
+            await pending_messages.stop()
+        await collection_catalog.stop()
+        await edit_writer.close()
+        await write_spool.close()
+        await graphql_client.close()
+        if metrics_server is not None:
+            await metrics_server.stop()
 
 
 if __name__ == "__main__":
-    client.run(CLIENT_SECRET)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
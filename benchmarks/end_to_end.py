@@ -0,0 +1,359 @@
+"""
+Drives the bot's real handlers end to end against local stand-ins for Hasura and the Discord REST API.
+
+Messages, reactions and /open, /close, /solve and /unsolve arrive at configurable rates (Poisson arrivals) and are
+handed to the same entry points the gateway would call, while the real task loop delivers answers. Nothing talks to
+the real Hasura or Discord: discord.http.Route.BASE is pointed at the Discord stand-in, and GRAPHQL_URL at the Hasura
+stand-in, which also inserts an answer for every new thread and bot mention.
+
+It reports:
+  - throughput and handler latency per operation
+  - p50/p95/p99 from a question arriving to its answer being fully delivered (the thread's controller being updated,
+    after every answer message has been sent)
+  - Discord REST calls per operation, and every Hasura operation and Discord route that was called
+
+Run from the repository root:
+    python -m benchmarks.end_to_end --duration 30 --message-rate 20 --reaction-rate 20 --toggle-rate 2
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from benchmarks.fake_discord import FakeDiscord
+from benchmarks.fake_hasura import FakeHasura
+
+GUILD_ID = 100000000000000001
+FORUM_CHANNEL_ID = 100000000000000002
+LOGGING_CHANNEL_ID = 100000000000000003
+MOD_ROLE_ID = 100000000000000004
+BOT_ID = 100000000000000005
+AUTHOR_IDS = list(range(200000000000000000, 200000000000000050))
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def report(name: str, latencies: list[float], duration: float):
+    if not latencies:
+        print(f"{name:<22} n=0")
+        return
+    print(f"{name:<22} n={len(latencies):<6} {len(latencies) / duration:7.2f}/s "
+          f"mean={statistics.mean(latencies):8.2f}ms p50={percentile(latencies, 50):8.2f}ms "
+          f"p95={percentile(latencies, 95):8.2f}ms p99={percentile(latencies, 99):8.2f}ms")
+
+
+async def start(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def user(user_id: int) -> dict:
+    return {"id": str(user_id), "username": f"user-{user_id}", "discriminator": "0", "avatar": None}
+
+
+def role(role_id: int, name: str) -> dict:
+    return {"id": str(role_id), "name": name, "permissions": "0", "position": 0, "color": 0, "hoist": False,
+            "managed": False, "mentionable": False}
+
+
+class Workload:
+    """
+    Builds gateway-shaped objects for a single guild with one help forum, and feeds them to the bot's handlers.
+    """
+
+    def __init__(self, bot, args: argparse.Namespace):
+        """
+        :param bot: The imported app module
+        :param args: The command line arguments
+        """
+        import discord
+
+        self.discord = discord
+        self.bot = bot
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.state = bot.client._connection
+        self.guild = discord.Guild(data={"id": str(GUILD_ID), "name": "Hasura", "owner_id": str(AUTHOR_IDS[0]),
+                                         "roles": [role(GUILD_ID, "@everyone"), role(MOD_ROLE_ID, "Staff")],
+                                         "channels": [], "threads": [], "members": []},
+                                   state=self.state)
+        self.state._add_guild(self.guild)
+        self.threads: list[int] = []
+        # Recent messages that can be edited: (thread id, message id, author id).
+        self.sent: deque[tuple[int, int, int]] = deque(maxlen=200)
+        self.questions: dict[int, deque[float]] = {}
+        self.latencies: dict[str, list[float]] = {}
+        self.errors = 0
+        self._ids = itertools.count(7 * 10 ** 17)
+        self._tasks: set[asyncio.Task] = set()
+
+    def add_thread(self, thread_id: int, author_id: int):
+        self.guild._add_thread(self.discord.Thread(guild=self.guild, state=self.state, data={
+            "id": str(thread_id),
+            "guild_id": str(GUILD_ID),
+            "parent_id": str(FORUM_CHANNEL_ID),
+            "owner_id": str(author_id),
+            "name": f"Question {thread_id}",
+            "type": 11,
+            "last_message_id": None,
+            "rate_limit_per_user": 0,
+            "message_count": 0,
+            "member_count": 1,
+            "thread_metadata": {"archived": False, "auto_archive_duration": 1440, "locked": False,
+                                "archive_timestamp": datetime.now(timezone.utc).isoformat()},
+        }))
+
+    def message(self, thread_id: int, message_id: int, author_id: int, mentions_bot: bool):
+        return self.discord.Message(state=self.state, channel=self.guild.get_thread(thread_id), data={
+            "id": str(message_id),
+            "channel_id": str(thread_id),
+            "type": 0,
+            "content": (f"<@{BOT_ID}> " if mentions_bot else "") + "How do I add a remote schema?",
+            "author": user(author_id),
+            "attachments": [],
+            "embeds": [],
+            "mentions": [user(BOT_ID)] if mentions_bot else [],
+            "mention_roles": [],
+            "mention_everyone": False,
+            "pinned": False,
+            "tts": False,
+            "flags": 0,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "edited_timestamp": None,
+        })
+
+    def observe(self, route: str, channel_id: int, payload: dict):
+        """
+        Records an answer as delivered when deliver_answer updates the thread's controller, which it does after every
+        message of the answer has been sent. Toggles and reactions also edit the controller, but with more than one
+        embed.
+        """
+        embeds = payload.get("embeds") or []
+        if route.startswith("PATCH") and len(embeds) == 1 and embeds[0].get("title") == self.bot.CONTROLLER_TITLE:
+            questions = self.questions.get(channel_id)
+            if questions:
+                self.latencies.setdefault("message -> answer", []).append(
+                    (time.perf_counter() - questions.popleft()) * 1000)
+
+    async def timed(self, name: str, handler):
+        start = time.perf_counter()
+        try:
+            await handler
+        except Exception as e:
+            self.errors += 1
+            print(f"{name} failed: {e!r}")
+        self.latencies.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+
+    def spawn(self, name: str, handler):
+        task = asyncio.create_task(self.timed(name, handler))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def send_message(self):
+        if not self.threads or self.random.random() < self.args.new_thread_ratio:
+            thread_id = message_id = next(self._ids)
+            author_id = self.random.choice(AUTHOR_IDS)
+            self.add_thread(thread_id, author_id)
+            self.threads.append(thread_id)
+            mentions_bot = False
+        else:
+            thread_id = self.random.choice(self.threads)
+            message_id = next(self._ids)
+            author_id = self.random.choice(AUTHOR_IDS)
+            mentions_bot = self.random.random() < self.args.mention_ratio
+        if thread_id == message_id or mentions_bot:
+            self.questions.setdefault(thread_id, deque()).append(time.perf_counter())
+        self.sent.append((thread_id, message_id, author_id))
+        self.spawn("message", self.bot.on_message(self.message(thread_id, message_id, author_id, mentions_bot)))
+
+    def send_edit(self):
+        if not self.sent:
+            return
+        thread_id, message_id, author_id = self.random.choice(self.sent)
+        # People often save a message several times in a row while fixing it up.
+        for revision in range(self.random.randint(1, 4)):
+            event = self.discord.RawMessageUpdateEvent(data={
+                "id": str(message_id),
+                "channel_id": str(thread_id),
+                "guild_id": str(GUILD_ID),
+                "content": f"How do I add a remote schema? (edit {revision})",
+                "author": user(author_id),
+                "mentions": [],
+                "edited_timestamp": datetime.now(timezone.utc).isoformat(),
+            })
+            self.spawn("edit", self.bot.on_raw_message_edit(event))
+
+    def send_reaction(self):
+        thread = self.random_indexed_thread()
+        if thread is None:
+            return
+        # Most reactions in a help forum are on ordinary messages, which the bot ignores.
+        on_controller = self.random.random() < self.args.controller_reaction_ratio
+        message_id = thread["thread_controller_id"] if on_controller else next(self._ids)
+        user_id = int(thread["author_id"]) if self.random.random() < 0.5 else self.random.choice(AUTHOR_IDS)
+        emoji = self.random.choice([self.bot.POSITIVE_EMOJI, self.bot.NEGATIVE_EMOJI])
+        event = self.discord.RawReactionActionEvent(data={"message_id": str(message_id),
+                                                          "channel_id": thread["thread_id"],
+                                                          "user_id": str(user_id),
+                                                          "guild_id": str(GUILD_ID)},
+                                                    emoji=self.discord.PartialEmoji(name=emoji),
+                                                    event_type="REACTION_ADD")
+        if self.random.random() < 0.8:
+            self.spawn("reaction", self.bot.on_raw_reaction_add(event))
+        else:
+            self.spawn("reaction", self.bot.on_raw_reaction_remove(event))
+
+    def send_toggle(self):
+        thread = self.random_indexed_thread()
+        if thread is None:
+            return
+        command = self.random.choice(["open", "close", "solve", "unsolve"])
+        interaction = self.discord.Interaction(state=self.state, data={
+            "id": str(next(self._ids)),
+            "application_id": str(BOT_ID),
+            "type": 2,
+            "token": f"token-{next(self._ids)}",
+            "version": 1,
+            "guild_id": str(GUILD_ID),
+            "channel": {"id": thread["thread_id"], "type": 11},
+            "data": {"id": str(next(self._ids)), "name": command, "type": 1},
+            "member": {"user": user(int(thread["author_id"])), "roles": [], "joined_at": None, "deaf": False,
+                       "mute": False, "permissions": "0", "flags": 0},
+        })
+        self.spawn(command, self.bot.handle_toggle(interaction, command))
+
+    def random_indexed_thread(self) -> dict | None:
+        threads = list(self.bot.thread_index.threads.values())
+        return self.random.choice(threads) if threads else None
+
+    async def arrivals(self, rate: float, send, deadline: float):
+        if rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.random.expovariate(rate))
+            if time.perf_counter() >= deadline:
+                return
+            send()
+
+    async def run(self, duration: float):
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(self.arrivals(self.args.message_rate, self.send_message, deadline),
+                             self.arrivals(self.args.reaction_rate, self.send_reaction, deadline),
+                             self.arrivals(self.args.toggle_rate, self.send_toggle, deadline),
+                             self.arrivals(self.args.edit_rate, self.send_edit, deadline))
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    def outstanding(self) -> int:
+        return sum(len(questions) for questions in self.questions.values())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--hasura-port", type=int, default=8767)
+    parser.add_argument("--discord-port", type=int, default=8768)
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to generate load for")
+    parser.add_argument("--drain", type=float, default=30, help="Seconds to wait for outstanding answers")
+    parser.add_argument("--message-rate", type=float, default=20, help="Messages per second")
+    parser.add_argument("--reaction-rate", type=float, default=20, help="Reactions per second")
+    parser.add_argument("--toggle-rate", type=float, default=2, help="/open, /close, /solve, /unsolve per second")
+    parser.add_argument("--edit-rate", type=float, default=2, help="Bursts of message edits per second")
+    parser.add_argument("--new-thread-ratio", type=float, default=0.2)
+    parser.add_argument("--mention-ratio", type=float, default=0.3)
+    parser.add_argument("--controller-reaction-ratio", type=float, default=0.3)
+    parser.add_argument("--hasura-latency", type=float, default=0.005, help="Seconds added to every GraphQL request")
+    parser.add_argument("--discord-latency", type=float, default=0.02, help="Seconds added to every REST request")
+    parser.add_argument("--answer-delay", type=float, default=0.5,
+                        help="Seconds the stand-in answer pipeline takes to answer a question")
+    parser.add_argument("--answer-length", type=int, default=3000)
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth message send with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--persisted-queries", choices=("off", "apq"), default="off",
+                        help="Send GraphQL documents in full, or as automatic persisted query hashes")
+    args = parser.parse_args()
+
+    hasura = FakeHasura(guild_id=GUILD_ID, forum_channel_id=FORUM_CHANNEL_ID, logging_channel_id=LOGGING_CHANNEL_ID,
+                        mod_role_id=MOD_ROLE_ID, latency=args.hasura_latency, answer_delay=args.answer_delay,
+                        answer_length=args.answer_length)
+    fake_discord = FakeDiscord(bot_id=BOT_ID, forum_channel_id=FORUM_CHANNEL_ID, latency=args.discord_latency,
+                               rate_limit_every=args.rate_limit_every)
+    runners = [await start(hasura.app(), args.host, args.hasura_port),
+               await start(fake_discord.app(), args.host, args.discord_port)]
+
+    spool_directory = tempfile.TemporaryDirectory()
+    # constants.py reads its configuration at import time, so the environment has to point at the stand-ins first.
+    os.environ.update({"GUILD_ID": str(GUILD_ID),
+                       "GRAPHQL_URL": f"http://{args.host}:{args.hasura_port}/v1/graphql",
+                       "GRAPHQL_ADMIN_SECRET": "benchmark",
+                       "CONFIG_SNAPSHOT_DIRECTORY": "",
+                       "WRITE_SPOOL_PATH": os.path.join(spool_directory.name, "write_spool.sqlite3"),
+                       "DELIVERY_MODE": "poll",
+                       "GRAPHQL_PERSISTED_QUERIES": args.persisted_queries,
+                       "SYNC_ON_STARTUP": "0"})
+    import discord
+    import app as bot
+    from write_behind import vote_coalescer
+
+    discord.http.Route.BASE = f"http://{args.host}:{args.discord_port}/api/v10"
+    workload = Workload(bot, args)
+    fake_discord.on_message = workload.observe
+    try:
+        async with bot.client:
+            await asyncio.gather(bot.get_config(GUILD_ID), bot.client.login("benchmark"))
+            await bot.thread_index.warm_up()
+            await bot.collection_catalog.refresh()
+            bot.task_loop.start()
+
+            started = time.perf_counter()
+            await workload.run(args.duration)
+            drain_deadline = time.perf_counter() + args.drain
+            while workload.outstanding() and time.perf_counter() < drain_deadline:
+                await asyncio.sleep(0.1)
+            elapsed = time.perf_counter() - started
+            bot.task_loop.cancel()
+            await bot.edit_writer.close()
+            spool_stats = bot.write_spool.stats()
+            await bot.write_spool.close()
+
+            print(f"\n{elapsed:.1f}s, {len(workload.threads)} threads, {hasura.answers_inserted} answers inserted, "
+                  f"{workload.outstanding()} undelivered, {workload.errors} handler errors")
+            print("\nLatency")
+            for name, latencies in sorted(workload.latencies.items()):
+                report(name, latencies, elapsed)
+            print("\nDiscord REST calls per operation")
+            for name, stats in sorted(bot.rest_calls.stats().items()):
+                print(f"{name:<22} n={stats['operations']:<6} calls={stats['calls']:<6} "
+                      f"per operation={stats['calls_per_operation']:.2f}")
+            print("\nHasura operations")
+            for name, count in hasura.operations.most_common():
+                print(f"{name:<32} {count:<6} {hasura.request_bytes[name] / count:8.0f} bytes/request")
+            print("\nDiscord routes (interaction callbacks and follow-ups bypass the REST call counter)")
+            for name, count in fake_discord.routes.most_common():
+                print(f"{name:<58} {count}")
+            print(f"\n429s injected={fake_discord.rate_limited} send scheduler={bot.send_scheduler.stats()} "
+                  f"votes={vote_coalescer.stats()} spool={spool_stats}")
+    finally:
+        await bot.collection_catalog.stop()
+        await bot.guild_configs.close()
+        await bot.graphql_client.close()
+        for runner in runners:
+            await runner.cleanup()
+        spool_directory.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
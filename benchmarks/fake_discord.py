@@ -0,0 +1,173 @@
+"""
+A stand-in for the parts of the Discord REST API the bot calls.
+
+discord.py builds every REST URL, including interaction callbacks and webhook follow-ups, from discord.http.Route.BASE,
+so pointing that at this server is enough to capture all outbound traffic. Every request can be delayed, and every
+Nth message send can be answered with a 429 shaped like Discord's.
+"""
+import asyncio
+import itertools
+import json
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Callable
+
+from aiohttp import web
+
+
+def json_response(data: dict, status: int = 200, headers: dict | None = None) -> web.Response:
+    # discord.py only decodes JSON when the content type is exactly application/json, without a charset.
+    return web.Response(body=json.dumps(data).encode(), status=status,
+                        headers={"Content-Type": "application/json", **(headers or {})})
+
+
+class FakeDiscord:
+
+    def __init__(self, bot_id: int, forum_channel_id: int, latency: float = 0.02, rate_limit_every: int = 0,
+                 retry_after: float = 0.05):
+        """
+        :param bot_id: The bot's user id, returned by /users/@me
+        :param forum_channel_id: The forum every thread belongs to
+        :param latency: Seconds added to every request
+        :param rate_limit_every: Answer every Nth message send with a 429, or 0 to never rate limit
+        :param retry_after: The retry_after of injected 429s, in seconds
+        """
+        self.bot_id = bot_id
+        self.forum_channel_id = forum_channel_id
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.routes = Counter()
+        self.rate_limited = 0
+        # Called with the route, channel id and JSON payload of every message send and edit.
+        self.on_message: Callable[[str, int, dict], None] | None = None
+        self._ids = itertools.count(8 * 10 ** 17)
+        self._sends = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/v10/users/@me", self.me)
+        app.router.add_get("/api/v10/oauth2/applications/@me", self.application)
+        app.router.add_post("/api/v10/channels/{channel_id}/messages", self.send_message)
+        app.router.add_get("/api/v10/channels/{channel_id}/messages/{message_id}", self.get_message)
+        app.router.add_patch("/api/v10/channels/{channel_id}/messages/{message_id}", self.edit_message)
+        app.router.add_put("/api/v10/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me",
+                           self.add_reaction)
+        app.router.add_patch("/api/v10/channels/{channel_id}", self.edit_channel)
+        app.router.add_post("/api/v10/interactions/{interaction_id}/{token}/callback", self.interaction_callback)
+        app.router.add_post("/api/v10/webhooks/{application_id}/{token}", self.send_followup)
+        return app
+
+    def user(self) -> dict:
+        return {"id": str(self.bot_id), "username": "hasura-bot", "discriminator": "0", "avatar": None, "bot": True}
+
+    def message(self, channel_id: int, message_id: int | None = None, payload: dict | None = None) -> dict:
+        payload = payload or {}
+        return {
+            "id": str(message_id or next(self._ids)),
+            "channel_id": str(channel_id),
+            "type": 0,
+            "content": payload.get("content") or "",
+            "author": self.user(),
+            "attachments": [],
+            "embeds": payload.get("embeds") or [],
+            "mentions": [],
+            "mention_roles": [],
+            "mention_everyone": False,
+            "pinned": False,
+            "tts": False,
+            "flags": 0,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "edited_timestamp": None,
+        }
+
+    @staticmethod
+    async def payload(request: web.Request) -> dict:
+        if request.content_type == "multipart/form-data":
+            form = await request.post()
+            return json.loads(form.get("payload_json") or "{}")
+        if not request.can_read_body:
+            return {}
+        return await request.json()
+
+    async def _respond(self, route: str) -> None:
+        self.routes[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _observe(self, route: str, channel_id: int, payload: dict):
+        if self.on_message is not None:
+            self.on_message(route, channel_id, payload)
+
+    async def me(self, request: web.Request) -> web.Response:
+        await self._respond("GET /users/@me")
+        return json_response(self.user())
+
+    async def application(self, request: web.Request) -> web.Response:
+        await self._respond("GET /oauth2/applications/@me")
+        return json_response({"id": str(self.bot_id), "name": "hasura-bot", "icon": None, "description": "",
+                                  "bot_public": False, "bot_require_code_grant": False, "owner": self.user(),
+                                  "verify_key": "", "flags": 0})
+
+    async def send_message(self, request: web.Request) -> web.Response:
+        await self._respond("POST /channels/{id}/messages")
+        self._sends += 1
+        if self.rate_limit_every and self._sends % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            headers = {
+                "Via": "1.1 google",
+                "X-RateLimit-Bucket": "fake-send-bucket",
+                "X-RateLimit-Limit": "5",
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Reset-After": str(self.retry_after),
+                "X-RateLimit-Scope": "user",
+                "Retry-After": str(self.retry_after),
+            }
+            return json_response({"message": "You are being rate limited.",
+                                      "retry_after": self.retry_after,
+                                      "global": False}, status=429, headers=headers)
+        channel_id = int(request.match_info["channel_id"])
+        payload = await self.payload(request)
+        self._observe("POST /channels/{id}/messages", channel_id, payload)
+        return json_response(self.message(channel_id, payload=payload))
+
+    async def get_message(self, request: web.Request) -> web.Response:
+        await self._respond("GET /channels/{id}/messages/{id}")
+        return json_response(self.message(int(request.match_info["channel_id"]),
+                                              int(request.match_info["message_id"])))
+
+    async def edit_message(self, request: web.Request) -> web.Response:
+        await self._respond("PATCH /channels/{id}/messages/{id}")
+        channel_id = int(request.match_info["channel_id"])
+        payload = await self.payload(request)
+        self._observe("PATCH /channels/{id}/messages/{id}", channel_id, payload)
+        return json_response(self.message(channel_id, int(request.match_info["message_id"]), payload))
+
+    async def add_reaction(self, request: web.Request) -> web.Response:
+        await self._respond("PUT /channels/{id}/messages/{id}/reactions/{emoji}/@me")
+        return web.Response(status=204)
+
+    async def edit_channel(self, request: web.Request) -> web.Response:
+        await self._respond("PATCH /channels/{id}")
+        payload = await self.payload(request)
+        return json_response({
+            "id": request.match_info["channel_id"],
+            "parent_id": str(self.forum_channel_id),
+            "owner_id": str(self.bot_id),
+            "name": payload.get("name") or "Question",
+            "type": 11,
+            "message_count": 0,
+            "member_count": 1,
+            "thread_metadata": {"archived": payload.get("archived", False),
+                                "locked": payload.get("locked", False),
+                                "auto_archive_duration": 1440,
+                                "archive_timestamp": datetime.now(timezone.utc).isoformat()},
+        })
+
+    async def interaction_callback(self, request: web.Request) -> web.Response:
+        await self._respond("POST /interactions/{id}/{token}/callback")
+        return web.Response(status=204)
+
+    async def send_followup(self, request: web.Request) -> web.Response:
+        await self._respond("POST /webhooks/{id}/{token}")
+        return json_response(self.message(0, payload=await self.payload(request)))
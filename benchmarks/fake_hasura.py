@@ -0,0 +1,255 @@
+"""
+A stand-in for the Hasura GraphQL endpoint, covering the queries and mutations in constants.py.
+
+Data lives in memory. Operations are dispatched on the operation name in the document, and every request can be delayed
+to simulate network and database latency. It also stands in for the answer pipeline: when a message that starts a
+thread or mentions the bot is inserted, a bot answer is inserted answer_delay seconds later.
+"""
+import asyncio
+import itertools
+import re
+from collections import Counter
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+OPERATION_NAME = re.compile(r'^\s*(?:query|mutation|subscription)\s+(\w+)')
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeHasura:
+
+    def __init__(self, guild_id: int, forum_channel_id: int, logging_channel_id: int, mod_role_id: int,
+                 latency: float = 0.005, answer_delay: float = 0.0, answer_length: int = 3000):
+        """
+        :param guild_id: The guild the configuration is for
+        :param forum_channel_id: The forum the bot watches
+        :param logging_channel_id: The bot's logging channel
+        :param mod_role_id: The moderator role
+        :param latency: Seconds added to every request
+        :param answer_delay: Seconds between a question being inserted and its answer being inserted
+        :param answer_length: The number of characters in each generated answer
+        """
+        self.latency = latency
+        self.answer_delay = answer_delay
+        self.answer_length = answer_length
+        self.configuration = {
+            "guild_id": guild_id,
+            "logging_channel_id": logging_channel_id,
+            "mod_role_id": mod_role_id,
+            "banned_user_ids": [],
+            "guild_forums": [{"forum_channel_id": forum_channel_id, "forum_collection": "docs"}],
+        }
+        self.threads: dict[str, dict] = {}
+        self.messages: dict[str, dict] = {}
+        self.operations = Counter()
+        self.request_bytes = Counter()
+        self.persisted_queries: dict[str, str] = {}
+        self.answers_inserted = 0
+        self._ids = itertools.count(9 * 10 ** 17)
+        self._answer_tasks: set[asyncio.Task] = set()
+        self.handlers = {
+            "Config": self.config,
+            "InsertThreads": self.insert_threads,
+            "InsertMessages": self.insert_messages,
+            "UpdateMessageEditsMany": self.update_message_edits_many,
+            "ClaimableMessages": self.claimable_messages,
+            "ClaimMessages": self.claim_messages,
+            "AckMessages": self.ack_messages,
+            "ReleaseMessages": self.release_messages,
+            "GetThreadByControllerId": self.get_thread_by_controller,
+            "ThreadById": self.thread_by_id,
+            "GetAllThreads": self.get_all_threads,
+            "GET_COLLECTIONS_ENUM": self.collections,
+            "UpdateThreadVotesMany": self.update_thread_votes_many,
+            "MarkThreadsSolvedMany": self.mark_threads_solved_many,
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/graphql", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        payload = await request.json()
+        query = payload.get("query")
+        # Automatic persisted queries: a hash with the document registers it, a hash on its own looks it up.
+        persisted_query = (payload.get("extensions") or {}).get("persistedQuery")
+        if persisted_query is not None:
+            if query is not None:
+                self.persisted_queries[persisted_query["sha256Hash"]] = query
+            else:
+                query = self.persisted_queries.get(persisted_query["sha256Hash"])
+                if query is None:
+                    return web.json_response({"errors": [{"message": "PersistedQueryNotFound",
+                                                          "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}]})
+        match = OPERATION_NAME.match(query or "")
+        name = match.group(1) if match else "Unknown"
+        self.operations[name] += 1
+        self.request_bytes[name] += len(body)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        handler = self.handlers.get(name)
+        if handler is None:
+            return web.json_response({"errors": [{"message": f"Unknown operation {name}"}]})
+        return web.json_response({"data": handler(payload.get("variables") or {})})
+
+    def config(self, variables: dict) -> dict:
+        if str(variables.get("guild_id")) != str(self.configuration["guild_id"]):
+            return {"configuration_by_pk": None}
+        return {"configuration_by_pk": self.configuration}
+
+    def insert_threads(self, variables: dict) -> dict:
+        affected_rows = 0
+        for row in variables["objects"]:
+            nested = row.pop("messages", {"data": []})
+            if row["thread_id"] in self.threads:
+                self.threads[row["thread_id"]]["thread_controller_id"] = row["thread_controller_id"]
+            else:
+                self.threads[row["thread_id"]] = {"solved_votes": 0, "failed_votes": 0, "created_at": now(),
+                                                  "updated_at": now(), **row}
+            affected_rows += 1
+            for message in nested["data"]:
+                affected_rows += self._store_message({**message, "thread_id": row["thread_id"]})
+        return {"insert_thread": {"affected_rows": affected_rows}}
+
+    def _store_message(self, row: dict):
+        if row["message_id"] in self.messages:
+            return False
+        message = {"sources": None, "created_at": now(), "updated_at": now(), "lease_owner": None,
+                   "lease_expires_at": None, "delivery_attempts": 0, "delivered_at": None,
+                   "discord_message_ids": None, **row}
+        self.messages[message["message_id"]] = message
+        if not message["from_bot"] and (message["first_message"] or message["mentions_bot"]):
+            task = asyncio.create_task(self._answer(message["thread_id"]))
+            self._answer_tasks.add(task)
+            task.add_done_callback(self._answer_tasks.discard)
+        return True
+
+    async def _answer(self, thread_id: str):
+        if self.answer_delay:
+            await asyncio.sleep(self.answer_delay)
+        words = "Hasura instantly gives you GraphQL APIs over your data, see [the docs](https://hasura.io/docs). "
+        content = (words * (self.answer_length // len(words) + 1))[:self.answer_length]
+        self._store_message({
+            "thread_id": thread_id,
+            "message_id": str(next(self._ids)),
+            "content": content,
+            "sources": "https://hasura.io/docs/latest/index/",
+            "from_bot": True,
+            "first_message": False,
+            "mentions_bot": False,
+            "processed": False,
+        })
+        self.answers_inserted += 1
+
+    def insert_messages(self, variables: dict) -> dict:
+        return {"insert_message": {"affected_rows": sum(self._store_message(row) for row in variables["objects"])}}
+
+    def update_message_edits_many(self, variables: dict) -> dict:
+        results = []
+        for update in variables["updates"]:
+            message = self.messages.get(update["where"]["message_id"]["_eq"])
+            if message is not None:
+                message.update(update["_set"], updated_at=now())
+            results.append({"affected_rows": int(message is not None)})
+        return {"update_message_many": results}
+
+    @staticmethod
+    def _claimable(message: dict, now: str) -> bool:
+        return not message["processed"] and (message["lease_expires_at"] is None or message["lease_expires_at"] < now)
+
+    def claimable_messages(self, variables: dict) -> dict:
+        rows = sorted((message for message in self.messages.values()
+                       if message["from_bot"] and not message["processed"]
+                       and message["delivery_attempts"] < variables["max_attempts"]),
+                      key=lambda message: message["created_at"])
+        return {"message": [{"message_id": message["message_id"],
+                             "thread_id": message["thread_id"],
+                             "created_at": message["created_at"],
+                             "lease_expires_at": message["lease_expires_at"]} for message in rows[:variables["limit"]]]}
+
+    def claim_messages(self, variables: dict) -> dict:
+        returning = []
+        for message_id in variables["message_ids"]:
+            message = self.messages.get(message_id)
+            if message is None or not self._claimable(message, variables["now"]):
+                continue
+            message["lease_owner"] = variables["owner"]
+            message["lease_expires_at"] = variables["expires_at"]
+            message["delivery_attempts"] += 1
+            thread = self.threads.get(message["thread_id"], {})
+            returning.append({**message, "thread": {"thread_controller_id": thread.get("thread_controller_id"),
+                                                    "author_id": thread.get("author_id")}})
+        return {"update_message": {"returning": returning}}
+
+    def ack_messages(self, variables: dict) -> dict:
+        results = []
+        for update in variables["updates"]:
+            message = self.messages.get(update["where"]["message_id"]["_eq"])
+            if message is None or message["lease_owner"] != update["where"]["lease_owner"]["_eq"]:
+                results.append({"affected_rows": 0})
+                continue
+            message.update(update["_set"])
+            results.append({"affected_rows": 1})
+        return {"update_message_many": results}
+
+    def release_messages(self, variables: dict) -> dict:
+        results = []
+        for update in variables["updates"]:
+            message = self.messages.get(update["where"]["message_id"]["_eq"])
+            if message is None or message["lease_owner"] != update["where"]["lease_owner"]["_eq"]:
+                results.append({"affected_rows": 0})
+                continue
+            message.update(update["_set"])
+            message["delivery_attempts"] += update["_inc"]["delivery_attempts"]
+            results.append({"affected_rows": 1})
+        return {"update_message_many": results}
+
+    def get_thread_by_controller(self, variables: dict) -> dict:
+        return {"thread": [thread for thread in self.threads.values()
+                           if thread["thread_controller_id"] == variables["thread_controller_id"]]}
+
+    def thread_by_id(self, variables: dict) -> dict:
+        return {"thread_by_pk": self.threads.get(variables["thread_id"])}
+
+    def get_all_threads(self, variables: dict) -> dict:
+        threads = sorted(self.threads.values(), key=lambda thread: thread["created_at"], reverse=True)
+        return {"thread": threads[variables["offset"]:variables["offset"] + variables["limit"]]}
+
+    def collections(self, variables: dict) -> dict:
+        return {"COLLECTION_ENUM": [{"value": "docs"}]}
+
+    def _increment_votes(self, thread_id: str, failed_votes: int, solved_votes: int) -> int:
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            return 0
+        thread["failed_votes"] += failed_votes
+        thread["solved_votes"] += solved_votes
+        return 1
+
+    def update_thread_votes_many(self, variables: dict) -> dict:
+        return {"update_thread_many": [
+            {"affected_rows": self._increment_votes(update["where"]["thread_id"]["_eq"],
+                                                    update["_inc"].get("failed_votes", 0),
+                                                    update["_inc"].get("solved_votes", 0))}
+            for update in variables["updates"]
+        ]}
+
+    def mark_threads_solved_many(self, variables: dict) -> dict:
+        results = []
+        for update in variables["updates"]:
+            thread = self.threads.get(update["where"]["thread_id"]["_eq"])
+            if thread is not None:
+                thread.update(update["_set"])
+            results.append({"affected_rows": int(thread is not None)})
+        return {"update_thread_many": results}
+
+    def pending_answers(self) -> int:
+        return len(self._answer_tasks) + sum(1 for message in self.messages.values()
+                                             if message["from_bot"] and not message["processed"])
+
@@ -0,0 +1,98 @@
+"""
+Compares per-call aiohttp sessions against the pooled GraphQLClient using a local stand-in GraphQL server.
+
+Run from the repository root:
+    python -m benchmarks.graphql_client --requests 500 --concurrency 1
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+from aiohttp import web
+
+from graphql_client import GraphQLClient
+
+QUERY = """mutation ProcessMessages {
+  update_message(where: {from_bot: {_eq: true}, processed: {_eq: false}}, _set: {processed: true}) {
+    returning {
+      message_id
+    }
+  }
+}
+"""
+HEADERS = {"Content-Type": "application/json", "x-hasura-admin-secret": "benchmark"}
+
+
+async def graphql_handler(request: web.Request) -> web.Response:
+    await request.json()
+    return web.json_response({"data": {"update_message": {"returning": []}}})
+
+
+async def start_stand_in(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_post("/v1/graphql", graphql_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def per_call_session(url: str):
+    # This is what constants.execute_graphql used to do on every call.
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json={'query': QUERY, 'variables': {}}, headers=HEADERS) as response:
+            return await response.json()
+
+
+async def measure(call, requests: int, concurrency: int) -> list[float]:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed():
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    return latencies
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def report(name: str, latencies: list[float]):
+    print(f"{name:<18} n={len(latencies):<6} mean={statistics.mean(latencies):7.3f}ms "
+          f"p50={percentile(latencies, 50):7.3f}ms p99={percentile(latencies, 99):7.3f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    url = f"http://{args.host}:{args.port}/v1/graphql"
+    runner = await start_stand_in(args.host, args.port)
+    client = GraphQLClient()
+    try:
+        # Warm up both paths so neither pays for first-import or first-connection costs.
+        await per_call_session(url)
+        await client.execute(url, QUERY, {}, HEADERS)
+
+        report("per-call session", await measure(lambda: per_call_session(url), args.requests, args.concurrency))
+        report("pooled client", await measure(lambda: client.execute(url, QUERY, {}, HEADERS),
+                                              args.requests, args.concurrency))
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+"""
+Compares the single-pass MarkdownSplitter against the previous split_content on large LLM-style outputs and on
+link-heavy source lists.
+
+Run from the repository root:
+    python -m benchmarks.split_content --sizes 100000 300000 800000 3000000
+"""
+import argparse
+import os
+import random
+import time
+
+# utilities imports constants, which needs a guild id, but nothing here talks to Discord or Hasura.
+os.environ.setdefault("GUILD_ID", "0")
+
+from utilities import split_content  # noqa: E402
+
+
+def legacy_split_content(content, max_length=4096):
+    # The previous implementation, which re-slices and re-strips the remaining string for every part.
+    if len(content) <= max_length:
+        return [content]
+
+    parts = []
+    while content:
+        if len(content) <= max_length:
+            parts.append(content)
+            break
+
+        split_index = content.rfind(' ', 0, max_length)
+        if split_index == -1:
+            split_index = max_length
+
+        part = content[:split_index].strip()
+        parts.append(part)
+        content = content[split_index:].strip()
+
+    return parts
+
+
+def generate(size: int, seed: int = 0) -> str:
+    """
+    Generates markdown with prose, links and code blocks, roughly like an answer from the LLM.
+    """
+    rng = random.Random(seed)
+    words = ["hasura", "graphql", "permissions", "actions", "remote", "schema", "the", "a", "to", "of", "query"]
+    parts = []
+    length = 0
+    while length < size:
+        roll = rng.random()
+        if roll < 0.1:
+            lines = "\n".join(f"    field_{i}: String  # {rng.choice(words)}" for i in range(rng.randint(5, 80)))
+            part = f"```graphql\ntype Example {{\n{lines}\n}}\n```\n\n"
+        elif roll < 0.3:
+            part = f"See [the docs](https://hasura.io/docs/latest/{rng.choice(words)}/{rng.randint(0, 999)}/). "
+        else:
+            part = " ".join(rng.choice(words) for _ in range(rng.randint(10, 80))) + "\n\n"
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def generate_sources(size: int, seed: int = 0) -> str:
+    """
+    Generates a list of links, like the sources the bot sends with each answer.
+    """
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        part = (f"- [Hasura docs: {rng.choice(['permissions', 'actions', 'remote schemas'])}]"
+                f"(https://hasura.io/docs/latest/{rng.randint(0, 999)}/{rng.randint(0, 999)}/)\n")
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def best_of(function, content: str, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in function(content, 4096):
+            pass
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 300_000, 800_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, generator in (("answer", generate), ("sources", generate_sources)):
+        for size in args.sizes:
+            content = generator(size)
+            legacy = best_of(legacy_split_content, content, args.repeat)
+            current = best_of(split_content, content, args.repeat)
+            broken = sum(part.count("```") % 2 for part in legacy_split_content(content))
+            print(f"{name:<8} {len(content):>9} chars  legacy={legacy:8.3f}ms  markdown-aware={current:8.3f}ms  "
+                  f"legacy parts with unbalanced code blocks={broken}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Exercises PendingMessageSubscription against a local graphql-transport-ws stand-in.
+
+It measures the time from the server pushing a new unprocessed bot message to the task loop waking up, then drops the
+socket to check that the subscription reconnects, resumes from its last cursor, and wakes the task loop to catch up.
+
+Run from the repository root:
+    python -m benchmarks.subscription --pushes 200
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web, WSMsgType
+
+from graphql_client import GraphQLClient
+from task_loop.subscription import PendingMessageSubscription, GRAPHQL_TRANSPORT_WS
+
+
+class StandIn:
+    """
+    A minimal graphql-transport-ws server that records subscriptions and pushes message_stream rows on demand.
+    """
+
+    def __init__(self):
+        self.sockets: list[web.WebSocketResponse] = []
+        self.cursors: list[str] = []
+        self.subscription_ids: list[str] = []
+        self.subscribed = asyncio.Event()
+
+    async def handler(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(protocols=(GRAPHQL_TRANSPORT_WS,))
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+            payload = msg.json()
+            if payload["type"] == "connection_init":
+                await ws.send_json({"type": "connection_ack"})
+            elif payload["type"] == "subscribe":
+                self.subscription_ids.append(payload["id"])
+                self.cursors.append(payload["payload"]["variables"]["cursor"])
+                self.subscribed.set()
+        return ws
+
+    async def push(self, created_at: str):
+        await self.sockets[-1].send_json({
+            "id": self.subscription_ids[-1],
+            "type": "next",
+            "payload": {"data": {"message_stream": [{"message_id": created_at, "created_at": created_at}]}}
+        })
+
+    async def drop(self):
+        self.subscribed.clear()
+        await self.sockets[-1].close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--pushes", type=int, default=200)
+    args = parser.parse_args()
+
+    stand_in = StandIn()
+    app = web.Application()
+    app.router.add_get("/v1/graphql", stand_in.handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+
+    client = GraphQLClient()
+    subscription = PendingMessageSubscription(url=f"ws://{args.host}:{args.port}/v1/graphql",
+                                              headers={"x-hasura-admin-secret": "benchmark"},
+                                              session_factory=client.open,
+                                              max_reconnect_delay=1)
+    try:
+        subscription.start()
+        await asyncio.wait_for(stand_in.subscribed.wait(), 5)
+        # The first wake is the catch-up on connect.
+        assert await subscription.wait(fallback_interval=1), "expected a catch-up wake on connect"
+
+        latencies = []
+        created_at = datetime.now(timezone.utc)
+        for _ in range(args.pushes):
+            created_at += timedelta(milliseconds=1)
+            start = time.perf_counter()
+            await stand_in.push(created_at.isoformat())
+            assert await subscription.wait(fallback_interval=1), "push did not wake the task loop"
+            latencies.append((time.perf_counter() - start) * 1000)
+        ordered = sorted(latencies)
+        print(f"push to wake       n={len(ordered):<6} p50={ordered[len(ordered) // 2]:7.3f}ms "
+              f"p99={ordered[int(len(ordered) * 0.99) - 1]:7.3f}ms (vs. up to 1000ms when polling)")
+
+        await stand_in.drop()
+        # While the socket is down, waits fall back to the polling interval.
+        await asyncio.wait_for(stand_in.subscribed.wait(), 5)
+        assert await subscription.wait(fallback_interval=1), "expected a catch-up wake on reconnect"
+        assert stand_in.cursors[-1] == created_at.isoformat(), "the subscription did not resume from its cursor"
+        print(f"reconnected after drop, resumed from cursor {stand_in.cursors[-1]}")
+    finally:
+        await subscription.stop()
+        await client.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
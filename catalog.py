@@ -0,0 +1,84 @@
+import asyncio
+from constants import *
+
+
+class CollectionCatalog:
+    """
+    The searchable document collections (COLLECTION_ENUM), held in memory and refreshed in the background.
+
+    /collections and the /search collection autocomplete are served from memory, and /search uses the catalog to reject
+    unknown collections before they reach the search endpoint.
+    """
+
+    def __init__(self, refresh_interval: float = 300):
+        """
+        :param refresh_interval: The number of seconds between background refreshes
+        """
+        self.refresh_interval = refresh_interval
+        self.collections: tuple[str, ...] = ()
+        self.loaded = False
+        self._task: asyncio.Task | None = None
+
+    async def refresh(self) -> bool:
+        """
+        Reloads the collections from Hasura. On failure the previous collections are kept.
+
+        :return: Whether the refresh succeeded
+        """
+        result = await execute_graphql(
+            GRAPHQL_URL,
+            GET_DOCS_COLLECTION,
+            {},
+            GRAPHQL_HEADERS
+        )
+        if not result or "data" not in result:
+            print("Failed to refresh the collection catalog.")
+            return False
+        self.collections = tuple(i['value'] for i in result["data"]["COLLECTION_ENUM"])
+        self.loaded = True
+        return True
+
+    async def ensure_loaded(self) -> bool:
+        """
+        Loads the collections if they have never been loaded.
+
+        :return: Whether the catalog is loaded
+        """
+        return self.loaded or await self.refresh()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="collection-catalog-refresh")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __contains__(self, collection: str) -> bool:
+        return collection in self.collections
+
+    def matching(self, current: str, limit: int = 25) -> list[str]:
+        """
+        Finds collections for autocomplete. Discord allows at most 25 choices.
+
+        :param current: What the user has typed so far
+        :param limit: The maximum number of collections to return
+        :return: The collections starting with what was typed, then the ones containing it
+        """
+        current = current.lower()
+        starts = [c for c in self.collections if c.lower().startswith(current)]
+        contains = [c for c in self.collections if current in c.lower() and c not in starts]
+        return (starts + contains)[:limit]
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+
+collection_catalog = CollectionCatalog(refresh_interval=COLLECTION_REFRESH_SECONDS)
@@ -1,5 +1,5 @@
-from constants import *
-from utilities import *
+from constants import COLLECTIONS_UNAVAILABLE_MESSAGE, NO_COLLECTIONS_MESSAGE
+from catalog import collection_catalog
 import discord
 from discord.ui import View, Select
 
@@ -7,13 +7,14 @@ from discord.ui import View, Select
 # It will be easier to understand if we give users a dropdown.
 async def command_collections(interaction: discord.Interaction.response,
                               _: discord.Client):
-    result = await execute_graphql(
-        GRAPHQL_URL,
-        GET_DOCS_COLLECTION,
-        {},
-        GRAPHQL_HEADERS
-    )
-    documents = [i['value'] for i in result["data"]["COLLECTION_ENUM"]]
+    # The catalog is refreshed in the background, so this only goes to Hasura if it has never loaded.
+    if not await collection_catalog.ensure_loaded():
+        await interaction.response.send_message(COLLECTIONS_UNAVAILABLE_MESSAGE, ephemeral=True)
+        return
+    if not collection_catalog.collections:
+        await interaction.response.send_message(NO_COLLECTIONS_MESSAGE, ephemeral=True)
+        return
+    documents = collection_catalog.collections
     select = Select(placeholder='Searchable Collections', min_values=1, max_values=1)
 
     # Dynamically add options to the Select component
@@ -0,0 +1,40 @@
+from utilities import *
+from profiling import loop_watchdog, sampling_profiler
+import discord
+
+
+async def command_profile(interaction: discord.Interaction.response, seconds: int):
+    """
+    Samples the running bot for a few seconds and replies with the functions it spent the most time in, along with the
+    event loop lag measured by the watchdog.
+
+    Can only be used by the users in PROFILE_OPERATOR_IDS, or if there are none, by members with the mod role of the
+    primary guild, in that guild. The profile covers every guild the bot serves, so other guilds' mods can't run it.
+
+    :param interaction: The incoming interaction
+    :param seconds: How long to sample for, up to PROFILE_MAX_SECONDS
+    :return:
+    """
+    await interaction.response.defer(ephemeral=True)
+
+    if PROFILE_OPERATOR_IDS:
+        allowed = interaction.user.id in PROFILE_OPERATOR_IDS
+    else:
+        config = await get_config(GUILD_ID) if GUILD_ID is not None and interaction.guild_id == GUILD_ID else None
+        allowed = config is not None and config.mod_role in [role.id for role in getattr(interaction.user, "roles", [])]
+    if not allowed:
+        return await send_followup(interaction, PROFILE_NO_PERMISSION_MESSAGE)
+
+    if sampling_profiler.running:
+        return await send_followup(interaction, PROFILE_RUNNING_MESSAGE)
+
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    report = await sampling_profiler.profile(seconds)
+    # Leave room for the code block around the report.
+    embed = discord.Embed(title=PROFILE_TITLE,
+                          description=f"```\n{report[:MAX_EMBED_DESCRIPTION - 8]}\n```",
+                          color=discord.Color.blurple())
+    watchdog = loop_watchdog.stats()
+    embed.set_footer(text=f"Event loop lag: last {watchdog['last_lag'] * 1000:.1f}ms, "
+                          f"max {watchdog['max_lag'] * 1000:.1f}ms, {watchdog['stalls']} stalls")
+    return await send_followup(interaction, embed=embed)
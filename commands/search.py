@@ -1,27 +1,34 @@
 from constants import *
+from cache import TTLCache
+from catalog import collection_catalog
+from utilities import send_followup
 import discord
 import aiohttp
 
+# Identical searches within SEARCH_CACHE_TTL_SECONDS are served from memory, and identical searches in flight at the
+# same time share one request to the search endpoint.
+search_cache = TTLCache(max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL_SECONDS)
 
-async def command_search(interaction: discord.Interaction.response, query: str, collection: str, limit: int = 10):
+
+class SearchError(Exception):
+    """
+    The search endpoint responded with an error. These are not cached.
     """
-    Performs a vector search across a collection for an embedded query.
 
-    :param interaction: The incoming interaction
+    def __init__(self, details: str):
+        super().__init__(details)
+        self.details = details
+
+
+async def fetch_search_results(query: str, collection: str, limit: int) -> list[dict]:
+    """
+    Runs a search against the search endpoint.
+
     :param query: The query to search for
     :param collection: The name of the collection in Qdrant
-    :param limit: The number of results to return, max 100
-    :return:
+    :param limit: The number of results to return
+    :return: The ranked results
     """
-    # Prepare the request payload according to the API's expected schema
-    if limit > 100:
-        await interaction.response.send_message("The request exceeds the maximum allowed limit of 100 documents.")
-        return
-
-    # DEFER the response, the maximum this can take is 15 seconds. That's why it is insufficient for GPT, which needs
-    # a task loop but fine for things like a vector search
-    await interaction.response.defer()
-
     payload = {
         "collection": collection,
         "query": query,
@@ -38,26 +45,61 @@ async def command_search(interaction: discord.Interaction.response, query: str,
     async with aiohttp.ClientSession() as session:
         async with session.post(SEARCH_ENDPOINT_URL, json=payload, headers=headers) as response:
             if response.status == 200:
-                data = await response.json()
-
-                # The maximum number of fields in an embed is 25, so chunk the results
-                chunks = [data[x:x + 25] for x in range(0, len(data), 25)]
-
-                for chunk in chunks:
-                    embed = discord.Embed(title=SEARCH_RESPONSE_EMBED_TITLE, description=query)
-                    for link in chunk:
-                        rank = link["rank"]
-                        url = link["url"]
-                        score = link["score"]
-                        embed.add_field(name=f"Rank: {rank}", value=f"{url} **Match %{score}**", inline=False)
-
-                    # Send the message back to the Discord channel for each chunk
-                    await interaction.followup.send(embed=embed)
-
-            else:
-                # This part helps debug the issue by providing server's error details. We are a code server, if there
-                # are bugs people might just find it interesting and it'll make it easy to debug. This is public facing
-                # anyways
-                error_details = await response.text()  # Get the text of the response
-                embed = discord.Embed(title="Failed to get search results.", description=error_details)
-                await interaction.followup.send(embed=embed)
+                return await response.json()
+            # This part helps debug the issue by providing server's error details. We are a code server, if there
+            # are bugs people might just find it interesting and it'll make it easy to debug. This is public facing
+            # anyways
+            raise SearchError(await response.text())
+
+
+async def command_search(interaction: discord.Interaction.response, query: str, collection: str, limit: int = 10):
+    """
+    Performs a vector search across a collection for an embedded query.
+
+    :param interaction: The incoming interaction
+    :param query: The query to search for
+    :param collection: The name of the collection in Qdrant
+    :param limit: The number of results to return, max 100
+    :return:
+    """
+    # Prepare the request payload according to the API's expected schema
+    if limit > 100:
+        await interaction.response.send_message("The request exceeds the maximum allowed limit of 100 documents.")
+        return
+
+    # DEFER the response, the maximum this can take is 15 seconds. That's why it is insufficient for GPT, which needs
+    # a task loop but fine for things like a vector search. The catalog may have to be loaded first, so this comes
+    # before it.
+    await interaction.response.defer()
+
+    # Unknown collections never reach the search endpoint.
+    if not await collection_catalog.ensure_loaded():
+        await send_followup(interaction, COLLECTIONS_UNAVAILABLE_MESSAGE)
+        return
+    if collection not in collection_catalog:
+        await send_followup(interaction, UNKNOWN_COLLECTION_MESSAGE.format(collection=collection))
+        return
+
+    # Searches that only differ in case or whitespace share a cache entry, the query is searched for as it was typed.
+    normalized_query = " ".join(query.lower().split())
+    try:
+        data = await search_cache.get_or_load((collection, normalized_query, limit),
+                                              lambda: fetch_search_results(query, collection, limit))
+    except SearchError as e:
+        embed = discord.Embed(title="Failed to get search results.", description=e.details)
+        await send_followup(interaction, embed=embed)
+        return
+
+    # The maximum number of fields in an embed is 25, so chunk the results
+    chunks = [data[x:x + 25] for x in range(0, len(data), 25)]
+
+    for chunk in chunks:
+        embed = discord.Embed(title=SEARCH_RESPONSE_EMBED_TITLE, description=query)
+        for link in chunk:
+            rank = link["rank"]
+            url = link["url"]
+            score = link["score"]
+            embed.add_field(name=f"Rank: {rank}", value=f"{url} **Match %{score}**", inline=False)
+
+        # Send the message back to the Discord channel for each chunk
+        await send_followup(interaction, embed=embed)
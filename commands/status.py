@@ -13,13 +13,14 @@ async def command_status(interaction: discord.Interaction.response):
     await interaction.response.defer()
 
     if not isinstance(interaction.channel, discord.Thread):
-        await interaction.followup.send(embed=discord.Embed(title=UNAVAILABLE_COMMAND))
+        await send_followup(interaction, embed=discord.Embed(title=UNAVAILABLE_COMMAND))
         return
 
-    if interaction.channel.parent_id not in CHANNELS:
-        await interaction.followup.send(embed=allowed_channels_embed(interaction))
+    config = await get_config(interaction.guild_id)
+    if config is None or interaction.channel.parent_id not in config.channels:
+        await allowed_channels_embed(interaction, config)
         return
 
     thread_id = str(interaction.channel.id)
-    status_embed = await build_thread_status_embed(thread_id)
-    await interaction.followup.send(embed=status_embed)
+    status_embed = await build_thread_status_embed(interaction.guild_id, thread_id)
+    await send_followup(interaction, embed=status_embed)
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from constants import *
+
+
+@dataclass(frozen=True)
+class GuildConfig:
+    """
+    The guild configuration stored in Hasura (configuration_by_pk).
+    """
+    guild_id: int
+    logging_channel: int
+    mod_role: int
+    # A set so that checking every message and reaction author against it is O(1).
+    banned: frozenset[int]
+    channels: dict[int, str]
+
+    @classmethod
+    def from_row(cls, row: dict) -> "GuildConfig":
+        return cls(guild_id=row['guild_id'],
+                   logging_channel=row['logging_channel_id'],
+                   mod_role=row['mod_role_id'],
+                   banned=frozenset(int(user_id) for user_id in row['banned_user_ids'] or []),
+                   channels={forum['forum_channel_id']: forum['forum_collection'] for forum in row['guild_forums']})
+
+    def diff(self, other: "GuildConfig") -> list[str]:
+        """
+        Describes what changed between this configuration and a newer one.
+
+        :param other: The newer configuration
+        :return: A line per change
+        """
+        changes = []
+        if other.logging_channel != self.logging_channel:
+            changes.append(f"Logging channel: <#{self.logging_channel}> -> <#{other.logging_channel}>")
+        if other.mod_role != self.mod_role:
+            changes.append(f"Mod role: <@&{self.mod_role}> -> <@&{other.mod_role}>")
+        changes += [f"Banned: <@{user_id}>" for user_id in sorted(other.banned - self.banned)]
+        changes += [f"Unbanned: <@{user_id}>" for user_id in sorted(self.banned - other.banned)]
+        for channel_id in other.channels.keys() - self.channels.keys():
+            changes.append(f"Forum added: <#{channel_id}> ({other.channels[channel_id]})")
+        for channel_id in self.channels.keys() - other.channels.keys():
+            changes.append(f"Forum removed: <#{channel_id}>")
+        for channel_id in self.channels.keys() & other.channels.keys():
+            if self.channels[channel_id] != other.channels[channel_id]:
+                changes.append(f"Forum <#{channel_id}> collection: {self.channels[channel_id]} -> "
+                               f"{other.channels[channel_id]}")
+        return changes
+
+
+class ConfigStore:
+    """
+    Loads a guild's configuration and keeps it up to date.
+
+    If a snapshot of the last good configuration exists on disk, load() returns immediately with it and the fresh
+    configuration is fetched in the background. Otherwise load() waits for Hasura.
+
+    Once started, the configuration is re-fetched every refresh_interval seconds. A changed configuration replaces the
+    current one in a single assignment, so readers see either the old or the new configuration, never a mix.
+    """
+
+    def __init__(self,
+                 guild_id: int,
+                 snapshot_path: str | None = None,
+                 attempts: int = 5,
+                 refresh_interval: float = 60):
+        """
+        :param guild_id: The guild to load the configuration for
+        :param snapshot_path: Where to keep the last good configuration, or None to not keep one
+        :param attempts: How many times to try fetching the configuration before giving up
+        :param refresh_interval: The number of seconds between refreshes
+        """
+        self.guild_id = guild_id
+        self.snapshot_path = snapshot_path
+        self.attempts = attempts
+        self.refresh_interval = refresh_interval
+        self.current: GuildConfig | None = None
+        self.source: str | None = None
+        self.load_seconds: float | None = None
+        self.listeners: list[Callable[[GuildConfig, list[str]], Awaitable[None]]] = []
+        self._background: asyncio.Task | None = None
+        self._refresh: asyncio.Task | None = None
+
+    async def load(self) -> GuildConfig:
+        """
+        Loads the configuration, from the snapshot if there is one, otherwise from Hasura.
+
+        :return: The configuration
+        """
+        started = time.perf_counter()
+        if self.load_snapshot():
+            self._background = asyncio.create_task(self.fetch_with_retry(), name="guild-config-fetch")
+        elif not await self.fetch_with_retry():
+            raise RuntimeError(f"Could not load the configuration for guild {self.guild_id}.")
+        self.load_seconds = time.perf_counter() - started
+        return self.current
+
+    async def fetch(self) -> bool:
+        """
+        Fetches the configuration from Hasura and saves a snapshot of it.
+
+        :return: Whether the fetch succeeded
+        """
+        result = await execute_graphql(url=GRAPHQL_URL,
+                                       headers=GRAPHQL_HEADERS,
+                                       query=GET_CONFIG,
+                                       variables={"guild_id": self.guild_id},
+                                       )
+        if not result or not result.get("data", {}).get("configuration_by_pk"):
+            return False
+        row = result["data"]["configuration_by_pk"]
+        config = GuildConfig.from_row(row)
+        previous, self.current = self.current, config
+        self.source = "hasura"
+        if previous != config:
+            self.save_snapshot(row)
+            if previous is not None:
+                changes = previous.diff(config)
+                print("The guild configuration changed:\n" + "\n".join(changes))
+                for listener in self.listeners:
+                    try:
+                        await listener(config, changes)
+                    except Exception as e:
+                        print(f"A configuration listener failed: {e!r}")
+        return True
+
+    async def fetch_with_retry(self) -> bool:
+        delay = 1
+        for attempt in range(self.attempts):
+            if await self.fetch():
+                return True
+            if attempt + 1 == self.attempts:
+                break
+            print(f"Failed to fetch the configuration for guild {self.guild_id}, attempt {attempt + 1}. "
+                  f"Retrying in {delay} seconds...")
+            await asyncio.sleep(delay)
+            delay *= 2
+        return False
+
+    def load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                row = json.load(file)
+            config = GuildConfig.from_row(row)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring the configuration snapshot at {self.snapshot_path}: {e!r}")
+            return False
+        if config.guild_id != self.guild_id:
+            return False
+        self.current = config
+        self.source = "snapshot"
+        return True
+
+    def save_snapshot(self, row: dict):
+        if not self.snapshot_path:
+            return
+        # Write to a temporary file first so a crash can never leave a half-written snapshot behind.
+        temporary_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(temporary_path, 'w') as file:
+                json.dump(row, file)
+            os.replace(temporary_path, self.snapshot_path)
+        except OSError as e:
+            print(f"Failed to save the configuration snapshot to {self.snapshot_path}: {e!r}")
+
+    def start(self):
+        """
+        Starts refreshing the configuration in the background.
+        """
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._run(), name="guild-config-refresh")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                if not await self.fetch():
+                    print("Failed to refresh the guild configuration, keeping the current one.")
+            except Exception as e:
+                print(f"Failed to refresh the guild configuration: {e!r}")
+
+    async def close(self):
+        for task in (self._background, self._refresh):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+
+class GuildConfigCache:
+    """
+    The configuration of every guild the bot is in, loaded the first time each guild is seen and cached by guild id.
+
+    Each guild gets its own ConfigStore, which keeps its configuration up to date once it has loaded. Concurrent lookups
+    for a guild that is still loading share one request. A guild without a configuration (or whose configuration could
+    not be loaded) is not looked up again for retry_interval seconds, so its events cost nothing in the meantime.
+    """
+
+    def __init__(self,
+                 snapshot_directory: str | None = None,
+                 refresh_interval: float = 60,
+                 retry_interval: float = 60):
+        """
+        :param snapshot_directory: Where to keep the last good configuration of each guild, or None to not keep them
+        :param refresh_interval: The number of seconds between refreshes of each loaded configuration
+        :param retry_interval: The number of seconds before a guild that failed to load is tried again
+        """
+        self.snapshot_directory = snapshot_directory
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.stores: dict[int, ConfigStore] = {}
+        # Shared by every guild's store.
+        self.listeners: list[Callable[[GuildConfig, list[str]], Awaitable[None]]] = []
+        self._loading: dict[int, asyncio.Task] = {}
+        self._failed: dict[int, float] = {}
+
+    def _store(self, guild_id: int) -> ConfigStore:
+        store = self.stores.get(guild_id)
+        if store is None:
+            snapshot_path = None
+            if self.snapshot_directory:
+                snapshot_path = os.path.join(self.snapshot_directory, f"guild_{guild_id}.json")
+            # One attempt, so an event from a new guild waits for at most one request.
+            store = self.stores[guild_id] = ConfigStore(guild_id=guild_id,
+                                                        snapshot_path=snapshot_path,
+                                                        attempts=1,
+                                                        refresh_interval=self.refresh_interval)
+            store.listeners = self.listeners
+        return store
+
+    async def get(self, guild_id: int | None) -> GuildConfig | None:
+        """
+        Gets a guild's configuration, loading it if this is the first time the guild is seen.
+
+        :param guild_id: The guild
+        :return: The configuration, or None if the guild isn't configured
+        """
+        if guild_id is None:
+            return None
+        store = self.stores.get(guild_id)
+        if store is not None and store.current is not None:
+            return store.current
+        if time.monotonic() < self._failed.get(guild_id, 0):
+            return None
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.create_task(self._load(guild_id),
+                                                                 name=f"guild-config-load-{guild_id}")
+        return await asyncio.shield(task)
+
+    async def _load(self, guild_id: int) -> GuildConfig | None:
+        store = self._store(guild_id)
+        try:
+            config = await store.load()
+        except Exception as e:
+            print(f"Could not load the configuration for guild {guild_id}, retrying in {self.retry_interval} "
+                  f"seconds: {e!r}")
+            self._failed[guild_id] = time.monotonic() + self.retry_interval
+            return None
+        finally:
+            self._loading.pop(guild_id, None)
+        self._failed.pop(guild_id, None)
+        store.start()
+        return config
+
+    def cached(self, guild_id: int) -> GuildConfig | None:
+        """
+        Gets a guild's configuration if it has already been loaded, without loading it.
+
+        :param guild_id: The guild
+        :return: The configuration, or None if it hasn't been loaded
+        """
+        store = self.stores.get(guild_id)
+        return store.current if store is not None else None
+
+    def loaded(self) -> list[GuildConfig]:
+        return [store.current for store in self.stores.values() if store.current is not None]
+
+    async def close(self):
+        for task in list(self._loading.values()):
+            task.cancel()
+        for store in self.stores.values():
+            await store.close()
+
+
+guild_configs = GuildConfigCache(snapshot_directory=CONFIG_SNAPSHOT_DIRECTORY,
+                                 refresh_interval=CONFIG_REFRESH_SECONDS,
+                                 retry_interval=CONFIG_RETRY_SECONDS)
+
+
+async def get_config(guild_id: int | None) -> GuildConfig | None:
+    """
+    Gets a guild's configuration, loading it the first time the guild is seen. Read it once per handler so every check
+    in the handler uses the same one.
+
+    :param guild_id: The guild the event or interaction came from
+    :return: The configuration, or None if the guild isn't configured
+    """
+    return await guild_configs.get(guild_id)
@@ -1,18 +1,10 @@
 from dotenv import load_dotenv
+from graphql_client import GraphQLClient
+from metrics import graphql_seconds, graphql_failures
+from operations import OperationRegistry
 import os
-import aiohttp
+import socket
 from typing import Any
-import asyncio
-
-
-async def execute_graphql(url, query, variables, headers) -> Any:
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json={'query': query, 'variables': variables}, headers=headers) as response:
-            if response.status == 200:
-                return await response.json()  # Process the JSON response
-            else:
-                return False
-
 
 # Load environment variables
 load_dotenv()
@@ -23,6 +15,10 @@ SEARCH_ENDPOINT_URL = os.getenv('SEARCH_ENDPOINT_URL')
 SEARCH_ENDPOINT_API_KEY_HEADER = os.getenv('SEARCH_ENDPOINT_API_KEY_HEADER')
 SEARCH_ENDPOINT_API_KEY = os.getenv('SEARCH_ENDPOINT_API_KEY')
 
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 256))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL_SECONDS", 300))
+COLLECTION_REFRESH_SECONDS = float(os.getenv("COLLECTION_REFRESH_SECONDS", 300))
+
 GRAPHQL_URL = os.getenv('GRAPHQL_URL')
 GRAPHQL_ADMIN_SECRET = os.getenv('GRAPHQL_ADMIN_SECRET')
 SYNC_ON_STARTUP = int(os.getenv("SYNC_ON_STARTUP", False))
@@ -32,6 +28,116 @@ GRAPHQL_HEADERS = {
     "x-hasura-admin-secret": GRAPHQL_ADMIN_SECRET
 }
 
+GRAPHQL_TIMEOUT_SECONDS = float(os.getenv("GRAPHQL_TIMEOUT_SECONDS", 30))
+GRAPHQL_CONNECT_TIMEOUT_SECONDS = float(os.getenv("GRAPHQL_CONNECT_TIMEOUT_SECONDS", 10))
+GRAPHQL_CONNECTION_LIMIT = int(os.getenv("GRAPHQL_CONNECTION_LIMIT", 100))
+GRAPHQL_CONNECTION_LIMIT_PER_HOST = int(os.getenv("GRAPHQL_CONNECTION_LIMIT_PER_HOST", 20))
+GRAPHQL_KEEPALIVE_SECONDS = float(os.getenv("GRAPHQL_KEEPALIVE_SECONDS", 60))
+GRAPHQL_DNS_CACHE_SECONDS = int(os.getenv("GRAPHQL_DNS_CACHE_SECONDS", 300))
+
+# The shared GraphQL client, created once and closed when the bot shuts down.
+graphql_client = GraphQLClient(total_timeout=GRAPHQL_TIMEOUT_SECONDS,
+                               connect_timeout=GRAPHQL_CONNECT_TIMEOUT_SECONDS,
+                               connection_limit=GRAPHQL_CONNECTION_LIMIT,
+                               connection_limit_per_host=GRAPHQL_CONNECTION_LIMIT_PER_HOST,
+                               keepalive_timeout=GRAPHQL_KEEPALIVE_SECONDS,
+                               dns_cache_ttl=GRAPHQL_DNS_CACHE_SECONDS)
+
+
+# "apq" sends each GraphQL document's sha256 hash instead of its text, Apollo automatic persisted queries style, falling
+# back to the full text when the server doesn't know the hash. "off" sends the full text. Either way the request bodies
+# are encoded once, and only the variables are encoded per request.
+GRAPHQL_PERSISTED_QUERIES = os.getenv("GRAPHQL_PERSISTED_QUERIES", "off")
+graphql_operations = OperationRegistry(persisted=GRAPHQL_PERSISTED_QUERIES == "apq")
+
+
+async def execute_graphql(url, query, variables, headers) -> Any:
+    operation = graphql_operations.get(query).name
+    with graphql_seconds.time(operation):
+        result = await graphql_operations.execute(graphql_client, url, query, variables, headers)
+    if not result or "errors" in result:
+        graphql_failures.inc(operation)
+    return result
+
+
+# "poll" runs the task loop on an adaptive polling schedule. "subscription" wakes the task loop from a Hasura
+# subscription, and only falls back to polling while the websocket is down.
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "poll")
+TASK_LOOP_SECONDS = float(os.getenv("TASK_LOOP_SECONDS", 1))
+# When polls come back empty the wait doubles (TASK_LOOP_BACKOFF) up to TASK_LOOP_MAX_SECONDS.
+TASK_LOOP_MAX_SECONDS = float(os.getenv("TASK_LOOP_MAX_SECONDS", 10))
+TASK_LOOP_BACKOFF = float(os.getenv("TASK_LOOP_BACKOFF", 2))
+# After a question that will be answered arrives, polls don't back off past TASK_LOOP_SECONDS for this long, since the
+# answer can take minutes to be written.
+TASK_LOOP_NUDGE_WINDOW_SECONDS = float(os.getenv("TASK_LOOP_NUDGE_WINDOW_SECONDS", 300))
+# How many answers can be delivered at once. Answers in the same thread are always delivered in order.
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", 5))
+SUBSCRIPTION_SAFETY_POLL_SECONDS = float(os.getenv("SUBSCRIPTION_SAFETY_POLL_SECONDS", 30))
+# Answers are claimed with a lease, so several replicas can deliver them and a crash between claiming and sending
+# doesn't lose the answer: the lease expires after DELIVERY_LEASE_SECONDS and another worker claims it again. An
+# answer is given up on after DELIVERY_MAX_ATTEMPTS claims.
+DELIVERY_WORKER_ID = os.getenv("DELIVERY_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Answers are claimed oldest first in pages of at most DELIVERY_BATCH_SIZE, so a backlog after an outage drains a page
+# at a time instead of being loaded into memory at once.
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", 20))
+DELIVERY_LEASE_SECONDS = float(os.getenv("DELIVERY_LEASE_SECONDS", 120))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", 5))
+# Threads are split into DELIVERY_PARTITIONS partitions by a hash of their id, and this worker prefers the ones in
+# DELIVERY_PARTITION_IDS (e.g. "0,1"; all of them by default). Answers from other partitions are only taken once they
+# have waited DELIVERY_STEAL_AFTER_SECONDS, so a replica that is down doesn't strand its partitions.
+DELIVERY_PARTITIONS = int(os.getenv("DELIVERY_PARTITIONS", 1))
+DELIVERY_PARTITION_IDS = [int(partition) for partition in os.getenv("DELIVERY_PARTITION_IDS", "").split(",")
+                          if partition.strip()] or list(range(DELIVERY_PARTITIONS))
+DELIVERY_STEAL_AFTER_SECONDS = float(os.getenv("DELIVERY_STEAL_AFTER_SECONDS", 30))
+GRAPHQL_WS_URL = os.getenv("GRAPHQL_WS_URL", (GRAPHQL_URL or "").replace("http", "ws", 1))
+
+# Serves Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics. Metrics are not served unless a port is set.
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# The event loop watchdog checks the loop every LOOP_WATCHDOG_INTERVAL_MS milliseconds, and prints the stack of whatever
+# is holding the loop once it has been blocked for LOOP_WATCHDOG_THRESHOLD_MS milliseconds.
+LOOP_WATCHDOG_INTERVAL_MS = int(os.getenv("LOOP_WATCHDOG_INTERVAL_MS", 100))
+LOOP_WATCHDOG_THRESHOLD_MS = int(os.getenv("LOOP_WATCHDOG_THRESHOLD_MS", 250))
+# The longest /profile can sample for.
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 30))
+# /profile samples the whole process, so only these users (comma separated ids) can run it. If none are set, members
+# with the mod role of the primary guild (GUILD_ID) can run it there.
+PROFILE_OPERATOR_IDS = [int(user_id) for user_id in os.getenv("PROFILE_OPERATOR_IDS", "").split(",")
+                        if user_id.strip()]
+
+# Messages that don't mention the bot are spooled and inserted in bulk, every MESSAGE_FLUSH_INTERVAL_MS milliseconds or
+# every MESSAGE_FLUSH_MAX_ROWS spooled writes.
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", 500))
+MESSAGE_FLUSH_MAX_ROWS = int(os.getenv("MESSAGE_FLUSH_MAX_ROWS", 50))
+
+# Writes made while handling gateway events are appended to a local SQLite spool at WRITE_SPOOL_PATH and replayed to
+# Hasura in the background, in order and in batches of up to WRITE_SPOOL_BATCH_SIZE, so the handlers never wait on
+# Hasura. While Hasura is unreachable the replayer backs off up to WRITE_SPOOL_MAX_RETRY_SECONDS. A rejected batch is
+# split to find the rows Hasura rejects, which are moved to the spool's dead_letters table while the rest are written.
+# ":memory:" keeps the spool in memory, so writes that haven't been replayed are lost when the bot stops.
+WRITE_SPOOL_PATH = os.getenv("WRITE_SPOOL_PATH", "write_spool.sqlite3")
+WRITE_SPOOL_BATCH_SIZE = int(os.getenv("WRITE_SPOOL_BATCH_SIZE", 100))
+WRITE_SPOOL_MAX_RETRY_SECONDS = float(os.getenv("WRITE_SPOOL_MAX_RETRY_SECONDS", 60))
+
+# Edits are written once a message hasn't been edited again for EDIT_DEBOUNCE_MS milliseconds, so a burst of edits is
+# one write of the final content. Edits that are due together are written in one mutation, as are all pending edits once
+# EDIT_FLUSH_MAX_ROWS messages have pending edits.
+EDIT_DEBOUNCE_MS = int(os.getenv("EDIT_DEBOUNCE_MS", 2000))
+EDIT_FLUSH_MAX_ROWS = int(os.getenv("EDIT_FLUSH_MAX_ROWS", 50))
+
+# Vote reactions are summed per thread and written together every VOTE_FLUSH_INTERVAL_MS milliseconds, or once
+# VOTE_FLUSH_MAX_EVENTS writes have been spooled.
+VOTE_FLUSH_INTERVAL_MS = int(os.getenv("VOTE_FLUSH_INTERVAL_MS", 2000))
+VOTE_FLUSH_MAX_EVENTS = int(os.getenv("VOTE_FLUSH_MAX_EVENTS", 500))
+
+# The thread index is warmed with the most recent THREAD_INDEX_WARM_UP_THREADS threads, THREAD_INDEX_PAGE_SIZE at a time.
+# Threads it doesn't hold are looked up in Hasura, and a thread that isn't found there isn't looked up again for
+# THREAD_INDEX_MISS_TTL_SECONDS.
+THREAD_INDEX_WARM_UP_THREADS = int(os.getenv("THREAD_INDEX_WARM_UP_THREADS", 10000))
+THREAD_INDEX_PAGE_SIZE = int(os.getenv("THREAD_INDEX_PAGE_SIZE", 1000))
+THREAD_INDEX_MISS_TTL_SECONDS = float(os.getenv("THREAD_INDEX_MISS_TTL_SECONDS", 60))
+
 GET_CONFIG = """query Config($guild_id: bigint = "") {
   configuration_by_pk(guild_id: $guild_id) {
     guild_id
@@ -46,50 +152,73 @@ GET_CONFIG = """query Config($guild_id: bigint = "") {
 }
 """
 
-GUILD_ID = int(os.getenv("GUILD_ID"))
-guild_config = asyncio.run(execute_graphql(url=GRAPHQL_URL,
-                                           headers=GRAPHQL_HEADERS,
-                                           query=GET_CONFIG,
-                                           variables={"guild_id": GUILD_ID},
-                                           ))["data"]["configuration_by_pk"]
+# An optional home guild. Its configuration is loaded at startup, and startup messages are logged to its logging
+# channel. Every other guild's configuration is loaded the first time the bot sees an event from it.
+GUILD_ID = int(os.getenv("GUILD_ID", 0)) or None
+# Commands are registered globally, so every guild the bot serves has them. For development, they can be registered to
+# a single guild instead, where they update instantly.
+COMMAND_GUILD_ID = int(os.getenv("COMMAND_GUILD_ID", 0)) or None
+# An optional directory to keep the last good configuration of each guild in, so a guild's configuration is available
+# without waiting for Hasura.
+CONFIG_SNAPSHOT_DIRECTORY = os.getenv("CONFIG_SNAPSHOT_DIRECTORY")
+# How often to check Hasura for changes to each guild's configuration, e.g. newly banned users.
+CONFIG_REFRESH_SECONDS = float(os.getenv("CONFIG_REFRESH_SECONDS", 60))
+# How long to wait before looking up a guild without a configuration again.
+CONFIG_RETRY_SECONDS = float(os.getenv("CONFIG_RETRY_SECONDS", 60))
+# The number of shards, and which of them this process runs, e.g. "0,1". By default Discord's recommended number of
+# shards is used, and every shard runs in this process.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0)) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or None
+
+# A new thread carries its first message as a nested insert, through the thread's messages relationship, so both are
+# written in one request. Re-inserting a thread that is already stored only rewrites its controller id, so a replayed
+# batch doesn't fail, and its nested messages (which skip conflicts themselves) are still inserted.
+INSERT_THREADS_GRAPHQL = """mutation InsertThreads($objects: [thread_insert_input!]!) {
+  insert_thread(objects: $objects, on_conflict: {constraint: thread_pkey, update_columns: [thread_controller_id]}) {
+    affected_rows
+  }
+}"""
 
-LOGGING_CHANNEL = guild_config['logging_channel_id']
-MOD_ROLE = guild_config['mod_role_id']
-BANNED = guild_config['banned_user_ids']
-CHANNELS = {forum['forum_channel_id']: forum['forum_collection'] for forum in guild_config['guild_forums']}
+# Re-inserting a message that is already stored is a no-op, so a batch can be retried safely.
+INSERT_MESSAGES_GRAPHQL = """mutation InsertMessages($objects: [message_insert_input!]!) {
+  insert_message(objects: $objects, on_conflict: {constraint: message_pkey, update_columns: []}) {
+    affected_rows
+  }
+}"""
 
-INSERT_THREAD_GRAPHQL = """mutation InsertThread($object: thread_insert_input!) {
-  insert_thread_one(object: $object) {
-    thread_id
-    title
-    created_at
-    updated_at
-    open
-    solved
-    collection
-    thread_controller_id
-    author_id
+# Edits overwrite the stored content of messages that are already stored; an edit to any other message changes nothing.
+# Edits are debounced for longer than messages linger and are replayed after them, so a message's insert lands first.
+UPDATE_MESSAGE_EDITS_MANY = """mutation UpdateMessageEditsMany($updates: [message_updates!]!) {
+  update_message_many(updates: $updates) {
+    affected_rows
   }
 }"""
 
-INSERT_MESSAGE_GRAPHQL = """mutation InsertMessage($object: message_insert_input!) {
-  insert_message_one(object: $object) {
-    thread_id
+# Answers are claimed in two steps. First the oldest claimable answers are listed: undelivered, not leased (or with an
+# expired lease), and not out of attempts. Then the ones this worker wants are leased with a conditional update, which
+# re-checks the same conditions row by row, so when two workers race for an answer only one of them gets it.
+# Leased answers are listed too, so a thread whose oldest undelivered answer is leased can be skipped: its later
+# answers wait until it has been delivered.
+CLAIMABLE_MESSAGES_GRAPHQL = """query ClaimableMessages($limit: Int!, $max_attempts: Int!) {
+  message(where: {from_bot: {_eq: true},
+                  processed: {_eq: false},
+                  delivery_attempts: {_lt: $max_attempts}},
+          order_by: {created_at: asc},
+          limit: $limit) {
     message_id
-    content
-    sources
-    from_bot
-    first_message
-    mentions_bot
+    thread_id
     created_at
-    updated_at
-    processed
+    lease_expires_at
   }
-}"""
+}
+"""
 
-# Check out my nifty transaction. 😎
-PROCESS_MESSAGES_GRAPHQL = """mutation ProcessMessages {
-  update_message(where: {from_bot: {_eq: true}, processed: {_eq: false}}, _set: {processed: true}) {
+CLAIM_MESSAGES_GRAPHQL = """mutation ClaimMessages($message_ids: [String!]!, $owner: String!, $now: timestamptz!, $expires_at: timestamptz!) {
+  update_message(where: {message_id: {_in: $message_ids},
+                         processed: {_eq: false},
+                         _or: [{lease_expires_at: {_is_null: true}}, {lease_expires_at: {_lt: $now}}]},
+                 _set: {lease_owner: $owner, lease_expires_at: $expires_at},
+                 _inc: {delivery_attempts: 1}) {
     returning {
       content
       created_at
@@ -101,6 +230,7 @@ PROCESS_MESSAGES_GRAPHQL = """mutation ProcessMessages {
       sources
       thread_id
       updated_at
+      delivery_attempts
       thread {
         thread_controller_id
         author_id
@@ -110,13 +240,37 @@ PROCESS_MESSAGES_GRAPHQL = """mutation ProcessMessages {
 }
 """
 
+# Acknowledges a batch of answers in one request, one update per answer, recording when each was delivered and the ids
+# of the Discord messages it was sent as. Only the worker holding the lease can acknowledge an answer, so a worker whose
+# lease expired and was taken over can't mark the new owner's delivery as done.
+ACK_MESSAGES_GRAPHQL = """mutation AckMessages($updates: [message_updates!]!) {
+  update_message_many(updates: $updates) {
+    affected_rows
+  }
+}
+"""
+
+# Hands back leased answers that weren't attempted, undoing the delivery attempt their claim counted.
+RELEASE_MESSAGES_GRAPHQL = """mutation ReleaseMessages($updates: [message_updates!]!) {
+  update_message_many(updates: $updates) {
+    affected_rows
+  }
+}
+"""
+
 GET_THREAD_BY_CONTROLLER = """query GetThreadByControllerId($thread_controller_id: String = "") {
   thread(where: {thread_controller_id: {_eq: $thread_controller_id}}) {
-    thread_controller_id
     thread_id
+    thread_controller_id
+    author_id
+    title
     open
     solved
-    author_id
+    solved_votes
+    failed_votes
+    collection
+    created_at
+    updated_at
   }
 }
 """
@@ -139,6 +293,24 @@ query ThreadById($thread_id: String = "") {
 }
 """
 
+GET_ALL_THREADS = """
+query GetAllThreads($limit: Int!, $offset: Int!) {
+  thread(order_by: {created_at: desc}, limit: $limit, offset: $offset) {
+    thread_id
+    thread_controller_id
+    author_id
+    title
+    open
+    solved
+    solved_votes
+    failed_votes
+    collection
+    created_at
+    updated_at
+  }
+}
+"""
+
 GET_DOCS_COLLECTION = """
 query GET_COLLECTIONS_ENUM {
   COLLECTION_ENUM {
@@ -147,16 +319,16 @@ query GET_COLLECTIONS_ENUM {
 }
 """
 
-UPDATE_THREAD_VOTES = """mutation UpdateThreadVotes($thread_id: String = "", $failed_votes: Int = 0, $solved_votes: Int = 0) {
-  update_thread_by_pk(pk_columns: {thread_id: $thread_id}, _inc: {failed_votes: $failed_votes, solved_votes: $solved_votes}) {
-    thread_id
+UPDATE_THREAD_VOTES_MANY = """mutation UpdateThreadVotesMany($updates: [thread_updates!]!) {
+  update_thread_many(updates: $updates) {
+    affected_rows
   }
 }
 """
 
-MARK_THREAD_SOLVED = """mutation MarkThreadSolved($thread_id: String = "", $solved: Boolean = false, $open: Boolean = false) {
-  update_thread_by_pk(pk_columns: {thread_id: $thread_id}, _set: {solved: $solved, open: $open}) {
-    thread_id
+MARK_THREADS_SOLVED_MANY = """mutation MarkThreadsSolvedMany($updates: [thread_updates!]!) {
+  update_thread_many(updates: $updates) {
+    affected_rows
   }
 }
 """
@@ -190,6 +362,13 @@ LOADING_MESSAGES = [
     "🤖 Assembling the pieces of the puzzle. 🧩 this might take a couple of minutes... beep boop"
 ]
 
+# Discord's limits for embeds, see https://discord.com/developers/docs/resources/channel#embed-object-embed-limits
+MAX_MESSAGE_EMBEDS = 10
+MAX_MESSAGE_EMBED_CHARACTERS = 6000
+MAX_EMBED_DESCRIPTION = 4096
+# Don't squeeze a sliver of text into the end of a nearly full message, start a new one instead.
+MIN_PACKED_CHUNK = 200
+
 POSITIVE_EMOJI = "✅"
 NEGATIVE_EMOJI = "❌"
 CONTROLLER_TITLE = "Help Bot Thread Information"
@@ -233,6 +412,9 @@ This can be used by a member of the staff to re-open a closed thread.
 
 `/status`
 This shows the status of the thread it is posted in.
+
+`/profile`
+This can be used by a member of the staff to profile the bot for a few seconds and see where its time goes.
 """
 INFO_MESSAGE = """**Self-Improving Bot Disclaimer** 
 These threads will be used to fine-tune the bot periodically! This is an experiment. 👨‍🔬💻🧪
@@ -251,4 +433,10 @@ Please read and verify things with the linked documentation.
 The source code for this bot can be found here: {github}
 
 For a list of available commands the bot can perform, type: ```/commands```"""
+UNKNOWN_COLLECTION_MESSAGE = "`{collection}` is not a searchable collection. Use `/collections` to see which are."
+COLLECTIONS_UNAVAILABLE_MESSAGE = "The collections are temporarily unavailable, try again later."
+NO_COLLECTIONS_MESSAGE = "There are no searchable collections yet."
 UNAVAILABLE_COMMAND = "This command can only be used in a forum thread."
+PROFILE_TITLE = "Profile"
+PROFILE_NO_PERMISSION_MESSAGE = "Only the bot's operators can profile it."
+PROFILE_RUNNING_MESSAGE = "A profile is already running, try again when it has finished."
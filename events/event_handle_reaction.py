@@ -1,5 +1,6 @@
 from utilities import *
 from constants import *
+from write_behind import vote_writer, solved_writer
 import discord
 
 
@@ -19,65 +20,47 @@ async def event_handle_reaction(reaction: discord.RawReactionActionEvent, client
     if not isinstance(channel, discord.Thread):
         return
 
-    if channel.parent_id not in CHANNELS:
+    config = await get_config(reaction.guild_id)
+    if config is None or channel.parent_id not in config.channels:
         return
 
-    result = await execute_graphql(
-        GRAPHQL_URL,
-        GET_THREAD_BY_CONTROLLER,
-        {
-            "thread_controller_id": str(reaction.message_id)
-        },
-        GRAPHQL_HEADERS
-    )
-
-    if not result:
-        return
-
-    threads = result["data"]["thread"]
-
-    if len(threads) == 0:
-        return
-
-    thread = threads[0]
     emoji = str(reaction.emoji)
     if emoji not in [POSITIVE_EMOJI, NEGATIVE_EMOJI]:
         return
 
+    # Reactions on messages in indexed threads that aren't controllers return here without any I/O.
+    thread = await thread_index.get_by_controller(str(reaction.message_id), str(channel.id))
+    if thread is None:
+        return
+
     if thread["author_id"] == str(reaction.user_id):
         if emoji == POSITIVE_EMOJI:
             is_solved = inc > 0
-            await execute_graphql(GRAPHQL_URL,
-                                  MARK_THREAD_SOLVED,
-                                  {
-                                      "thread_id": thread["thread_id"],
-                                      "solved": is_solved
-                                  },
-                                  GRAPHQL_HEADERS
-                                  )
-            controller = await channel.fetch_message(int(thread["thread_controller_id"]))
+            solved_writer.add({"thread_id": thread["thread_id"], "solved": is_solved, "open": False}, urgent=True)
+            thread_index.update(thread["thread_id"], solved=is_solved, open=False)
             help_controller_message = HELP_CONTROLLER_MESSAGE.format(author=thread["author_id"],
                                                                      bot=client.user.id,
                                                                      disclaimer=DISCLAIMER_LINK)
             if is_solved:
-                await controller.edit(embeds=[discord.Embed(title=CONTROLLER_TITLE,
-                                                            description=help_controller_message,
-                                                            color=discord.Color.gold()),
-                                              discord.Embed(title=SOLVED_MESSAGE,
-                                                            color=discord.Color.green()),
-                                              ])
+                await edit_controller(channel, thread["thread_controller_id"],
+                                      [discord.Embed(title=CONTROLLER_TITLE,
+                                                     description=help_controller_message,
+                                                     color=discord.Color.gold()),
+                                       discord.Embed(title=SOLVED_MESSAGE,
+                                                     color=discord.Color.green()),
+                                       ])
             else:
-                await controller.edit(embeds=[discord.Embed(title=CONTROLLER_TITLE,
-                                                            description=help_controller_message,
-                                                            color=discord.Color.gold()),
-                                              discord.Embed(title=UNSOLVED_MESSAGE,
-                                                            color=discord.Color.yellow())
-                                              ])
-    await execute_graphql(GRAPHQL_URL,
-                          UPDATE_THREAD_VOTES,
-                          {
-                              "thread_id": thread["thread_id"],
-                              "failed_votes": inc if emoji == NEGATIVE_EMOJI else 0,
-                              "solved_votes": inc if emoji == POSITIVE_EMOJI else 0
-                          },
-                          GRAPHQL_HEADERS)
+                await edit_controller(channel, thread["thread_controller_id"],
+                                      [discord.Embed(title=CONTROLLER_TITLE,
+                                                     description=help_controller_message,
+                                                     color=discord.Color.gold()),
+                                       discord.Embed(title=UNSOLVED_MESSAGE,
+                                                     color=discord.Color.yellow())
+                                       ])
+    votes = {
+        "failed_votes": inc if emoji == NEGATIVE_EMOJI else 0,
+        "solved_votes": inc if emoji == POSITIVE_EMOJI else 0
+    }
+    # Votes are spooled, then coalesced per thread and written in batches. The index is updated right away.
+    vote_writer.add({"thread_id": thread["thread_id"], **votes})
+    thread_index.increment(thread["thread_id"], **votes)
@@ -1,11 +1,19 @@
 from constants import *
 from utilities import *
+from task_loop.scheduler import poll_scheduler
+from write_behind import message_writer, thread_writer
+from metrics import handler_step_seconds
+import asyncio
 import discord
 
+# Threads whose controller is being sent, so replies that arrive before the thread is indexed aren't dropped.
+creating_threads: set[str] = set()
+
 
 async def event_on_message(client: discord.Client, message: discord.Message):
     """
-    Occurs when a message is sent
+    Occurs when a message is sent. A new thread's controller and the loading message for a mention are sent
+    concurrently, and the thread is spooled with its first message as soon as its controller exists.
     :param client: The discord client. (essentially a singleton instance of the bot)
     :param message: The incoming message
     :return: None
@@ -15,7 +23,9 @@ async def event_on_message(client: discord.Client, message: discord.Message):
         return
 
     # If the message is not in the correct channel, discard it.
-    if message.channel.parent_id not in CHANNELS:
+    with handler_step_seconds.time("on_message", "config"):
+        config = await get_config(message.guild.id)
+    if config is None or message.channel.parent_id not in config.channels:
         return
 
     # If the bot authored the message, discard it.
@@ -26,50 +36,66 @@ async def event_on_message(client: discord.Client, message: discord.Message):
     message_id = str(message.id)
     is_new_thread = thread_id == message_id
     bot_mentioned = client.user in message.mentions
+    row = {
+        "message_id": message_id,
+        "content": message.content,
+        "from_bot": False,
+        "first_message": is_new_thread,
+        "mentions_bot": bot_mentioned,
+        "processed": True
+    }
 
-    # If it is a new thread, insert into HGE.
-    if is_new_thread:
-        thread_message = await send_message_in_embed(message.channel,
-                                                     title=CONTROLLER_TITLE,
-                                                     message=get_random_loading_message(),
-                                                     color=discord.Color.gold())
-        await execute_graphql(GRAPHQL_URL,
-                              INSERT_THREAD_GRAPHQL,
-                              {
-                                  "object": {
-                                      "solved": False,
-                                      "open": True,
-                                      "thread_id": thread_id,
-                                      "title": message.channel.name,
-                                      "collection": CHANNELS[message.channel.parent_id],
-                                      "thread_controller_id": str(thread_message.id),
-                                      "author_id": str(message.author.id)
-                                  }
-                              },
-                              GRAPHQL_HEADERS)
-    else:
-        pass
-    # Insert the message into HGE
-    variables = {
-        "object": {
+    async def create_thread():
+        # The thread row needs the controller's id, its first message is written along with it.
+        creating_threads.add(thread_id)
+        try:
+            with handler_step_seconds.time("on_message", "send_controller"):
+                thread_message = await send_message_in_embed(message.channel,
+                                                             title=CONTROLLER_TITLE,
+                                                             message=get_random_loading_message(),
+                                                             color=discord.Color.gold())
+        finally:
+            creating_threads.discard(thread_id)
+        thread = {
+            "solved": False,
+            "open": True,
             "thread_id": thread_id,
-            "message_id": message_id,
-            "content": message.content,
-            "from_bot": False,
-            "first_message": is_new_thread,
-            "mentions_bot": bot_mentioned,
-            "processed": True
+            "title": message.channel.name,
+            "collection": config.channels[message.channel.parent_id],
+            "thread_controller_id": str(thread_message.id),
+            "author_id": str(message.author.id)
         }
-    }
-    await execute_graphql(GRAPHQL_URL,
-                          INSERT_MESSAGE_GRAPHQL,
-                          variables,
-                          GRAPHQL_HEADERS)
-    if bot_mentioned:
+        with handler_step_seconds.time("on_message", "spool"):
+            thread_writer.add({**thread,
+                               "messages": {"data": [row],
+                                            "on_conflict": {"constraint": "message_pkey", "update_columns": []}}},
+                              urgent=True)
+        thread_index.put(thread)
+        # An answer is on its way, so stop the task loop from idling.
+        poll_scheduler.nudge()
+
+    async def send_loading_message():
         # Send a message to the user so that they know the bot is working on a response.
-        await message.channel.send(
-            embed=discord.Embed(
-                title=get_random_loading_message(),
-                color=discord.Color.gold()
-            )
-        )
+        with handler_step_seconds.time("on_message", "send_loading_message"):
+            await send_embeds(message.channel, [discord.Embed(title=get_random_loading_message(),
+                                                              color=discord.Color.gold())])
+
+    # Only the thread insert waits on Discord, so everything else starts right away and the Discord calls run
+    # concurrently.
+    steps = []
+    if is_new_thread:
+        steps.append(create_thread())
+    elif thread_id not in creating_threads and await thread_index.get(thread_id) is None:
+        # The thread was never stored (e.g. it was opened before the bot joined), so its messages would be rejected.
+        print(f"Skipping message {message_id} in unknown thread {thread_id}")
+        return
+    else:
+        # The answer pipeline is waiting on mentions, so those are written (along with anything spooled before them)
+        # right away.
+        with handler_step_seconds.time("on_message", "spool"):
+            message_writer.add({"thread_id": thread_id, **row}, urgent=bot_mentioned)
+        if bot_mentioned:
+            poll_scheduler.nudge()
+    if bot_mentioned:
+        steps.append(send_loading_message())
+    await asyncio.gather(*steps)
@@ -0,0 +1,41 @@
+from constants import *
+from utilities import *
+from write_behind import edit_writer
+import discord
+
+
+async def event_on_raw_message_edit(client: discord.Client, payload: discord.RawMessageUpdateEvent):
+    """
+    Occurs when a message is edited, whether or not it is in the message cache. The new content is buffered and
+    written once the message stops being edited.
+    :param client: The discord client. (essentially a singleton instance of the bot)
+    :param payload: The raw edit event
+    :return: None
+    """
+    data = payload.data
+    # Discord also sends updates when it adds link previews, those have no edited_timestamp.
+    if "content" not in data or data.get("edited_timestamp") is None:
+        return
+
+    # If the bot authored the message, discard it.
+    if int(data.get("author", {}).get("id", 0)) == client.user.id:
+        return
+
+    # If the content didn't change (e.g. only an attachment was removed), discard it.
+    if payload.cached_message is not None and payload.cached_message.content == data["content"]:
+        return
+
+    # If the message is not in a thread in the correct channel, discard it.
+    channel = client.get_channel(payload.channel_id)
+    if not isinstance(channel, discord.Thread) or payload.guild_id is None:
+        return
+    config = await get_config(payload.guild_id)
+    if config is None or channel.parent_id not in config.channels:
+        return
+
+    # If the thread was never stored, neither were its messages, so discard it.
+    if await thread_index.get(str(channel.id)) is None:
+        return
+
+    # Only stored messages are updated, an edit to a message that was never stored changes nothing.
+    edit_writer.add({"message_id": str(payload.message_id), "content": data["content"]})
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import time
+from typing import Any
+
+import aiohttp
+
+
+class GraphQLClient:
+    """
+    A long-lived GraphQL client that shares a single pooled aiohttp session across every request.
+
+    Creating a new ClientSession per request means a fresh TCP+TLS handshake to Hasura each time. This client keeps
+    connections alive between calls and caches DNS lookups, so the 1-second task loop and the gateway event handlers
+    reuse warm connections.
+
+    The session is opened lazily on first use inside the running event loop, and must be closed with close() when the
+    bot shuts down. After close() the next request will open a new session.
+    """
+
+    def __init__(self,
+                 total_timeout: float = 30,
+                 connect_timeout: float = 10,
+                 connection_limit: int = 100,
+                 connection_limit_per_host: int = 20,
+                 keepalive_timeout: float = 60,
+                 dns_cache_ttl: int = 300):
+        """
+        :param total_timeout: The maximum number of seconds a request can take, including connecting.
+        :param connect_timeout: The maximum number of seconds to wait for a pooled or new connection.
+        :param connection_limit: The maximum number of open connections in the pool.
+        :param connection_limit_per_host: The maximum number of open connections to a single host.
+        :param keepalive_timeout: How many seconds an idle connection is kept open for re-use.
+        :param dns_cache_ttl: How many seconds resolved DNS entries are cached.
+        """
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session: aiohttp.ClientSession | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def session(self) -> aiohttp.ClientSession | None:
+        return self._session
+
+    async def open(self) -> aiohttp.ClientSession:
+        """
+        Opens the shared session if it isn't already open.
+
+        :return: The shared session
+        """
+        if self._session is not None and not self._session.closed:
+            return self._session
+        async with self._lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                                 limit_per_host=self.connection_limit_per_host,
+                                                 keepalive_timeout=self.keepalive_timeout,
+                                                 ttl_dns_cache=self.dns_cache_ttl,
+                                                 use_dns_cache=True)
+                self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        """
+        Closes the shared session and all pooled connections.
+        """
+        async with self._lock:
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+            self._session = None
+
+    async def post(self, url: str, body: bytes, headers: dict) -> tuple[Any, float | None]:
+        """
+        Posts an encoded GraphQL request over the shared session.
+
+        :param url: The GraphQL endpoint
+        :param body: The JSON encoded request
+        :param headers: The headers to send, e.g. the admin secret
+        :return: The JSON response, or False if the request failed, and the seconds until the response headers arrived
+        """
+        session = await self.open()
+        started = time.perf_counter()
+        try:
+            async with session.post(url, data=body, headers=headers) as response:
+                response_seconds = time.perf_counter() - started
+                if response.status == 200:
+                    return await response.json(), response_seconds  # Process the JSON response
+                else:
+                    return False, response_seconds
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"GraphQL request failed: {e!r}")
+            return False, None
+
+    async def execute(self, url: str, query: str, variables: dict, headers: dict) -> Any:
+        """
+        Executes a GraphQL document over the shared session.
+
+        :param url: The GraphQL endpoint
+        :param query: The GraphQL document
+        :param variables: The variables for the document
+        :param headers: The headers to send, e.g. the admin secret
+        :return: The JSON response, or False if the request failed
+        """
+        result, _ = await self.post(url, json.dumps({'query': query, 'variables': variables}).encode(), headers)
+        return result
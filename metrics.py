@@ -0,0 +1,272 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+import aiohttp
+from aiohttp import web
+
+# Seconds. Covers a fast in-memory handler up to a slow GraphQL mutation or a rate limited Discord send.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Seconds. A local write, from a few microseconds up to a slow disk.
+APPEND_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1)
+# Seconds. How long an answer waited to be delivered, which is at least a poll interval when polling.
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    A gauge that is read when the metrics are scraped, so keeping it up to date costs nothing. A gauge with labels reads
+    a value per tuple of label values.
+    """
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float | dict[tuple, float]],
+                 labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        self.label_names = labels
+
+    def render(self) -> list[str]:
+        try:
+            value = self.read()
+        except Exception as e:
+            print(f"Failed to read the {self.name} gauge: {e!r}")
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        if not self.label_names:
+            return lines + [f"{self.name} {value}"]
+        for labels, labelled_value in value.items():
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {labelled_value}")
+        return lines
+
+
+class Histogram:
+    """
+    A histogram with fixed buckets. Observing a value is a binary search and two additions, and the cumulative counts
+    Prometheus expects are only computed when the metrics are scraped.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self.buckets = buckets
+        # Per label values: a count per bucket (the last one is +Inf), and the sum of observed values.
+        self.values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """
+        Observes how long the block took, in seconds, including when it raises.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}")
+            cumulative += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total[0]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds every metric and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"The metric {metric.name} is already registered.")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float | dict[tuple, float]],
+              labels: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, read, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP at /metrics.
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int):
+        """
+        :param registry: The metrics to serve
+        :param host: The interface to listen on
+        :param port: The port to listen on
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"Cache-Control": "no-store"})
+
+    async def start(self):
+        if self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = MetricsRegistry()
+
+graphql_seconds = metrics.histogram("hasura_graphql_seconds",
+                                    "GraphQL requests to Hasura by operation name.",
+                                    ("operation",))
+graphql_failures = metrics.counter("hasura_graphql_failures_total",
+                                   "GraphQL requests that failed or returned errors, by operation name.",
+                                   ("operation",))
+graphql_request_bytes = metrics.counter("hasura_graphql_request_bytes_total",
+                                        "Bytes of GraphQL request bodies sent to Hasura, by operation name and whether "
+                                        "the full document or only its persisted query hash was sent.",
+                                        ("operation", "sent"))
+graphql_response_seconds = metrics.histogram("hasura_graphql_response_seconds",
+                                             "Time from sending a GraphQL request to Hasura to its response headers "
+                                             "arriving, which includes parsing and validating the document, by "
+                                             "operation name and what was sent.",
+                                             ("operation", "sent"))
+persisted_query_registrations = metrics.counter("hasura_persisted_query_registrations_total",
+                                                "Full documents sent because Hasura didn't know their persisted query "
+                                                "hash yet, by operation name.",
+                                                ("operation",))
+command_seconds = metrics.histogram("discord_command_seconds",
+                                    "Slash command and autocomplete handling by command.",
+                                    ("command", "type"))
+handler_seconds = metrics.histogram("discord_event_handler_seconds",
+                                    "Gateway event handling by event.",
+                                    ("event",))
+handler_step_seconds = metrics.histogram("discord_event_handler_step_seconds",
+                                         "Steps of gateway event handlers by event and step. Steps of one event can "
+                                         "run concurrently.",
+                                         ("event", "step"))
+task_loop_seconds = metrics.histogram("task_loop_iteration_seconds",
+                                      "Task loop iterations: claiming answers and delivering them.")
+task_loop_lag_seconds = metrics.histogram("task_loop_lag_seconds",
+                                          "How long each answer waited between being written and being claimed.",
+                                          buckets=LAG_BUCKETS)
+answers = metrics.counter("answers_total",
+                          "Claimed answers by outcome (delivered, failed and retried later, or dropped).",
+                          ("outcome",))
+spool_append_seconds = metrics.histogram("write_spool_append_seconds",
+                                         "Appending a write to the local spool on the gateway event path.",
+                                         buckets=APPEND_BUCKETS)
+spool_replayed = metrics.counter("write_spool_replayed_total",
+                                 "Spooled writes replayed to Hasura, by kind.",
+                                 ("kind",))
+spool_dead_letters = metrics.counter("write_spool_dead_letters_total",
+                                     "Spooled writes Hasura kept rejecting, moved to the dead letter table, by kind.",
+                                     ("kind",))
+loop_lag_seconds = metrics.histogram("event_loop_lag_seconds",
+                                     "How late the event loop ran the watchdog's heartbeat.")
+loop_stalls = metrics.counter("event_loop_stalls_total",
+                              "Times the event loop was blocked for longer than the watchdog threshold.")
+discord_request_seconds = metrics.histogram("discord_request_seconds",
+                                            "Discord REST requests by method, including retries.",
+                                            ("method",))
+discord_responses = metrics.counter("discord_responses_total",
+                                    "Discord REST responses by method and status.",
+                                    ("method", "status"))
+discord_rate_limited = metrics.counter("discord_rate_limited_total",
+                                       "Discord 429 responses by rate limit scope.",
+                                       ("scope",))
+
+
+def discord_trace_config() -> aiohttp.TraceConfig:
+    """
+    Builds an aiohttp trace config that times every Discord REST request and counts the responses by status, including
+    the 429s discord.py retries internally. Pass it to discord.Client as http_trace.
+
+    :return: The trace config
+    """
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params: aiohttp.TraceRequestStartParams):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+        discord_request_seconds.observe(time.perf_counter() - context.started, params.method)
+        discord_responses.inc(params.method, params.response.status)
+        if params.response.status == 429:
+            discord_rate_limited.inc(params.response.headers.get("X-RateLimit-Scope", "unknown"))
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
@@ -0,0 +1,189 @@
+"""
+The registry of GraphQL documents the bot sends to Hasura.
+
+Run it to print the Hasura metadata API requests that put every document in a query collection and add the collection
+to the allow-list:
+    python -m operations > allow_list.json
+"""
+import hashlib
+import json
+import re
+from typing import Any
+
+from graphql_client import GraphQLClient
+from metrics import graphql_request_bytes, graphql_response_seconds, persisted_query_registrations
+
+OPERATION_NAME_PATTERN = re.compile(r'^\s*(?:query|mutation|subscription)\s+(\w+)')
+# The errors an APQ server answers with when it hasn't seen a hash yet, or doesn't do persisted queries at all.
+PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+PERSISTED_QUERY_NOT_SUPPORTED = "PersistedQueryNotSupported"
+
+
+def _encode(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+class Operation:
+    """
+    A GraphQL document with its request bodies encoded up front, so each request only serializes its variables.
+    """
+
+    def __init__(self, query: str):
+        """
+        :param query: The GraphQL document
+        """
+        match = OPERATION_NAME_PATTERN.match(query)
+        self.query = query
+        self.name = match.group(1) if match else "anonymous"
+        self.sha256 = hashlib.sha256(query.encode()).hexdigest()
+        head = {"operationName": self.name} if match else {}
+        persisted_query = {"persistedQuery": {"version": 1, "sha256Hash": self.sha256}}
+        # Each prefix is an encoded JSON object with its closing brace cut off, ready for ',"variables":{...}}'.
+        self.full_prefix = _encode({**head, "query": query})[:-1]
+        self.hash_prefix = _encode({**head, "extensions": persisted_query})[:-1]
+        self.register_prefix = _encode({**head, "query": query, "extensions": persisted_query})[:-1]
+        # Whether the server has confirmed it knows the hash.
+        self.persisted = False
+        self.requests = 0
+        self.bytes = 0
+
+    def body(self, prefix: bytes, variables: dict | None) -> bytes:
+        return prefix + b',"variables":' + _encode(variables or {}) + b"}"
+
+
+def _error_messages(result: Any) -> list[str]:
+    if not isinstance(result, dict):
+        return []
+    return [error.get("message", "") for error in result.get("errors") or [] if isinstance(error, dict)]
+
+
+def _unsupported(result: Any) -> bool:
+    """
+    Whether the server rejected a persisted query request. Servers without APQ support either say so, or (like Hasura,
+    which ignores the extension) reject a request without a document as malformed.
+    """
+    if PERSISTED_QUERY_NOT_SUPPORTED in _error_messages(result):
+        return True
+    return isinstance(result, dict) and any(isinstance(error, dict)
+                                            and (error.get("extensions") or {}).get("code") == "parse-failed"
+                                            for error in result.get("errors") or [])
+
+
+class OperationRegistry:
+    """
+    Gives each GraphQL document a stable sha256 hash the first time it is sent, and sends it as a pre-encoded body.
+
+    With persisted queries on, requests send only the hash, Apollo APQ style. If the server doesn't know the hash yet,
+    the request is retried with the full document and the hash, which registers it, and later requests are small again.
+    If the server doesn't support persisted queries at all, they are turned off and every request sends the full
+    document, as it does with persisted queries off.
+    """
+
+    def __init__(self, persisted: bool = False):
+        """
+        :param persisted: Whether to send hashes instead of full documents
+        """
+        self.persisted = persisted
+        self.operations: dict[str, Operation] = {}
+
+    def get(self, query: str) -> Operation:
+        operation = self.operations.get(query)
+        if operation is None:
+            operation = self.operations[query] = Operation(query)
+        return operation
+
+    async def _post(self, client: GraphQLClient, url: str, operation: Operation, prefix: bytes, variables: dict,
+                    headers: dict, sent: str) -> Any:
+        body = operation.body(prefix, variables)
+        operation.requests += 1
+        operation.bytes += len(body)
+        graphql_request_bytes.inc(operation.name, sent, amount=len(body))
+        result, response_seconds = await client.post(url, body, headers)
+        if response_seconds is not None:
+            graphql_response_seconds.observe(response_seconds, operation.name, sent)
+        return result
+
+    async def execute(self, client: GraphQLClient, url: str, query: str, variables: dict, headers: dict) -> Any:
+        """
+        Executes a GraphQL document.
+
+        :param client: The client to send the request with
+        :param url: The GraphQL endpoint
+        :param query: The GraphQL document
+        :param variables: The variables for the document
+        :param headers: The headers to send, e.g. the admin secret
+        :return: The JSON response, or False if the request failed
+        """
+        operation = self.get(query)
+        if not self.persisted:
+            return await self._post(client, url, operation, operation.full_prefix, variables, headers, "document")
+        if operation.persisted:
+            result = await self._post(client, url, operation, operation.hash_prefix, variables, headers, "hash")
+            if _unsupported(result):
+                return await self._unsupported(client, url, operation, variables, headers)
+            if PERSISTED_QUERY_NOT_FOUND not in _error_messages(result):
+                return result
+            # The server forgot the hash, e.g. it restarted.
+            operation.persisted = False
+        persisted_query_registrations.inc(operation.name)
+        result = await self._post(client, url, operation, operation.register_prefix, variables, headers, "document")
+        if _unsupported(result):
+            return await self._unsupported(client, url, operation, variables, headers)
+        if result and "errors" not in result:
+            operation.persisted = True
+        return result
+
+    async def _unsupported(self, client: GraphQLClient, url: str, operation: Operation, variables: dict,
+                           headers: dict) -> Any:
+        print("The GraphQL server doesn't support persisted queries, sending full documents instead.")
+        self.persisted = False
+        return await self._post(client, url, operation, operation.full_prefix, variables, headers, "document")
+
+    def stats(self) -> dict:
+        return {
+            operation.name: {
+                "sha256": operation.sha256,
+                "persisted": operation.persisted,
+                "requests": operation.requests,
+                "bytes_per_request": operation.bytes / operation.requests if operation.requests else 0,
+            }
+            for operation in self.operations.values()
+        }
+
+
+def allow_list_metadata(queries: list[str], collection: str = "discord_bot") -> dict:
+    """
+    Builds a Hasura metadata API bulk request that puts every document in a query collection and adds the collection to
+    the allow-list. Hasura then only runs these documents for non-admin roles, and checks requests against them.
+
+    :param queries: The GraphQL documents
+    :param collection: The name of the query collection
+    :return: The request body for the /v1/metadata endpoint
+    """
+    operations = {}
+    for query in queries:
+        operation = Operation(query)
+        operations[operation.name] = operation
+    return {
+        "type": "bulk",
+        "args": [
+            {
+                "type": "create_query_collection",
+                "args": {
+                    "name": collection,
+                    "definition": {"queries": [{"name": name, "query": operation.query}
+                                               for name, operation in sorted(operations.items())]}
+                }
+            },
+            {"type": "add_collection_to_allowlist", "args": {"collection": collection}}
+        ]
+    }
+
+
+if __name__ == "__main__":
+    import constants
+    from task_loop.subscription import PENDING_BOT_MESSAGES_SUBSCRIPTION
+
+    documents = [value for name, value in vars(constants).items()
+                 if name.isupper() and isinstance(value, str) and OPERATION_NAME_PATTERN.match(value)]
+    print(json.dumps(allow_list_metadata(documents + [PENDING_BOT_MESSAGES_SUBSCRIPTION]), indent=2))
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from constants import *
+from metrics import loop_lag_seconds, loop_stalls
+
+# Every stack on the loop thread starts in asyncio's own run loop, so those frames are left out of total time.
+ASYNCIO_DIRECTORY = os.path.dirname(asyncio.__file__)
+
+
+class LoopWatchdog:
+    """
+    Measures how late the event loop runs a callback scheduled every interval seconds. Everything the bot does shares
+    one loop, so any lag here delays every handler.
+
+    A background thread watches the loop's heartbeat. When the loop hasn't ticked for threshold seconds, something is
+    holding it (blocking I/O, or a long CPU-bound step), and the thread prints the loop thread's stack while it is
+    still stuck, so the culprit shows up in the logs. Each stall is reported once.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25):
+        """
+        :param interval: Seconds between heartbeats
+        :param threshold: Seconds without a heartbeat before the loop is considered blocked
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self._last_tick = time.monotonic()
+        self._reported_tick: float | None = None
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._thread: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._tick(), name="loop-watchdog")
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._last_tick = now
+            self.last_lag = max(0.0, now - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            loop_lag_seconds.observe(self.last_lag)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            last_tick = self._last_tick
+            blocked = time.monotonic() - last_tick
+            if blocked < self.threshold or self._reported_tick == last_tick:
+                continue
+            self._reported_tick = last_tick
+            self.stalls += 1
+            loop_stalls.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack)\n"
+            print(f"The event loop has been blocked for {blocked * 1000:.0f}ms, it is running:\n{stack}", end="")
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "stalls": self.stalls,
+        }
+
+
+class SamplingProfiler:
+    """
+    Profiles the live process by sampling the event loop thread's stack every interval seconds from another thread.
+
+    Sampling adds no overhead to the code being profiled, so it is safe to run in production. Only one profile runs
+    at a time.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """
+        :param interval: Seconds between samples
+        """
+        self.interval = interval
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _location(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self, thread_id: int, seconds: float) -> tuple[int, int, Counter, Counter]:
+        own = Counter()
+        total = Counter()
+        samples = 0
+        idle = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                samples += 1
+                # The loop waits for I/O in the selector when it has nothing to run.
+                if os.path.basename(frame.f_code.co_filename) == "selectors.py":
+                    idle += 1
+                own[self._location(frame)] += 1
+                # A recursive function is only counted once per sample.
+                seen = set()
+                while frame is not None:
+                    location = self._location(frame)
+                    if location not in seen and not frame.f_code.co_filename.startswith(ASYNCIO_DIRECTORY):
+                        seen.add(location)
+                        total[location] += 1
+                    frame = frame.f_back
+            time.sleep(self.interval)
+        return samples, idle, own, total
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def profile(self, seconds: float, top: int = 15) -> str:
+        """
+        Samples the event loop thread for a number of seconds.
+
+        :param seconds: How long to sample for
+        :param top: How many functions to list
+        :return: A report of the functions with the most samples, by own time and by total time
+        """
+        async with self._lock:
+            samples, idle, own, total = await asyncio.to_thread(self._sample, threading.get_ident(), seconds)
+        if not samples:
+            return "No samples were taken."
+        lines = [f"{samples} samples over {seconds:g}s, the loop was idle for {idle / samples:.1%}", "",
+                 "Own time (the function itself was running):"]
+        lines += [f"{count / samples:6.1%} {location}" for location, count in own.most_common(top)]
+        lines += ["", "Total time (the function or something it called was running):"]
+        lines += [f"{count / samples:6.1%} {location}" for location, count in total.most_common(top)]
+        return "\n".join(lines)
+
+
+loop_watchdog = LoopWatchdog(interval=LOOP_WATCHDOG_INTERVAL_MS / 1000,
+                             threshold=LOOP_WATCHDOG_THRESHOLD_MS / 1000)
+sampling_profiler = SamplingProfiler()
@@ -0,0 +1,209 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+import aiohttp
+import discord
+
+# Lower numbers are sent first.
+INTERACTION = 0
+ANSWER = 1
+
+
+class _PriorityGate:
+    """
+    A semaphore that lets the highest priority waiter in first.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self.slots > 0 and not self._waiters:
+            self.slots -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed to us as we were cancelled, pass it on.
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.slots += 1
+
+
+class _Bucket:
+    def __init__(self, key: str):
+        self.key = key
+        self.queue: list[tuple[int, int, float, int, Callable[[], Awaitable[Any]], asyncio.Future]] = []
+        self.blocked_until = 0.0
+        self.discord_bucket: str | None = None
+        self.worker: asyncio.Task | None = None
+
+
+# The bucket whose send is in flight. discord.py makes the REST request in the same task, so the trace sees it.
+_sending_bucket: ContextVar[_Bucket | None] = ContextVar("sending_bucket", default=None)
+
+
+class SendScheduler:
+    """
+    Queues every outbound Discord send by rate limit bucket, instead of letting each coroutine retry 429s on its own.
+
+    Sends to the same bucket (e.g. the same channel) go out one at a time in priority order, so concurrent senders don't
+    stampede a bucket. Interaction follow-ups are sent before background answer deliveries when both are waiting.
+
+    discord.py retries 429s itself and never hands them back, so the scheduler reads the rate limit headers of every
+    response through on_request_end, an aiohttp trace hook. When a bucket has no requests remaining, or Discord answers
+    with a 429, the bucket (or every bucket, for a global limit) is paused until the headers say it resets, and its
+    queued sends wait without holding one of the max_in_flight slots.
+
+    Buckets are keyed by the resource a send goes to (a channel or an interaction), which is what Discord scopes its
+    limits to, not by the X-RateLimit-Bucket hash: sends are opaque callables, so the route one will take isn't known
+    until it has been made. A channel is therefore paused as a whole when any one of its routes runs out, which is
+    stricter than Discord, never looser. The hash is kept on the bucket for logging.
+    """
+
+    def __init__(self, max_in_flight: int = 10, max_retries: int = 5):
+        """
+        :param max_in_flight: The maximum number of sends in flight across all buckets
+        :param max_retries: How many times a rate limited send is retried before giving up
+        """
+        self.max_retries = max_retries
+        self.buckets: dict[str, _Bucket] = {}
+        self.global_blocked_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.waits: deque[float] = deque(maxlen=1000)
+        self._gate = _PriorityGate(max_in_flight)
+        self._seq = itertools.count()
+
+    async def submit(self, bucket_key: str, send: Callable[[], Awaitable[Any]], priority: int = ANSWER) -> Any:
+        """
+        Queues a send and waits for it to complete.
+
+        :param bucket_key: The rate limit bucket the send belongs to, e.g. "channel:<id>"
+        :param send: Performs the send. It may be called more than once if it is rate limited.
+        :param priority: INTERACTION or ANSWER
+        :return: The result of send
+        """
+        bucket = self.buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self.buckets[bucket_key] = _Bucket(bucket_key)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(bucket.queue, (priority, next(self._seq), time.monotonic(), 0, send, future))
+        if bucket.worker is None or bucket.worker.done():
+            bucket.worker = asyncio.create_task(self._drain(bucket), name=f"send-{bucket_key}")
+        return await future
+
+    async def _drain(self, bucket: _Bucket):
+        while bucket.queue or bucket.blocked_until > time.monotonic():
+            if not bucket.queue:
+                # Keep an idle bucket, and what it knows about its rate limit, until the limit resets.
+                await asyncio.sleep(bucket.blocked_until - time.monotonic())
+                continue
+            priority, seq, queued_at, attempt, send, future = heapq.heappop(bucket.queue)
+            if future.done():
+                continue
+            delay = max(bucket.blocked_until, self.global_blocked_until) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._gate.acquire(priority)
+            sending = _sending_bucket.set(bucket)
+            try:
+                if attempt == 0:
+                    self.waits.append(time.monotonic() - queued_at)
+                result = await send()
+            except (discord.HTTPException, discord.RateLimited) as e:
+                # discord.py only gives up on a 429 after its own retries, or when the wait is longer than
+                # max_ratelimit_timeout.
+                if getattr(e, "status", 429) == 429 and attempt < self.max_retries:
+                    self._pause(bucket, getattr(e, "retry_after", None) or 1.0, False)
+                    # Put it back with the same sequence number so it keeps its place in the bucket.
+                    heapq.heappush(bucket.queue, (priority, seq, queued_at, attempt + 1, send, future))
+                else:
+                    self.failed += 1
+                    self._resolve(future, exception=e)
+            except Exception as e:
+                self.failed += 1
+                self._resolve(future, exception=e)
+            else:
+                self.sent += 1
+                self._resolve(future, result=result)
+            finally:
+                _sending_bucket.reset(sending)
+                self._gate.release()
+        # Buckets are created per channel, so drop idle ones.
+        if self.buckets.get(bucket.key) is bucket and not bucket.queue:
+            del self.buckets[bucket.key]
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any = None, exception: BaseException | None = None):
+        # The caller may have given up waiting while the send was in flight.
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    async def on_request_end(self, session: aiohttp.ClientSession, context, params: aiohttp.TraceRequestEndParams):
+        """
+        Learns the state of a send's rate limit bucket from the headers of its response. Append it to the on_request_end
+        hooks of the trace config passed to discord.Client as http_trace.
+        """
+        bucket = _sending_bucket.get()
+        headers = params.response.headers
+        if bucket is None or "X-RateLimit-Bucket" not in headers and params.response.status != 429:
+            return
+        bucket.discord_bucket = headers.get("X-RateLimit-Bucket", bucket.discord_bucket)
+        reset_after = headers.get("X-RateLimit-Reset-After") or headers.get("Retry-After")
+        if params.response.status == 429:
+            self.rate_limited += 1
+            retry_after = float(reset_after) if reset_after is not None else 1.0
+            is_global = headers.get("X-RateLimit-Global", "").lower() == "true"
+            self._pause(bucket, retry_after, is_global)
+            print(f"Rate limited on {bucket.key} (bucket {bucket.discord_bucket}), retrying in {retry_after} "
+                  f"seconds...")
+        elif headers.get("X-RateLimit-Remaining") == "0" and reset_after is not None:
+            self._pause(bucket, float(reset_after), False)
+
+    def _pause(self, bucket: _Bucket, seconds: float, is_global: bool):
+        until = time.monotonic() + seconds
+        if is_global:
+            self.global_blocked_until = max(self.global_blocked_until, until)
+        else:
+            bucket.blocked_until = max(bucket.blocked_until, until)
+
+    def queue_depth(self) -> int:
+        return sum(len(bucket.queue) for bucket in self.buckets.values())
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return {
+            "queue_depth": self.queue_depth(),
+            "buckets": len(self.buckets),
+            "sent": self.sent,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "wait_p50": waits[len(waits) // 2] if waits else 0,
+            "wait_max": waits[-1] if waits else 0,
+        }
+
+
+send_scheduler = SendScheduler()
@@ -0,0 +1,308 @@
+import asyncio
+import json
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable
+
+from metrics import spool_append_seconds, spool_replayed, spool_dead_letters
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    error TEXT NOT NULL
+);
+"""
+
+
+class WriteSpool:
+    """
+    A local, append-only SQLite log of writes to Hasura, so the gateway event handlers never wait on Hasura.
+
+    Appending a row is a single local insert in WAL mode, which takes microseconds. A background replayer drains the log
+    to Hasura, oldest first: it reads up to batch_size rows, writes each kind of row that is due in one batch with that
+    kind's writer, and deletes the rows once the write succeeds. A kind is due once its oldest row has waited its linger
+    (so e.g. votes can be folded together), once max_rows of it are waiting, or as soon as an urgent row of it is
+    appended. Rows survive a restart and are replayed on the next start.
+
+    Rows of a kind are written in the order they were appended. Kinds are written in the order their writers were
+    registered, and when a kind is due so is every kind registered before it, so register a kind (e.g. threads) before
+    the kinds that depend on it (e.g. messages).
+
+    When Hasura is unreachable the replayer backs off, from retry_interval up to max_retry_interval, and the rows wait
+    in the log. When Hasura answers a batch with errors, e.g. a constraint violation, retrying won't help: the batch is
+    split in half until the rows it rejects are found, those are moved to the dead_letters table right away, and the
+    rest are written without backing off, so one bad row can't hold up, or take down, everything around it.
+
+    Replays are at least once: a batch that was written just before the bot stopped, but not yet deleted, is written
+    again. Writers should be idempotent where they can be.
+    """
+
+    def __init__(self,
+                 path: str,
+                 batch_size: int = 100,
+                 retry_interval: float = 1,
+                 max_retry_interval: float = 60):
+        """
+        :param path: The SQLite database file, or ":memory:" to keep the log in memory only
+        :param batch_size: The most rows read from the log at once
+        :param retry_interval: The wait before the first retry when Hasura is unreachable, in seconds
+        :param max_retry_interval: The ceiling the retry wait backs off to, in seconds
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        # Per kind: writes a batch of rows, returning the GraphQL result (False when Hasura couldn't be reached).
+        self.writers: dict[str, Callable[[list[dict]], Awaitable[Any]]] = {}
+        self.lingers: dict[str, float] = {}
+        self.max_rows: dict[str, int] = {}
+        self.pending: dict[str, int] = {}
+        self.depth = 0
+        self.replayed = 0
+        self.dead_lettered = 0
+        self.failures = 0
+        self._db: sqlite3.Connection | None = None
+        self._urgent: set[str] = set()
+        self._retry_wait = retry_interval
+        self._resume_at = 0.0
+        self._timer: asyncio.Task | None = None
+        self._timer_due = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # A commit doesn't wait for an fsync. The log can lose its last writes if the machine loses power, but not
+            # if the bot crashes.
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+            self.pending = dict(self._db.execute("SELECT kind, count(*) FROM spool GROUP BY kind").fetchall())
+            self.depth = sum(self.pending.values())
+        return self._db
+
+    def register(self, kind: str, write: Callable[[list[dict]], Awaitable[Any]], linger: float = 0,
+                 max_rows: int = 50):
+        """
+        :param kind: The kind of row the writer writes
+        :param write: Writes a batch of rows, returning the GraphQL result
+        :param linger: How long rows of this kind wait to be batched together, in seconds
+        :param max_rows: The number of waiting rows of this kind that makes it due right away
+        """
+        self.writers[kind] = write
+        self.lingers[kind] = linger
+        self.max_rows[kind] = max_rows
+
+    def append(self, kind: str, row: dict, urgent: bool = False):
+        """
+        Appends a row to the log, and schedules a replay for when it is due.
+
+        :param kind: The kind of row, which picks the writer that replays it
+        :param row: The row to write
+        :param urgent: Whether something is waiting on the row, so it (and everything before it) is written right away
+        """
+        with spool_append_seconds.time():
+            self.db.execute("INSERT INTO spool (created_at, kind, payload) VALUES (?, ?, ?)",
+                            (time.time(), kind, json.dumps(row)))
+        self.depth += 1
+        self.pending[kind] = self.pending.get(kind, 0) + 1
+        if urgent:
+            self._urgent.add(kind)
+        if urgent or self.pending[kind] >= self.max_rows.get(kind, 0):
+            self.schedule(0)
+        else:
+            self.schedule(self.lingers.get(kind, 0))
+
+    def lag(self) -> float:
+        """
+        :return: How long the oldest row in the log has been waiting, in seconds
+        """
+        oldest = self.db.execute("SELECT created_at FROM spool ORDER BY id LIMIT 1").fetchone()
+        return time.time() - oldest[0] if oldest else 0.0
+
+    def start(self):
+        """
+        Replays anything left in the log from a previous run.
+        """
+        # Opening the log counts what is left in it.
+        if self.db and self.depth:
+            print(f"Replaying {self.depth} writes left in {self.path}.")
+            self._urgent.update(self.pending)
+            self.schedule(0)
+
+    def schedule(self, delay: float):
+        """
+        Replays the log after delay seconds, unless a replay is already due sooner.
+
+        :param delay: The number of seconds to wait
+        """
+        now = asyncio.get_running_loop().time()
+        # While backing off from a failed replay, new rows wait for the retry instead of hammering Hasura.
+        due = max(now + delay, self._resume_at)
+        if self._timer is not None and not self._timer.done():
+            if self._timer_due <= due:
+                return
+            self._timer.cancel()
+        self._timer_due = due
+        self._timer = asyncio.create_task(self._replay_after(due - now))
+
+    async def _replay_after(self, delay: float):
+        await asyncio.sleep(delay)
+        self._timer = None
+        if await self.replay():
+            self._resume_at = 0.0
+            self._retry_wait = self.retry_interval
+            # Rows that weren't due yet are replayed when they are.
+            now = time.time()
+            for kind, oldest in self.db.execute("SELECT kind, min(created_at) FROM spool GROUP BY kind").fetchall():
+                self.schedule(max(0.0, oldest + self.lingers.get(kind, 0) - now))
+        else:
+            self._resume_at = asyncio.get_running_loop().time() + self._retry_wait
+            self.schedule(self._retry_wait)
+            self._retry_wait = min(self._retry_wait * 2, self.max_retry_interval)
+
+    def _batches(self, everything: bool) -> list[tuple[str, list[tuple[int, str]]]]:
+        rows = self.db.execute("SELECT id, created_at, kind, payload FROM spool ORDER BY id LIMIT ?",
+                               (self.batch_size,)).fetchall()
+        by_kind: dict[str, list[tuple[int, str]]] = {}
+        oldest: dict[str, float] = {}
+        for row_id, created_at, kind, payload in rows:
+            by_kind.setdefault(kind, []).append((row_id, payload))
+            oldest.setdefault(kind, created_at)
+        order = {kind: position for position, kind in enumerate(self.writers)}
+        kinds = sorted(by_kind, key=lambda kind: order.get(kind, len(order)))
+        # An urgent row beyond the rows read makes everything before it due.
+        everything = everything or any(kind not in by_kind for kind in self._urgent)
+        now = time.time()
+        last_due = -1
+        for position, kind in enumerate(kinds):
+            if (everything or kind in self._urgent or self.pending.get(kind, 0) >= self.max_rows.get(kind, 0)
+                    or now - oldest[kind] >= self.lingers.get(kind, 0)):
+                last_due = position
+        return [(kind, by_kind[kind]) for kind in kinds[:last_due + 1]]
+
+    async def replay(self, everything: bool = False) -> bool:
+        """
+        Writes every row that is due to Hasura, oldest first, until nothing is due or Hasura can't be reached.
+
+        :param everything: Whether to write every row, due or not
+        :return: Whether every due row was written or dead-lettered
+        """
+        async with self._lock:
+            while batches := self._batches(everything):
+                for kind, batch in batches:
+                    write = self.writers.get(kind)
+                    if write is None:
+                        self._dead_letter(kind, batch, f"No writer for {kind}")
+                    elif not await self._write(kind, write, batch):
+                        return False
+            return True
+
+    async def _write(self, kind: str, write: Callable[[list[dict]], Awaitable[Any]],
+                     batch: list[tuple[int, str]]) -> bool:
+        """
+        Writes a batch. A batch Hasura rejects is split in half and each half written on its own, so only the rows that
+        are rejected by themselves are dead-lettered.
+
+        :return: Whether the replay can go on, i.e. Hasura could be reached
+        """
+        result = await write([json.loads(payload) for _, payload in batch])
+        if not result:
+            self.failures += 1
+            return False
+        if isinstance(result, dict) and "errors" in result:
+            self.failures += 1
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                return await self._write(kind, write, batch[:middle]) and await self._write(kind, write, batch[middle:])
+            self._dead_letter(kind, batch, json.dumps(result["errors"]))
+            return True
+        self._delete(kind, batch)
+        self.replayed += len(batch)
+        spool_replayed.inc(kind, amount=len(batch))
+        return True
+
+    def _delete(self, kind: str, batch: list[tuple[int, str]]):
+        self.db.executemany("DELETE FROM spool WHERE id = ?", [(row_id,) for row_id, _ in batch])
+        self.depth -= len(batch)
+        self.pending[kind] -= len(batch)
+        if not self.pending[kind]:
+            self._urgent.discard(kind)
+
+    def _dead_letter(self, kind: str, batch: list[tuple[int, str]], error: str):
+        print(f"Giving up on {len(batch)} {kind} writes, they are kept in the dead_letters table of {self.path}: "
+              f"{error}")
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT INTO dead_letters (id, created_at, kind, payload, error) "
+                            "SELECT id, created_at, kind, payload, ? FROM spool WHERE id = ?",
+                            [(error, row_id) for row_id, _ in batch])
+        self._delete(kind, batch)
+        self.db.execute("COMMIT")
+        self.dead_lettered += len(batch)
+        spool_dead_letters.inc(kind, amount=len(batch))
+
+    async def close(self):
+        """
+        Cancels the replay timer, tries once more to write everything that is left, and closes the log. Anything that
+        couldn't be written is replayed on the next start.
+        """
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+        if self.depth:
+            await self.replay(everything=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "lag": self.lag(),
+            "replayed": self.replayed,
+            "failures": self.failures,
+            "dead_lettered": self.dead_lettered,
+        }
+
+
+class SpoolWriter:
+    """
+    Appends one kind of row to a write spool. Rows are written flush_interval seconds after the oldest one was appended,
+    right away once max_rows are waiting, or right away when a row is urgent, in one batch.
+    """
+
+    def __init__(self,
+                 spool: WriteSpool,
+                 kind: str,
+                 write: Callable[[list[dict]], Awaitable[Any]],
+                 flush_interval: float = 0,
+                 max_rows: int = 50):
+        """
+        :param spool: The spool to append to
+        :param kind: The kind of row
+        :param write: Writes a batch of rows, returning the GraphQL result
+        :param flush_interval: How long rows wait to be batched together, in seconds
+        :param max_rows: The number of waiting rows that writes them right away
+        """
+        self.spool = spool
+        self.kind = kind
+        spool.register(kind, write, linger=flush_interval, max_rows=max_rows)
+
+    def add(self, row: dict, urgent: bool = False):
+        """
+        Appends a row to the spool.
+
+        :param row: The row to write
+        :param urgent: Whether something is waiting on the row, so it should be written right away
+        """
+        self.spool.append(self.kind, row, urgent)
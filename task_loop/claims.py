@@ -0,0 +1,205 @@
+import zlib
+from datetime import datetime, timedelta, timezone
+from constants import *
+
+
+class AnswerClaims:
+    """
+    Claims answers to deliver with a lease, and acknowledges them once they have been sent.
+
+    Answers are claimed a page at a time, oldest first, so only batch_size answers are held in memory however large the
+    backlog is. Each claim lists up to batch_size * 4 of the oldest undelivered answers, keeps the ones in this worker's
+    partitions (and any that have waited longer than steal_after seconds), and leases up to batch_size of them with a
+    conditional update. If a worker crashes before acknowledging an answer, its lease expires and the answer is claimed
+    again, so answers are delivered at least once instead of at most once.
+
+    Answers in a thread are delivered in order: a thread whose oldest undelivered answer is leased (or belongs to another
+    worker) is skipped, so its later answers are only claimed once that one has been delivered. Threads are assigned to
+    partitions by a hash of their id, so every answer in a thread is in the same partition.
+    """
+
+    def __init__(self,
+                 worker_id: str,
+                 partitions: int = 1,
+                 partition_ids: list[int] | None = None,
+                 batch_size: int = 20,
+                 lease_seconds: float = 120,
+                 max_attempts: int = 5,
+                 steal_after: float = 30):
+        """
+        :param worker_id: Identifies this worker as the owner of its leases
+        :param partitions: The number of partitions threads are split into
+        :param partition_ids: The partitions this worker prefers, all of them by default
+        :param batch_size: The most answers to claim at once
+        :param lease_seconds: How long a claimed answer is reserved for this worker
+        :param max_attempts: How many times an answer can be claimed before it is given up on
+        :param steal_after: How long an answer in another worker's partition waits before this worker takes it
+        """
+        self.worker_id = worker_id
+        self.partitions = partitions
+        self.partition_ids = set(partition_ids if partition_ids is not None else range(partitions))
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.steal_after = steal_after
+        self.claimed = 0
+        self.stolen = 0
+        self.lost_races = 0
+        self.acked = 0
+        self.lost_leases = 0
+        self.released = 0
+
+    def partition(self, thread_id: str) -> int:
+        return zlib.crc32(thread_id.encode()) % self.partitions
+
+    def wants(self, candidate: dict, now: datetime) -> bool:
+        if self.partition(candidate["thread_id"]) in self.partition_ids:
+            return True
+        try:
+            waited = (now - datetime.fromisoformat(candidate["created_at"])).total_seconds()
+        except (KeyError, TypeError, ValueError):
+            return False
+        return waited >= self.steal_after
+
+    @staticmethod
+    def leased(candidate: dict, now: datetime) -> bool:
+        try:
+            return datetime.fromisoformat(candidate["lease_expires_at"]) > now
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    async def claim(self) -> list[dict]:
+        """
+        Leases a batch of answers to this worker.
+
+        :return: The claimed answers, oldest first
+        """
+        now = datetime.now(timezone.utc)
+        result = await execute_graphql(GRAPHQL_URL,
+                                       CLAIMABLE_MESSAGES_GRAPHQL,
+                                       {
+                                           "limit": self.batch_size * 4,
+                                           "max_attempts": self.max_attempts
+                                       },
+                                       GRAPHQL_HEADERS)
+        if not result or "data" not in result:
+            return []
+        candidates = []
+        # Threads whose oldest undelivered answer this worker can't claim, so their later answers have to wait.
+        blocked = set()
+        for candidate in result["data"]["message"]:
+            if candidate["thread_id"] in blocked:
+                continue
+            if self.leased(candidate, now) or not self.wants(candidate, now):
+                blocked.add(candidate["thread_id"])
+                continue
+            candidates.append(candidate)
+            if len(candidates) == self.batch_size:
+                break
+        if not candidates:
+            return []
+        result = await execute_graphql(GRAPHQL_URL,
+                                       CLAIM_MESSAGES_GRAPHQL,
+                                       {
+                                           "message_ids": [candidate["message_id"] for candidate in candidates],
+                                           "owner": self.worker_id,
+                                           "now": now.isoformat(),
+                                           "expires_at": (now + timedelta(seconds=self.lease_seconds)).isoformat()
+                                       },
+                                       GRAPHQL_HEADERS)
+        if not result or "data" not in result:
+            return []
+        claimed = result["data"]["update_message"]["returning"]
+        # Another worker leased the rest between the two steps.
+        self.lost_races += len(candidates) - len(claimed)
+        # An answer this worker leased after one another worker got first would overtake it, so hand it back.
+        claimed_ids = {task["message_id"] for task in claimed}
+        lost_threads = set()
+        overtaking = []
+        for candidate in candidates:
+            if candidate["message_id"] not in claimed_ids:
+                lost_threads.add(candidate["thread_id"])
+            elif candidate["thread_id"] in lost_threads:
+                overtaking.append(candidate["message_id"])
+        if overtaking:
+            await self.release(overtaking)
+            claimed = [task for task in claimed if task["message_id"] not in overtaking]
+        self.claimed += len(claimed)
+        self.stolen += sum(1 for task in claimed if self.partition(task["thread_id"]) not in self.partition_ids)
+        # update_message doesn't keep the order of the list, so put the answers back in the order they were written.
+        return sorted(claimed, key=lambda task: task["created_at"])
+
+    async def ack(self, acks: dict[str, list[str] | None]) -> bool:
+        """
+        Marks answers as done in one bulk mutation, releasing their leases.
+
+        :param acks: The ids of the Discord messages each delivered answer was sent as, by answer message id. None for
+        an answer that is being dropped without being delivered.
+        :return: Whether the acknowledgement was written
+        """
+        if not acks:
+            return True
+        delivered_at = datetime.now(timezone.utc).isoformat()
+        updates = [{"where": {"message_id": {"_eq": message_id}, "lease_owner": {"_eq": self.worker_id}},
+                    "_set": {"processed": True,
+                             "lease_expires_at": None,
+                             "delivered_at": delivered_at if discord_message_ids is not None else None,
+                             "discord_message_ids": discord_message_ids}}
+                   for message_id, discord_message_ids in acks.items()]
+        result = await execute_graphql(GRAPHQL_URL,
+                                       ACK_MESSAGES_GRAPHQL,
+                                       {"updates": updates},
+                                       GRAPHQL_HEADERS)
+        if not result or "data" not in result:
+            print(f"Failed to acknowledge {len(acks)} answers, they will be delivered again once their leases expire.")
+            return False
+        acked = sum(update["affected_rows"] for update in result["data"]["update_message_many"])
+        # An answer whose lease expired and was claimed by another worker mid-delivery isn't acknowledged here.
+        self.lost_leases += len(acks) - acked
+        self.acked += acked
+        return True
+
+    async def release(self, message_ids: list[str]) -> bool:
+        """
+        Hands back the leases of answers that weren't attempted, so they can be claimed again right away without it
+        counting as a delivery attempt.
+
+        :param message_ids: The answers to release
+        :return: Whether the release was written
+        """
+        if not message_ids:
+            return True
+        updates = [{"where": {"message_id": {"_eq": message_id}, "lease_owner": {"_eq": self.worker_id}},
+                    "_set": {"lease_owner": None, "lease_expires_at": None},
+                    "_inc": {"delivery_attempts": -1}}
+                   for message_id in message_ids]
+        result = await execute_graphql(GRAPHQL_URL,
+                                       RELEASE_MESSAGES_GRAPHQL,
+                                       {"updates": updates},
+                                       GRAPHQL_HEADERS)
+        if not result or "data" not in result:
+            print(f"Failed to release {len(message_ids)} answers, they will be claimed again once their leases expire.")
+            return False
+        self.released += sum(update["affected_rows"] for update in result["data"]["update_message_many"])
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "partitions": sorted(self.partition_ids),
+            "claimed": self.claimed,
+            "stolen": self.stolen,
+            "lost_races": self.lost_races,
+            "acked": self.acked,
+            "lost_leases": self.lost_leases,
+            "released": self.released,
+        }
+
+
+answer_claims = AnswerClaims(worker_id=DELIVERY_WORKER_ID,
+                             partitions=DELIVERY_PARTITIONS,
+                             partition_ids=DELIVERY_PARTITION_IDS,
+                             batch_size=DELIVERY_BATCH_SIZE,
+                             lease_seconds=DELIVERY_LEASE_SECONDS,
+                             max_attempts=DELIVERY_MAX_ATTEMPTS,
+                             steal_after=DELIVERY_STEAL_AFTER_SECONDS)
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from constants import *
+
+
+class AdaptivePollScheduler:
+    """
+    Decides how long the task loop should wait before polling for answers again.
+
+    While polls keep claiming messages it polls again immediately to drain the burst. Once a poll comes back empty it
+    waits the base interval, then doubles the wait after each further empty poll up to a ceiling, so an idle bot
+    sends far fewer mutations to Hasura.
+
+    A nudge (e.g. a user mentioning the bot, so an answer is on its way) resets the wait to the base interval and cuts
+    any in-progress wait short. The answer can take minutes to be written, so for nudge_window seconds after a nudge the
+    wait doesn't back off past the base interval.
+    """
+
+    def __init__(self, base_interval: float = 1, max_interval: float = 10, backoff: float = 2,
+                 nudge_window: float = 300):
+        """
+        :param base_interval: The wait after the first empty poll
+        :param max_interval: The ceiling the wait backs off to when idle
+        :param backoff: The multiplier applied to the wait after each empty poll
+        :param nudge_window: How long after a nudge to keep polling at the base interval, in seconds
+        """
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.nudge_window = nudge_window
+        self.awake_until = 0.0
+        self.interval = base_interval
+        self.backlog = 0
+        self.polls = 0
+        self.empty_polls = 0
+        self.claimed = 0
+        self._nudge = asyncio.Event()
+
+    def record(self, claimed: int) -> float:
+        """
+        Records the result of a poll and returns how long to wait before the next one.
+
+        :param claimed: The number of messages the poll claimed
+        :return: The number of seconds to wait, 0 to poll again immediately
+        """
+        self.polls += 1
+        self.backlog = claimed
+        if claimed > 0:
+            self.claimed += claimed
+            self.interval = 0
+        else:
+            self.empty_polls += 1
+            if self.interval == 0 or time.monotonic() < self.awake_until:
+                self.interval = self.base_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+    def nudge(self):
+        """
+        Resets the wait to the base interval, keeps it there for nudge_window seconds, and wakes a pending wait().
+        """
+        self.interval = min(self.interval, self.base_interval)
+        self.awake_until = time.monotonic() + self.nudge_window
+        self._nudge.set()
+
+    async def wait(self, delay: float):
+        """
+        Sleeps for delay seconds, or until nudged.
+
+        :param delay: The number of seconds to sleep
+        """
+        try:
+            await asyncio.wait_for(self._nudge.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._nudge.clear()
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "backlog": self.backlog,
+            "polls": self.polls,
+            "empty_polls": self.empty_polls,
+            "claimed": self.claimed,
+            "awake_for": max(0.0, self.awake_until - time.monotonic()),
+        }
+
+
+poll_scheduler = AdaptivePollScheduler(base_interval=TASK_LOOP_SECONDS,
+                                       max_interval=TASK_LOOP_MAX_SECONDS,
+                                       backoff=TASK_LOOP_BACKOFF,
+                                       nudge_window=TASK_LOOP_NUDGE_WINDOW_SECONDS)
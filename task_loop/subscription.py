@@ -0,0 +1,150 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+import aiohttp
+
+# https://github.com/enisdenjo/graphql-ws/blob/master/PROTOCOL.md
+GRAPHQL_TRANSPORT_WS = "graphql-transport-ws"
+
+PENDING_BOT_MESSAGES_SUBSCRIPTION = """subscription PendingBotMessages($cursor: timestamptz) {
+  message_stream(batch_size: 100,
+                 cursor: {initial_value: {created_at: $cursor}, ordering: ASC},
+                 where: {from_bot: {_eq: true}, processed: {_eq: false}}) {
+    message_id
+    created_at
+  }
+}
+"""
+
+
+class PendingMessageSubscription:
+    """
+    Watches Hasura for unprocessed bot messages over a graphql-ws subscription, and wakes the task loop as soon as one
+    arrives instead of waiting for the next poll.
+
+    The subscription is only used as a wake-up signal. Messages are still claimed by the task loop with a lease, so a
+    duplicate or missed notification can never cause a duplicate or lost answer. Retries of failed answers are picked
+    up by the safety poll once their leases expire.
+
+    The stream resumes from the created_at of the last message it saw after a reconnect, and every (re)connect wakes the
+    task loop once to catch up on anything inserted while the socket was down. While the socket is down the task loop
+    falls back to polling.
+    """
+
+    def __init__(self,
+                 url: str,
+                 headers: dict,
+                 session_factory: Callable[[], Awaitable[aiohttp.ClientSession]],
+                 safety_poll_interval: float = 30,
+                 max_reconnect_delay: float = 30,
+                 heartbeat: float = 20):
+        """
+        :param url: The websocket GraphQL endpoint, e.g. wss://example.hasura.app/v1/graphql
+        :param headers: The headers to send in the connection_init payload
+        :param session_factory: Returns the aiohttp session to open the websocket on
+        :param safety_poll_interval: How often to poll anyway while the subscription is connected
+        :param max_reconnect_delay: The ceiling for the exponential reconnect backoff
+        :param heartbeat: How often to ping the server to detect dead connections
+        """
+        self.url = url
+        self.headers = {k: v for k, v in headers.items() if k.lower() != "content-type"}
+        self.session_factory = session_factory
+        self.safety_poll_interval = safety_poll_interval
+        self.max_reconnect_delay = max_reconnect_delay
+        self.heartbeat = heartbeat
+        self.cursor = datetime.now(timezone.utc)
+        self.connected = False
+        self.reconnects = 0
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="pending-message-subscription")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.connected = False
+
+    def wake(self):
+        self._wake.set()
+
+    async def wait(self, fallback_interval: float) -> bool:
+        """
+        Waits until there is work to do.
+
+        :param fallback_interval: How long to wait when the subscription is down, i.e. the polling interval
+        :return: True if woken by the subscription, False if the wait timed out
+        """
+        timeout = self.safety_poll_interval if self.connected else fallback_interval
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._wake.clear()
+
+    async def _run(self):
+        delay = 1
+        while True:
+            try:
+                await self._listen()
+                delay = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Subscription to {self.url} failed: {e!r}. Reconnecting in {delay} seconds...")
+            self.connected = False
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _listen(self):
+        session = await self.session_factory()
+        async with session.ws_connect(self.url, protocols=(GRAPHQL_TRANSPORT_WS,), heartbeat=self.heartbeat) as ws:
+            await ws.send_json({"type": "connection_init", "payload": {"headers": self.headers}})
+            ack = await ws.receive_json(timeout=10)
+            if ack.get("type") != "connection_ack":
+                raise ConnectionError(f"Expected connection_ack, got {ack}")
+            await ws.send_json({
+                "id": "pending",
+                "type": "subscribe",
+                "payload": {
+                    "query": PENDING_BOT_MESSAGES_SUBSCRIPTION,
+                    "variables": {"cursor": self.cursor.isoformat()}
+                }
+            })
+            self.connected = True
+            # Catch up on anything that arrived while we were disconnected.
+            self.wake()
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                payload = json.loads(msg.data)
+                if payload.get("type") == "ping":
+                    await ws.send_json({"type": "pong"})
+                else:
+                    self._handle(payload)
+
+    def _handle(self, payload: dict):
+        message_type = payload.get("type")
+        if message_type == "next":
+            rows = payload["payload"].get("data", {}).get("message_stream", [])
+            if rows:
+                # The stream is ordered by created_at, so the last row is the newest. Timestamps are compared as
+                # datetimes, Hasura's strings don't all have the same precision or offset.
+                self.cursor = max(self.cursor, datetime.fromisoformat(rows[-1]["created_at"]))
+                self.wake()
+        elif message_type == "error":
+            raise ConnectionError(f"Subscription error: {payload.get('payload')}")
+        elif message_type == "complete":
+            raise ConnectionError("Subscription completed by the server")
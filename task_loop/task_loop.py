@@ -1,47 +1,146 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from utilities import *
 from constants import *
+from metrics import answers, task_loop_lag_seconds
+from task_loop.claims import answer_claims
 import discord
 
 
-async def execute_task_loop(client: discord.Client):
+@dataclass
+class DeliveryResult:
     """
-    This is the main task loop.
+    The outcome of delivering a single claimed answer.
+    """
+    message_id: str
+    thread_id: str
+    delivered: bool
+    error: str | None = None
+    # The ids of the Discord messages the answer was sent as.
+    discord_message_ids: list[str] | None = None
+    # Retrying won't help (e.g. the thread was deleted), so the answer is acknowledged instead of being claimed again.
+    permanent: bool = False
+
+
+async def deliver_answer(client: discord.Client, task: dict) -> DeliveryResult:
+    """
+    Delivers a single answer to its thread and updates the thread's controller message.
+
     :param client: The discord client. (essentially a singleton)
-    :return: None
-    """
-    # Get all tasks
-    result = await execute_graphql(GRAPHQL_URL,
-                                   PROCESS_MESSAGES_GRAPHQL,
-                                   {},
-                                   GRAPHQL_HEADERS)
-    # If False result skip as this was a failure.
-    if not result:
-        return
-    # Collect the list of tasks
-    all_tasks = result["data"]["update_message"]["returning"]
-    for task in all_tasks:
-        thread_id = task["thread_id"]
-        content = task["content"]
-        sources = task["sources"]
-        thread = task["thread"]
-        thread_controller_id = thread["thread_controller_id"]
-        thread_author_id = thread["author_id"]
-        channel = client.get_channel(int(thread_id))
-        if channel is None:
-            continue
-        controller = await channel.fetch_message(int(thread_controller_id))
-        await send_long_message_in_embeds(channel=channel,
-                                          title=RESPONSE_TITLE,
-                                          message=content)
-        await send_long_message_in_embeds(channel=channel,
-                                          title=RESPONSE_SOURCES_TITLE,
-                                          message=sources,
-                                          color=discord.Color.green())
+    :param task: The claimed message
+    :return: Whether it was delivered
+    """
+    thread_id = task["thread_id"]
+    content = task["content"]
+    sources = task["sources"]
+    thread = task["thread"]
+    thread_controller_id = thread["thread_controller_id"]
+    thread_author_id = thread["author_id"]
+    channel = client.get_channel(int(thread_id))
+    if channel is None:
+        # The thread isn't cached, e.g. it was archived, or its guild is on a shard this process doesn't run.
+        try:
+            channel = await client.fetch_channel(int(thread_id))
+        except (discord.NotFound, discord.Forbidden) as e:
+            return DeliveryResult(task["message_id"], thread_id, False, repr(e), permanent=True)
+        except discord.DiscordException as e:
+            return DeliveryResult(task["message_id"], thread_id, False, repr(e))
+    # The answer and its sources are packed together into as few messages as possible.
+    sent = await send_long_messages_in_embeds(channel=channel,
+                                              sections=[
+                                                  EmbedSection(title=RESPONSE_TITLE,
+                                                               message=content),
+                                                  EmbedSection(title=RESPONSE_SOURCES_TITLE,
+                                                               message=sources,
+                                                               color=discord.Color.green())
+                                              ])
+    if sent is None:
+        return DeliveryResult(task["message_id"], thread_id, False, "The answer could not be sent")
+    # The answer has been delivered, so a failure updating the controller is logged but doesn't send it again.
+    try:
         help_controller_message = HELP_CONTROLLER_MESSAGE.format(author=thread_author_id,
                                                                  bot=client.user.id,
                                                                  disclaimer=DISCLAIMER_LINK)
-        controller = await controller.edit(embed=discord.Embed(title=CONTROLLER_TITLE,
-                                                               description=help_controller_message,
-                                                               color=discord.Color.gold()))
+        controller = await edit_controller(channel, thread_controller_id,
+                                           [discord.Embed(title=CONTROLLER_TITLE,
+                                                          description=help_controller_message,
+                                                          color=discord.Color.gold())])
         await controller.add_reaction(POSITIVE_EMOJI)
         await controller.add_reaction(NEGATIVE_EMOJI)
+    except discord.DiscordException as e:
+        print(f"Failed to update the controller of thread {thread_id} after delivering message {task['message_id']}: "
+              f"{e!r}")
+    return DeliveryResult(task["message_id"], thread_id, True,
+                          discord_message_ids=[str(message.id) for message in sent])
+
+
+async def deliver_thread(client: discord.Client, thread_tasks: list[dict], workers: asyncio.Semaphore):
+    """
+    Delivers the answers for one thread in order. Each answer holds a worker slot while it is being delivered. Delivery
+    stops at the first answer that fails and can be retried, so the answers after it don't overtake it.
+
+    :param client: The discord client. (essentially a singleton)
+    :param thread_tasks: The claimed messages for the thread, in the order they were claimed
+    :param workers: Bounds how many answers are delivered at once across all threads
+    :return: The result for each message that was attempted
+    """
+    results = []
+    for task in thread_tasks:
+        async with workers:
+            with rest_calls.operation("deliver_answer"):
+                delivery = await deliver_answer(client, task)
+        results.append(delivery)
+        if not delivery.delivered and not delivery.permanent:
+            break
+    return results
+
+
+async def execute_task_loop(client: discord.Client) -> list[DeliveryResult]:
+    """
+    This is the main task loop.
+
+    A batch of answers is claimed with a lease, and each answer is acknowledged once it has been sent, so an answer that
+    wasn't sent (because the send failed, or the bot stopped) is claimed again when its lease expires. Answers for
+    different threads are delivered concurrently, up to DELIVERY_CONCURRENCY at a time. Answers within the same thread
+    are delivered in order, and a thread's answers after one that failed are released and wait for it.
+    :param client: The discord client. (essentially a singleton)
+    :return: The result for each claimed message
+    """
+    all_tasks = await answer_claims.claim()
+    if not all_tasks:
+        return []
+    # Group the tasks by thread. dicts keep insertion order, so the order within a thread is kept.
+    claimed_at = datetime.now(timezone.utc)
+    by_thread: dict[str, list[dict]] = {}
+    for task in all_tasks:
+        by_thread.setdefault(task["thread_id"], []).append(task)
+        try:
+            task_loop_lag_seconds.observe(
+                max(0.0, (claimed_at - datetime.fromisoformat(task["created_at"])).total_seconds()))
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    workers = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+    thread_results = await asyncio.gather(*(deliver_thread(client, thread_tasks, workers)
+                                            for thread_tasks in by_thread.values()))
+    deliveries = [delivery for results in thread_results for delivery in results]
+    attempts = {task["message_id"]: task.get("delivery_attempts", 1) for task in all_tasks}
+    for delivery in deliveries:
+        if delivery.delivered:
+            answers.inc("delivered")
+        elif delivery.permanent:
+            answers.inc("dropped")
+            print(f"Dropping message {delivery.message_id} for thread {delivery.thread_id}: {delivery.error}")
+        else:
+            answers.inc("failed")
+            if attempts[delivery.message_id] >= DELIVERY_MAX_ATTEMPTS:
+                print(f"Giving up on message {delivery.message_id} for thread {delivery.thread_id} after "
+                      f"{DELIVERY_MAX_ATTEMPTS} attempts: {delivery.error}")
+    # Failed answers keep their lease until it expires, which spaces out the retries and holds back the rest of their
+    # thread. The answers after them weren't attempted, so they are handed back.
+    await answer_claims.ack({delivery.message_id: delivery.discord_message_ids
+                             for delivery in deliveries if delivery.delivered or delivery.permanent})
+    attempted = {delivery.message_id for delivery in deliveries}
+    await answer_claims.release([task["message_id"] for task in all_tasks if task["message_id"] not in attempted])
+    return deliveries
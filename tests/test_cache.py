@@ -0,0 +1,89 @@
+import asyncio
+
+from cache import TTLCache
+
+
+class CountingLoader:
+    """
+    Loads a value after a short delay, counting how often it is called.
+    """
+
+    def __init__(self, value="value", fail: bool = False):
+        self.value = value
+        self.fail = fail
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("The search endpoint is down")
+        return self.value
+
+
+def test_fresh_entries_are_served_from_memory():
+    async def run():
+        cache = TTLCache(ttl=60)
+        loader = CountingLoader()
+        values = [await cache.get_or_load("key", loader) for _ in range(3)]
+        return cache, loader, values
+
+    cache, loader, values = asyncio.run(run())
+    assert values == ["value"] * 3
+    assert loader.calls == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_concurrent_lookups_share_one_load():
+    async def run():
+        cache = TTLCache(ttl=60)
+        loader = CountingLoader()
+        values = await asyncio.gather(*(cache.get_or_load("key", loader) for _ in range(5)))
+        return cache, loader, values
+
+    cache, loader, values = asyncio.run(run())
+    assert values == ["value"] * 5
+    assert loader.calls == 1
+    assert cache.coalesced == 4
+    assert cache.stats()["hit_rate"] == 4 / 5
+
+
+def test_expired_entries_are_loaded_again():
+    async def run():
+        cache = TTLCache(ttl=0.02)
+        loader = CountingLoader()
+        await cache.get_or_load("key", loader)
+        await asyncio.sleep(0.05)
+        await cache.get_or_load("key", loader)
+        return loader
+
+    assert asyncio.run(run()).calls == 2
+
+
+def test_the_least_recently_used_entry_is_evicted():
+    async def run():
+        cache = TTLCache(max_size=2, ttl=60)
+        for key in ("a", "b"):
+            await cache.get_or_load(key, CountingLoader(key))
+        await cache.get_or_load("a", CountingLoader())
+        await cache.get_or_load("c", CountingLoader("c"))
+        return cache
+
+    cache = asyncio.run(run())
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.evictions == 1
+
+
+def test_failures_are_raised_to_every_waiter_and_not_cached():
+    async def run():
+        cache = TTLCache(ttl=60)
+        loader = CountingLoader(fail=True)
+        results = await asyncio.gather(*(cache.get_or_load("key", loader) for _ in range(3)), return_exceptions=True)
+        loader.fail = False
+        value = await cache.get_or_load("key", loader)
+        return loader, results, value
+
+    loader, results, value = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert value == "value"
+    assert loader.calls == 2
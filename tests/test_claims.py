@@ -0,0 +1,96 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from constants import CLAIMABLE_MESSAGES_GRAPHQL, CLAIM_MESSAGES_GRAPHQL, RELEASE_MESSAGES_GRAPHQL
+from task_loop import claims
+from task_loop.claims import AnswerClaims
+
+
+def at(seconds_ago: float) -> str:
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)).isoformat()
+
+
+class FakeHasura:
+    """
+    Answers the claim queries from a list of answers. Answers whose ids are in taken are leased by another worker
+    between the two claim steps.
+    """
+
+    def __init__(self, answers: list[dict], taken: tuple[str, ...] = ()):
+        self.answers = answers
+        self.taken = set(taken)
+        self.released: list[str] = []
+
+    async def execute_graphql(self, url, query, variables, headers):
+        if query == CLAIMABLE_MESSAGES_GRAPHQL:
+            return {"data": {"message": self.answers[:variables["limit"]]}}
+        if query == CLAIM_MESSAGES_GRAPHQL:
+            claimed = [answer for answer in self.answers
+                       if answer["message_id"] in variables["message_ids"] and answer["message_id"] not in self.taken]
+            # update_message returns rows in no particular order.
+            return {"data": {"update_message": {"returning": claimed[::-1]}}}
+        if query == RELEASE_MESSAGES_GRAPHQL:
+            message_ids = [update["where"]["message_id"]["_eq"] for update in variables["updates"]]
+            self.released += message_ids
+            return {"data": {"update_message_many": [{"affected_rows": 1} for _ in message_ids]}}
+        raise AssertionError(f"Unexpected query {query}")
+
+
+def answer(message_id: str, thread_id: str, waited: float = 0, leased_for: float | None = None) -> dict:
+    return {"message_id": message_id, "thread_id": thread_id, "created_at": at(waited),
+            "lease_expires_at": at(-leased_for) if leased_for is not None else None}
+
+
+def thread_in(answer_claims: AnswerClaims, partition: int, skip: int = 0) -> str:
+    return [thread_id for thread_id in (f"thread-{n}" for n in range(100))
+            if answer_claims.partition(thread_id) == partition][skip]
+
+
+def claim(monkeypatch, answer_claims: AnswerClaims, hasura: FakeHasura) -> list[str]:
+    monkeypatch.setattr(claims, "execute_graphql", hasura.execute_graphql)
+    return [task["message_id"] for task in asyncio.run(answer_claims.claim())]
+
+
+def test_every_worker_puts_a_thread_in_the_same_partition():
+    first, second = AnswerClaims("worker-1", partitions=4), AnswerClaims("worker-2", partitions=4)
+    assert all(first.partition(f"thread-{n}") == second.partition(f"thread-{n}") for n in range(100))
+    assert {first.partition(f"thread-{n}") for n in range(100)} == {0, 1, 2, 3}
+
+
+def test_answers_are_claimed_in_the_order_they_were_written(monkeypatch):
+    answer_claims = AnswerClaims("worker")
+    hasura = FakeHasura([answer("1", "a", waited=3), answer("2", "b", waited=2), answer("3", "a", waited=1)])
+    assert claim(monkeypatch, answer_claims, hasura) == ["1", "2", "3"]
+    assert answer_claims.stats()["claimed"] == 3
+
+
+def test_other_partitions_are_only_stolen_once_they_have_waited(monkeypatch):
+    answer_claims = AnswerClaims("worker", partitions=2, partition_ids=[0], steal_after=30)
+    mine, theirs, stale = thread_in(answer_claims, 0), thread_in(answer_claims, 1), thread_in(answer_claims, 1, 1)
+    hasura = FakeHasura([answer("1", stale, waited=60), answer("2", theirs, waited=5), answer("3", mine, waited=1)])
+    assert claim(monkeypatch, answer_claims, hasura) == ["1", "3"]
+    assert answer_claims.stats()["stolen"] == 1
+
+
+def test_a_thread_with_a_leased_answer_waits_for_it(monkeypatch):
+    answer_claims = AnswerClaims("worker")
+    hasura = FakeHasura([answer("1", "a", waited=3, leased_for=60), answer("2", "a", waited=2),
+                         answer("3", "b", waited=1, leased_for=-60)])
+    # The lease on 3 has expired, so it can be claimed again.
+    assert claim(monkeypatch, answer_claims, hasura) == ["3"]
+
+
+def test_answers_that_would_overtake_one_another_worker_won_are_released(monkeypatch):
+    answer_claims = AnswerClaims("worker")
+    hasura = FakeHasura([answer("1", "a", waited=3), answer("2", "a", waited=2), answer("3", "b", waited=1)],
+                        taken=("1",))
+    assert claim(monkeypatch, answer_claims, hasura) == ["3"]
+    assert hasura.released == ["2"]
+    stats = answer_claims.stats()
+    assert (stats["lost_races"], stats["released"], stats["claimed"]) == (1, 1, 1)
+
+
+def test_a_claim_is_at_most_a_batch(monkeypatch):
+    answer_claims = AnswerClaims("worker", batch_size=2)
+    hasura = FakeHasura([answer(str(n), f"thread-{n}", waited=10 - n) for n in range(6)])
+    assert claim(monkeypatch, answer_claims, hasura) == ["0", "1"]
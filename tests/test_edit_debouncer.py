@@ -0,0 +1,83 @@
+import asyncio
+
+from write_behind import EditDebouncer
+
+
+class RecordingWriter:
+    """
+    Records the batches written to it, and fails every write while it is down.
+    """
+
+    def __init__(self):
+        self.batches: list[list[dict]] = []
+        self.down = False
+
+    async def __call__(self, rows: list[dict]) -> bool:
+        if self.down:
+            return False
+        self.batches.append(rows)
+        return True
+
+
+def test_a_burst_of_edits_is_one_write_of_the_final_content():
+    async def run():
+        writer = RecordingWriter()
+        debouncer = EditDebouncer(writer, quiet_period=0.2)
+        for revision in range(5):
+            debouncer.add({"message_id": "1", "content": f"revision {revision}"})
+            await asyncio.sleep(0.01)
+        debouncer.add({"message_id": "1", "content": "revision 4"})
+        before_quiet = list(writer.batches)
+        await asyncio.sleep(0.4)
+        await debouncer.close()
+        return writer, before_quiet, debouncer
+
+    writer, before_quiet, debouncer = asyncio.run(run())
+    assert before_quiet == []
+    assert writer.batches == [[{"message_id": "1", "content": "revision 4"}]]
+    assert (debouncer.edits, debouncer.unchanged, debouncer.flushes) == (5, 1, 1)
+
+
+def test_messages_that_go_quiet_together_are_written_in_one_batch():
+    async def run():
+        writer = RecordingWriter()
+        debouncer = EditDebouncer(writer, quiet_period=0.05)
+        for message_id in ("1", "2", "3"):
+            debouncer.add({"message_id": message_id, "content": "edited"})
+        await asyncio.sleep(0.1)
+        await debouncer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    assert [[row["message_id"] for row in batch] for batch in writer.batches] == [["1", "2", "3"]]
+
+
+def test_a_full_buffer_is_written_right_away():
+    async def run():
+        writer = RecordingWriter()
+        debouncer = EditDebouncer(writer, quiet_period=60, max_rows=3)
+        for message_id in ("1", "2", "3"):
+            debouncer.add({"message_id": message_id, "content": "edited"})
+        await asyncio.sleep(0.01)
+        written = list(writer.batches)
+        await debouncer.close()
+        return written
+
+    assert [len(batch) for batch in asyncio.run(run())] == [3]
+
+
+def test_failed_writes_are_retried_unless_the_message_was_edited_again():
+    async def run():
+        writer = RecordingWriter()
+        debouncer = EditDebouncer(writer, quiet_period=0.05)
+        writer.down = True
+        debouncer.add({"message_id": "1", "content": "first"})
+        debouncer.add({"message_id": "2", "content": "first"})
+        assert not await debouncer.flush(everything=True)
+        debouncer.add({"message_id": "2", "content": "second"})
+        writer.down = False
+        await debouncer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.batches == [[{"message_id": "1", "content": "first"}, {"message_id": "2", "content": "second"}]]
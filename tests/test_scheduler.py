@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+from task_loop.scheduler import AdaptivePollScheduler
+
+
+def test_polls_again_immediately_while_answers_keep_coming():
+    scheduler = AdaptivePollScheduler(base_interval=1, max_interval=10, backoff=2, nudge_window=0)
+    assert [scheduler.record(claimed) for claimed in (5, 3, 1)] == [0, 0, 0]
+    assert scheduler.stats()["claimed"] == 9
+
+
+def test_empty_polls_back_off_to_the_ceiling():
+    scheduler = AdaptivePollScheduler(base_interval=1, max_interval=10, backoff=2, nudge_window=0)
+    scheduler.record(1)
+    assert [scheduler.record(0) for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+    assert scheduler.record(1) == 0
+    assert scheduler.record(0) == 1
+
+
+def test_a_nudge_holds_the_wait_at_the_base_interval_for_its_window():
+    scheduler = AdaptivePollScheduler(base_interval=1, max_interval=10, backoff=2, nudge_window=60)
+    for _ in range(5):
+        scheduler.record(0)
+    assert scheduler.interval == 10
+    scheduler.nudge()
+    assert scheduler.interval == 1
+    assert [scheduler.record(0) for _ in range(3)] == [1, 1, 1]
+    assert scheduler.stats()["awake_for"] > 0
+    scheduler.awake_until = time.monotonic()
+    assert [scheduler.record(0) for _ in range(2)] == [2, 4]
+
+
+def test_a_nudge_cuts_a_wait_short():
+    async def run():
+        scheduler = AdaptivePollScheduler()
+        asyncio.get_running_loop().call_later(0.01, scheduler.nudge)
+        started = time.monotonic()
+        await scheduler.wait(5)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 1
@@ -0,0 +1,58 @@
+from constants import MAX_EMBED_DESCRIPTION, MAX_MESSAGE_EMBED_CHARACTERS, MAX_MESSAGE_EMBEDS
+from utilities import EmbedSection, MarkdownSplitter, pack_embeds, split_content
+
+
+def test_parts_fit_and_keep_every_word():
+    content = "\n".join(" ".join(f"word{line}-{word}" for word in range(12)) for line in range(200))
+    parts = list(split_content(content, 500))
+    assert len(parts) > 1
+    assert all(len(part) <= 500 for part in parts)
+    assert " ".join(parts).split() == content.split()
+
+
+def test_code_blocks_are_closed_and_reopened_with_their_language():
+    content = "Intro\n```python\n" + "\n".join(f"print({line})" for line in range(100)) + "\n```\nOutro"
+    parts = list(split_content(content, 300))
+    assert len(parts) > 2
+    assert all(len(part) <= 300 for part in parts)
+    assert all(part.count("```") % 2 == 0 for part in parts)
+    assert all(part.startswith("```python\n") for part in parts[1:-1])
+    assert parts[-1].endswith("```\nOutro")
+
+
+def test_links_are_never_cut():
+    link = "[the Hasura docs](https://hasura.io/docs/latest/index/)"
+    content = " ".join(["filler"] * 13 + [link] + ["more"] * 20)
+    splitter = MarkdownSplitter(content)
+    first = splitter.next_chunk(110)
+    assert link not in first and "[the" not in first
+    assert splitter.next_chunk(110).startswith(link)
+
+
+def test_empty_content_is_one_empty_part():
+    assert list(split_content("")) == [""]
+
+
+def test_sections_are_packed_in_order_within_discord_limits():
+    sections = [EmbedSection("Answer", "answer " * 3000, footer="Was this helpful?"),
+                EmbedSection("Sources", "\n".join(f"- https://hasura.io/docs/{page}" for page in range(300)))]
+    messages = pack_embeds(sections)
+    embeds = [embed for message in messages for embed in message]
+    assert len(messages) > 1
+    for message in messages:
+        assert len(message) <= MAX_MESSAGE_EMBEDS
+        assert sum(len(embed.title) + len(embed.description) + len(embed.footer.text or "")
+                   for embed in message) <= MAX_MESSAGE_EMBED_CHARACTERS
+        assert all(len(embed.description) <= MAX_EMBED_DESCRIPTION for embed in message)
+    titles = [embed.title for embed in embeds]
+    assert titles == sorted(titles)
+    assert [embed.footer.text for embed in embeds if embed.footer.text] == ["Was this helpful?"]
+    last_answer = max(index for index, embed in enumerate(embeds) if embed.title == "Answer")
+    assert embeds[last_answer].footer.text == "Was this helpful?"
+
+
+def test_a_short_answer_and_its_sources_share_a_message():
+    messages = pack_embeds([EmbedSection("Answer", "Use a remote schema."),
+                            EmbedSection("Sources", "- https://hasura.io/docs/remote-schemas")])
+    assert len(messages) == 1
+    assert [embed.title for embed in messages[0]] == ["Answer", "Sources"]
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+from spool import WriteSpool
+
+
+class FakeHasura:
+    """
+    Records the batches written to it. Rejects any batch holding a row marked bad, and every batch while it is down.
+    """
+
+    def __init__(self):
+        self.batches: list[tuple[str, list[dict]]] = []
+        self.down = False
+
+    def writer(self, kind: str):
+        async def write(rows: list[dict]):
+            if self.down:
+                return False
+            if any(row.get("bad") for row in rows):
+                return {"errors": [{"message": "Foreign key violation"}]}
+            self.batches.append((kind, rows))
+            return {"data": {}}
+        return write
+
+    def rows(self, kind: str) -> list[dict]:
+        return [row for batch_kind, rows in self.batches if batch_kind == kind for row in rows]
+
+
+def test_kinds_replay_in_registration_order_and_rows_in_append_order():
+    async def run():
+        hasura = FakeHasura()
+        spool = WriteSpool(":memory:")
+        spool.register("threads", hasura.writer("threads"))
+        spool.register("messages", hasura.writer("messages"), linger=60)
+        spool.append("messages", {"id": 1})
+        spool.append("threads", {"id": "a"})
+        spool.append("messages", {"id": 2})
+        assert await spool.replay(everything=True)
+        await spool.close()
+        return hasura
+
+    hasura = asyncio.run(run())
+    assert [kind for kind, _ in hasura.batches] == ["threads", "messages"]
+    assert hasura.rows("messages") == [{"id": 1}, {"id": 2}]
+
+
+def test_lingering_rows_wait_for_their_linger_or_close():
+    async def run():
+        hasura = FakeHasura()
+        spool = WriteSpool(":memory:")
+        spool.register("threads", hasura.writer("threads"), linger=60)
+        spool.register("votes", hasura.writer("votes"), linger=60)
+        spool.append("votes", {"id": 1})
+        await spool.replay()
+        lingering = list(hasura.batches)
+        spool.append("threads", {"id": "a"}, urgent=True)
+        await spool.replay()
+        urgent = list(hasura.batches)
+        await spool.close()
+        return lingering, urgent, hasura
+
+    lingering, urgent, hasura = asyncio.run(run())
+    assert lingering == []
+    # The votes were registered after the threads, so an urgent thread doesn't drag them along.
+    assert urgent == [("threads", [{"id": "a"}])]
+    # Closing the spool writes everything that is left.
+    assert hasura.rows("votes") == [{"id": 1}]
+
+
+def test_only_rejected_rows_are_dead_lettered():
+    async def run():
+        hasura = FakeHasura()
+        spool = WriteSpool(":memory:")
+        spool.register("messages", hasura.writer("messages"))
+        for row_id in range(21):
+            spool.append("messages", {"id": row_id, "bad": row_id == 13})
+        replayed = await spool.replay(everything=True)
+        dead_letters = spool.db.execute("SELECT payload FROM dead_letters").fetchall()
+        stats = spool.stats()
+        await spool.close()
+        return hasura, replayed, dead_letters, stats
+
+    hasura, replayed, dead_letters, stats = asyncio.run(run())
+    assert replayed
+    assert [row["id"] for row in hasura.rows("messages")] == [row_id for row_id in range(21) if row_id != 13]
+    assert dead_letters == [('{"id": 13, "bad": true}',)]
+    assert stats["depth"] == 0
+    assert stats["dead_lettered"] == 1
+
+
+def test_a_rejected_row_does_not_hold_up_an_urgent_row_behind_it():
+    async def run():
+        hasura = FakeHasura()
+        spool = WriteSpool(":memory:")
+        spool.register("messages", hasura.writer("messages"), linger=60)
+        spool.append("messages", {"id": 1, "bad": True})
+        started = time.monotonic()
+        spool.append("messages", {"id": 2}, urgent=True)
+        while not hasura.rows("messages") and time.monotonic() - started < 5:
+            await asyncio.sleep(0.01)
+        written_after = time.monotonic() - started
+        stats = spool.stats()
+        await spool.close()
+        return hasura, written_after, stats
+
+    hasura, written_after, stats = asyncio.run(run())
+    assert hasura.rows("messages") == [{"id": 2}]
+    assert written_after < 0.5
+    assert stats["dead_lettered"] == 1
+    assert stats["depth"] == 0
+
+
+def test_rows_left_over_are_replayed_after_a_restart(tmp_path):
+    path = str(tmp_path / "spool.sqlite3")
+
+    async def before_restart():
+        hasura = FakeHasura()
+        hasura.down = True
+        spool = WriteSpool(path)
+        spool.register("threads", hasura.writer("threads"))
+        spool.register("messages", hasura.writer("messages"))
+        spool.append("messages", {"id": 1})
+        spool.append("threads", {"id": "a"})
+        await spool.close()
+        return hasura
+
+    async def after_restart():
+        hasura = FakeHasura()
+        spool = WriteSpool(path)
+        spool.register("threads", hasura.writer("threads"))
+        spool.register("messages", hasura.writer("messages"))
+        spool.start()
+        depth = spool.depth
+        assert await spool.replay()
+        await spool.close()
+        return hasura, depth
+
+    assert asyncio.run(before_restart()).batches == []
+    hasura, depth = asyncio.run(after_restart())
+    assert depth == 2
+    assert hasura.batches == [("threads", [{"id": "a"}]), ("messages", [{"id": 1}])]
@@ -0,0 +1,159 @@
+from constants import *
+from cache import TTLCache
+
+
+class ThreadIndex:
+    """
+    An in-memory index of help threads, keyed by thread id and by controller message id.
+
+    Rows have the same shape as GET_THREAD_FOR_COMMAND returns. The index is warmed from Hasura at startup with the most
+    recent threads, and every write the bot makes to a thread is written through to it, so reaction handling and
+    /status can usually be answered without a round-trip to Hasura.
+
+    A thread that isn't indexed (an older thread, or one created by another instance) is looked up in Hasura and
+    indexed. Lookups that find nothing are cached for miss_ttl seconds, so messages and reactions that aren't in a
+    thread don't query Hasura every time.
+    """
+
+    def __init__(self, warm_up_threads: int = 10000, page_size: int = 1000, miss_ttl: float = 60):
+        """
+        :param warm_up_threads: How many of the most recent threads to load when warming up
+        :param page_size: How many threads to load per query when warming up
+        :param miss_ttl: How long a lookup that found nothing is cached, in seconds
+        """
+        self.threads: dict[str, dict] = {}
+        self.by_controller: dict[str, str] = {}
+        self.warm_up_threads = warm_up_threads
+        self.page_size = page_size
+        self.lookups = TTLCache(max_size=1024, ttl=miss_ttl)
+        self.warm = False
+
+    async def warm_up(self) -> bool:
+        """
+        Loads the most recent threads from Hasura, a page at a time.
+
+        :return: Whether the index is warm
+        """
+        offset = 0
+        while offset < self.warm_up_threads:
+            result = await execute_graphql(GRAPHQL_URL,
+                                           GET_ALL_THREADS,
+                                           {"limit": min(self.page_size, self.warm_up_threads - offset),
+                                            "offset": offset},
+                                           GRAPHQL_HEADERS)
+            if not result or "data" not in result:
+                print("Failed to warm the thread index, falling back to Hasura for thread lookups.")
+                return False
+            threads = result["data"]["thread"]
+            for thread in threads:
+                self.put(thread)
+            offset += len(threads)
+            if len(threads) < self.page_size:
+                break
+        self.warm = True
+        return True
+
+    def put(self, thread: dict):
+        """
+        Adds or replaces a thread.
+
+        :param thread: The thread row
+        """
+        thread = {"solved_votes": 0, "failed_votes": 0, **thread}
+        previous = self.threads.get(thread["thread_id"])
+        if previous is not None and previous["thread_controller_id"] != thread["thread_controller_id"]:
+            self.by_controller.pop(previous["thread_controller_id"], None)
+        self.threads[thread["thread_id"]] = thread
+        self.by_controller[thread["thread_controller_id"]] = thread["thread_id"]
+
+    def update(self, thread_id: str, **fields):
+        """
+        Updates fields of a thread, if it is indexed.
+
+        :param thread_id: The thread to update
+        :param fields: The new values
+        """
+        thread = self.threads.get(thread_id)
+        if thread is not None:
+            thread.update(fields)
+
+    def increment(self, thread_id: str, **deltas: int):
+        """
+        Increments counters of a thread, if it is indexed.
+
+        :param thread_id: The thread to update
+        :param deltas: The amount to add to each counter
+        """
+        thread = self.threads.get(thread_id)
+        if thread is not None:
+            for field, delta in deltas.items():
+                thread[field] = (thread.get(field) or 0) + delta
+
+    async def get(self, thread_id: str) -> dict | None:
+        """
+        Gets a thread by its id, querying Hasura if it isn't indexed.
+
+        :param thread_id: The thread id
+        :return: The thread, or None if it doesn't exist
+        """
+        thread = self.threads.get(thread_id)
+        if thread is not None:
+            return thread
+        return await self._look_up(("thread", thread_id),
+                                   GET_THREAD_FOR_COMMAND,
+                                   {"thread_id": thread_id},
+                                   lambda data: data.get("thread_by_pk"))
+
+    async def get_by_controller(self, thread_controller_id: str, thread_id: str | None = None) -> dict | None:
+        """
+        Gets a thread by its controller message id, querying Hasura if it isn't indexed. A message in an indexed thread,
+        or one that was recently found not to be a controller, costs nothing.
+
+        :param thread_controller_id: The controller message id
+        :param thread_id: The thread the message is in, if known
+        :return: The thread, or None if the message isn't a controller
+        """
+        indexed_thread_id = self.by_controller.get(thread_controller_id)
+        if indexed_thread_id is not None:
+            return self.threads[indexed_thread_id]
+        if thread_id in self.threads:
+            # The thread is indexed under another controller, so this message isn't one.
+            return None
+        return await self._look_up(("controller", thread_controller_id),
+                                   GET_THREAD_BY_CONTROLLER,
+                                   {"thread_controller_id": thread_controller_id},
+                                   lambda data: next(iter(data["thread"]), None))
+
+    async def _look_up(self, key: tuple, query: str, variables: dict, find) -> dict | None:
+        """
+        Looks a thread up in Hasura and indexes it. Concurrent lookups of the same key share one query, and a lookup
+        that finds nothing is cached. A failed query isn't cached.
+
+        :param key: The lookup's cache key
+        :param query: The GraphQL query
+        :param variables: The query's variables
+        :param find: Gets the thread, or None, from the query's data
+        :return: The thread, or None if it doesn't exist or Hasura couldn't be reached
+        """
+        async def load():
+            result = await execute_graphql(GRAPHQL_URL, query, variables, GRAPHQL_HEADERS)
+            if not result or "data" not in result:
+                raise ConnectionError(f"Failed to look up the thread for {key}")
+            return find(result["data"])
+
+        try:
+            thread = await self.lookups.get_or_load(key, load)
+        except ConnectionError as e:
+            print(e)
+            return None
+        if thread is None:
+            return None
+        # A thread found earlier may have been indexed, and updated, since.
+        if thread["thread_id"] not in self.threads:
+            self.put(thread)
+        return self.threads[thread["thread_id"]]
+
+
+thread_index = ThreadIndex(warm_up_threads=THREAD_INDEX_WARM_UP_THREADS,
+                           page_size=THREAD_INDEX_PAGE_SIZE,
+                           miss_ttl=THREAD_INDEX_MISS_TTL_SECONDS)
@@ -1,105 +1,302 @@
-from typing import Literal
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Literal, NamedTuple
 import discord
 import random
+import re
 from constants import *
-import asyncio
+from thread_index import thread_index
+from config import get_config, GuildConfig
+from send_scheduler import send_scheduler, INTERACTION, ANSWER
+from write_behind import solved_writer
+
+
+class RestCallCounter:
+    """
+    Counts the Discord REST calls made by each bot operation.
+
+    Once installed on the client's HTTP client, every REST request is attributed to the operation that is running in
+    the current context (see operation()), or to "other".
+    """
+
+    def __init__(self):
+        self.operations = Counter()
+        self.calls = Counter()
+        self._current: ContextVar[str | None] = ContextVar("rest_operation", default=None)
+
+    def install(self, http):
+        """
+        Wraps the request method of a discord.py HTTPClient so that every REST call is counted.
+
+        :param http: The HTTP client, i.e. client.http
+        """
+        request = http.request
+
+        async def counted_request(route, **kwargs):
+            self.calls[self._current.get() or "other"] += 1
+            return await request(route, **kwargs)
+
+        http.request = counted_request
+
+    @contextmanager
+    def operation(self, name: str):
+        """
+        Attributes the REST calls made inside the block, including in tasks it starts, to an operation.
+
+        :param name: The operation name
+        """
+        self.operations[name] += 1
+        token = self._current.set(name)
+        try:
+            yield
+        finally:
+            self._current.reset(token)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "operations": count,
+                "calls": self.calls[name],
+                "calls_per_operation": self.calls[name] / count,
+            }
+            for name, count in self.operations.items()
+        }
+
+
+rest_calls = RestCallCounter()
 
 
 def get_random_loading_message():
     return random.choice(LOADING_MESSAGES)
 
 
-def split_content(content, max_length=4096):
+# Opens or closes a code block, with the language if there is one, e.g. ```python. Discord treats ``` as a code block
+# delimiter anywhere in a message, not only at the start of a line.
+CODE_FENCE_PATTERN = re.compile(r'```[\w+-]*')
+# An inline markdown link, e.g. [Hasura](https://hasura.io)
+LINK_PATTERN = re.compile(r'\[[^\]\n]*\]\([^)\s]*\)')
+CODE_FENCE_CLOSE = "\n```"
+
+
+class MarkdownSplitter:
     """
-    Splits a large string into parts without exceeding the specified maximum length.
-    Attempts to split on the last space within the limit to avoid cutting words in half.
+    Splits a large string into parts in a single pass, without exceeding a maximum length per part.
 
-    :param content: The string to split.
-    :param max_length: The maximum length of each part.
-    :return: A list of parts.
+    Each part is cut at the last line break (or failing that, the last space) that fits, never inside a markdown link.
+    If a part ends inside a ``` code block, the block is closed at the end of the part and reopened, with the same
+    language, at the start of the next one, so every part renders on its own.
+
+    Code fences are found once up front, links are only looked for on the line each part is cut on, and each part is
+    only sliced out once, so splitting is linear in the length of the string.
     """
-    if len(content) <= max_length:
-        return [content]
 
-    parts = []
-    while content:
-        # Check if the content is shorter or equal to the max_length
-        if len(content) <= max_length:
-            parts.append(content)
-            break
+    def __init__(self, content: str):
+        self.content = content
+        self.position = 0
+        self.fences = [(match.start(), match.group()) for match in CODE_FENCE_PATTERN.finditer(content)]
+        self._next_fence = 0
+        # The opening line of the code block the next part starts in, if any.
+        self.open_fence: str | None = None
+        self._skip_whitespace()
+
+    @property
+    def done(self) -> bool:
+        return self.position >= len(self.content)
+
+    def next_chunk(self, max_length: int) -> str:
+        """
+        Takes the next part.
+
+        :param max_length: The maximum length of the part, including any code fence lines added to it.
+        :return: The part.
+        """
+        content = self.content
+        prefix = f"{self.open_fence}\n" if self.open_fence else ""
+        # Always leave room to close a code block, we only know if we need to once the part has been cut.
+        available = max(1, max_length - len(prefix) - len(CODE_FENCE_CLOSE))
+        start = self.position
+        end = start + available
+        if end >= len(content):
+            end = len(content)
+        else:
+            end = self._split_index(start, end)
+
+        open_fence = self.open_fence
+        while self._next_fence < len(self.fences) and self.fences[self._next_fence][0] < end:
+            open_fence = None if open_fence else self.fences[self._next_fence][1]
+            self._next_fence += 1
+
+        chunk = prefix + content[start:end].rstrip()
+        if open_fence:
+            chunk += CODE_FENCE_CLOSE
+        self.open_fence = open_fence
+        self.position = end
+        self._skip_whitespace()
+        return chunk
+
+    def chunks(self, max_length: int = 4096):
+        """
+        Lazily yields every remaining part.
+
+        :param max_length: The maximum length of each part.
+        """
+        if self.done:
+            yield ""
+            return
+        while not self.done:
+            yield self.next_chunk(max_length)
+
+    def _split_index(self, start: int, end: int) -> int:
+        content = self.content
+        newline_index = content.rfind('\n', start, end)
+        if newline_index > start + (end - start) // 2:
+            split_index = newline_index
+        else:
+            split_index = content.rfind(' ', start, end)
+            if split_index <= start:
+                split_index = newline_index if newline_index > start else end
+        # Don't cut a link in half, split before it instead. A link can't span lines, so only the part of the line the
+        # split is on that is in this part can hold one.
+        position = content.rfind('\n', start, split_index) + 1 or start
+        line_end = content.find('\n', split_index)
+        if line_end == -1:
+            line_end = len(content)
+        while (bracket := content.find('[', position, split_index)) != -1:
+            link = LINK_PATTERN.match(content, bracket, line_end)
+            if link is None:
+                position = bracket + 1
+            elif link.end() > split_index:
+                return bracket if bracket > start else split_index
+            else:
+                position = link.end()
+        return split_index
+
+    def _skip_whitespace(self):
+        content = self.content
+        position = self.position
+        if self.open_fence:
+            # Inside a code block indentation matters, so only drop the line break we split on.
+            if position < len(content) and content[position] == '\n':
+                position += 1
+        else:
+            while position < len(content) and content[position].isspace():
+                position += 1
+        self.position = position
 
-        # Find the nearest space to split on to avoid cutting words
-        split_index = content.rfind(' ', 0, max_length)
-        if split_index == -1:
-            # No spaces found, hard split at max_length
-            split_index = max_length
 
-        part = content[:split_index].strip()
-        parts.append(part)
-        content = content[split_index:].strip()
+def split_content(content, max_length=4096):
+    """
+    Lazily splits a large string into parts without exceeding the specified maximum length. See MarkdownSplitter.
 
-    return parts
+    :param content: The string to split.
+    :param max_length: The maximum length of each part.
+    :return: A generator of parts.
+    """
+    return MarkdownSplitter(content).chunks(max_length)
 
 
 async def log(message: str, channel: int, client: discord.Client):
     await client.get_channel(channel).send(message)
 
 
-async def send_with_exponential_backoff(channel: discord.Thread, embed: discord.Embed, max_retries=5):
+async def send_embeds(channel: discord.Thread, embeds: list[discord.Embed]) -> discord.Message | None:
     """
-    Attempts to send an embed message to a channel with exponential backoff on rate limit errors.
+    Sends embeds in one message to a channel through the outbound send scheduler.
+
+    Sends to the same channel share a queue, and when Discord rate limits the channel the whole queue waits for as long
+    as Discord asks before retrying, instead of every sender backing off on its own.
 
     :param channel: The Discord channel (or thread) to send the message to.
-    :param embed: The Discord Embed object to send.
-    :param max_retries: Maximum number of retries before giving up.
+    :param embeds: The Discord Embed objects to send, at most 10.
+    :return: The sent message, or None if it could not be sent.
     """
-    base_delay = 1  # Base delay in seconds, adjust as needed
-    attempt = 0
+    try:
+        return await send_scheduler.submit(f"channel:{channel.id}", lambda: channel.send(embeds=embeds), ANSWER)
+    except discord.HTTPException as e:
+        print(f"Failed to send message to {channel}: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}.")
 
-    while attempt < max_retries:
-        try:
-            response = await channel.send(embed=embed)
-            return response
-        except discord.HTTPException as e:
-            if e.status == 429:  # 429 is the HTTP status code for Too Many Requests (rate limited)
-                wait_time = base_delay * 2 ** attempt  # Exponential backoff formula
-                print(f"Rate limit hit, attempt {attempt + 1}. Waiting {wait_time} seconds before retrying...")
-                await asyncio.sleep(wait_time)
-                attempt += 1
-            else:
-                print(f"HTTPException not related to rate limits: {e}")
-                break  # Exit loop for non-rate limit related HTTP exceptions
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}.")
-            break  # Exit loop on unexpected errors
-    else:
-        # If the loop completes without breaking, all retries have failed or max_retries reached.
-        print(f"Failed to send message to {channel} after {max_retries} attempts.")
-
-
-async def send_long_message_in_embeds(channel: discord.Thread,
-                                      title: str,
-                                      message: str,
-                                      color: discord.Color = discord.Color.blue(),
-                                      footer: str | None = None
-                                      ):
-    chunks = split_content(message)
-
-    if len(chunks) == 0:
-        return
 
+async def send_followup(interaction: discord.Interaction, *args, **kwargs):
+    """
+    Sends an interaction follow-up through the outbound send scheduler, ahead of any queued answer deliveries.
+
+    :param interaction: The interaction to follow up on
+    :return: The sent message
+    """
+    return await send_scheduler.submit(f"interaction:{interaction.id}",
+                                       lambda: interaction.followup.send(*args, **kwargs),
+                                       INTERACTION)
+
+
+class EmbedSection(NamedTuple):
+    """
+    A titled block of text to send as one or more embeds.
+    """
+    title: str
+    message: str
+    color: discord.Color = discord.Color.blue()
+    footer: str | None = None
+
+
+def pack_embeds(sections: list[EmbedSection]) -> list[list[discord.Embed]]:
+    """
+    Splits sections into embeds and packs them into as few messages as Discord allows: at most 10 embeds and 6000
+    characters per message, and at most 4096 characters per embed description.
+
+    Each chunk is cut to fit the space left in the current message, so a long answer and its sources usually share
+    messages. Order is preserved, and a section's footer goes on its last embed.
+
+    :param sections: The sections to send, in order
+    :return: The embeds for each message
+    """
+    messages = []
     embeds = []
-    for chunk in chunks:
-        embed = discord.Embed(title=title,
-                              description=chunk,
-                              color=color)
-        embeds.append(embed)
-    else:
-        if footer:
-            embeds[-1].set_footer(text=footer)
+    used = 0
+    for section in sections:
+        if section.message is None:
+            continue
+        splitter = MarkdownSplitter(section.message)
+        # The footer is reserved on every chunk, since we only know which chunk is last once it has been cut.
+        overhead = len(section.title) + len(section.footer or "")
+        while True:
+            budget = min(MAX_EMBED_DESCRIPTION, MAX_MESSAGE_EMBED_CHARACTERS - used - overhead)
+            if len(embeds) == MAX_MESSAGE_EMBEDS or budget < MIN_PACKED_CHUNK:
+                messages.append(embeds)
+                embeds, used = [], 0
+                budget = min(MAX_EMBED_DESCRIPTION, MAX_MESSAGE_EMBED_CHARACTERS - overhead)
+            chunk = splitter.next_chunk(budget)
+            embed = discord.Embed(title=section.title, description=chunk, color=section.color)
+            embeds.append(embed)
+            used += len(section.title) + len(chunk)
+            if splitter.done:
+                if section.footer:
+                    embed.set_footer(text=section.footer)
+                    used += len(section.footer)
+                break
+    if embeds:
+        messages.append(embeds)
+    return messages
+
+
+async def send_long_messages_in_embeds(channel: discord.Thread,
+                                       sections: list[EmbedSection]) -> list[discord.Message] | None:
+    """
+    Sends sections of text as embeds, packed into as few messages as possible. See pack_embeds.
 
-    for embed in embeds:
-        await send_with_exponential_backoff(channel, embed)
+    :param channel: The Discord channel (or thread) to send the messages to.
+    :param sections: The sections to send, in order
+    :return: The sent messages, or None if one of them could not be sent. The messages after it are not sent.
+    """
+    sent = []
+    for embeds in pack_embeds(sections):
+        message = await send_embeds(channel, embeds)
+        if message is None:
+            return None
+        sent.append(message)
+    return sent
 
 
 async def send_message_in_embed(channel: discord.Thread,
@@ -110,22 +307,29 @@ async def send_message_in_embed(channel: discord.Thread,
     embed = discord.Embed(title=title,
                           description=message,
                           color=color)
-    return await send_with_exponential_backoff(channel, embed)
+    return await send_embeds(channel, [embed])
 
 
-async def build_thread_status_embed(thread_id: str) -> discord.Embed:
-    response = await execute_graphql(
-        GRAPHQL_URL,
-        GET_THREAD_FOR_COMMAND,
-        {"thread_id": thread_id},
-        GRAPHQL_HEADERS
-    )
+async def edit_controller(channel: discord.Thread, thread_controller_id: str,
+                          embeds: list[discord.Embed]) -> discord.Message:
+    """
+    Replaces the embeds of a thread's controller message.
 
-    if not response or 'data' not in response or 'thread_by_pk' not in response['data']:
+    :param channel: The thread the controller is in
+    :param thread_controller_id: The id of the controller message
+    :param embeds: The new embeds
+    :return: The edited message
+    """
+    # A partial message can be edited without fetching it first.
+    return await channel.get_partial_message(int(thread_controller_id)).edit(embeds=embeds)
+
+
+async def build_thread_status_embed(guild_id: int, thread_id: str) -> discord.Embed:
+    thread = await thread_index.get(thread_id)
+
+    if thread is None:
         return discord.Embed(title="Error", description="Could not fetch thread data.")
 
-    thread = response['data']['thread_by_pk']
-    guild_id = GUILD_ID  # Assuming GUILD_ID is defined elsewhere as a constant
     thread_controller_id = thread['thread_controller_id']
 
     # Construct the message links
@@ -145,43 +349,43 @@ async def build_thread_status_embed(thread_id: str) -> discord.Embed:
     return embed
 
 
-async def allowed_channels_embed(interaction: discord.Interaction.response):
-    channels_list = ', '.join([f"<#{channel_id}>" for channel_id in CHANNELS])
+async def allowed_channels_embed(interaction: discord.Interaction.response, config: GuildConfig | None):
+    channels_list = ', '.join([f"<#{channel_id}>" for channel_id in (config.channels if config else [])])
     embed = discord.Embed(title=ERROR_MESSAGE_TITLE,
                           description=f"{WRONG_CHANNEL_MESSAGE}{channels_list}",
                           color=discord.Color.gold())
-    return await interaction.followup.send(embed=embed)
+    return await send_followup(interaction, embed=embed)
 
 
 async def handle_toggle(interaction: discord.Interaction.response,
                         command: Literal["open", "close", "solve", "unsolve"] = "open"):
+    with rest_calls.operation(command):
+        return await _handle_toggle(interaction, command)
+
+
+async def _handle_toggle(interaction: discord.Interaction.response,
+                         command: Literal["open", "close", "solve", "unsolve"]):
     await interaction.response.defer()
 
     if not isinstance(interaction.channel, discord.Thread):
-        await interaction.followup.send(embed=discord.Embed(title=UNAVAILABLE_COMMAND))
+        await send_followup(interaction, embed=discord.Embed(title=UNAVAILABLE_COMMAND))
         return
 
-    if interaction.channel.parent_id not in CHANNELS:
-        await interaction.followup.send(embed=allowed_channels_embed(interaction))
+    config = await get_config(interaction.guild_id)
+    if config is None or interaction.channel.parent_id not in config.channels:
+        await allowed_channels_embed(interaction, config)
         return
 
     thread_id = str(interaction.channel.id)
-    response = await execute_graphql(
-        GRAPHQL_URL,
-        GET_THREAD_FOR_COMMAND,
-        {"thread_id": thread_id},
-        GRAPHQL_HEADERS
-    )
-    thread = response["data"]["thread_by_pk"]
+    thread = await thread_index.get(thread_id)
     author_id = thread["author_id"]
     is_open = thread["open"]
     is_solved = thread["solved"]
     user_roles = [role.id for role in interaction.user.roles]
 
-    if str(interaction.user.id) != author_id and MOD_ROLE not in user_roles:
-        return await interaction.followup.send(NO_PERMISSION_MESSAGE)
+    if str(interaction.user.id) != author_id and config.mod_role not in user_roles:
+        return await send_followup(interaction, NO_PERMISSION_MESSAGE)
 
-    controller = await interaction.channel.fetch_message(int(thread["thread_controller_id"]))
     help_controller_message = HELP_CONTROLLER_MESSAGE.format(
         author=thread["author_id"],
         bot=interaction.client.user.id,
@@ -194,14 +398,8 @@ async def handle_toggle(interaction: discord.Interaction.response,
     ]
 
     if not is_open and command == "open":
-        await execute_graphql(GRAPHQL_URL,
-                              MARK_THREAD_SOLVED,
-                              {
-                                  "thread_id": thread_id,
-                                  "solved": is_solved,
-                                  "open": True
-                              },
-                              GRAPHQL_HEADERS)
+        solved_writer.add({"thread_id": thread_id, "solved": is_solved, "open": True}, urgent=True)
+        thread_index.update(thread_id, solved=is_solved, open=True)
         if interaction.channel.archived:
             await interaction.channel.edit(archived=False)
         if is_solved:
@@ -213,16 +411,10 @@ async def handle_toggle(interaction: discord.Interaction.response,
             discord.Embed(title=OPENED_MESSAGE,
                           color=discord.Color.yellow())
         )
-        await controller.edit(embeds=embeds)
+        await edit_controller(interaction.channel, thread["thread_controller_id"], embeds)
     elif is_open and command == "close":
-        await execute_graphql(GRAPHQL_URL,
-                              MARK_THREAD_SOLVED,
-                              {
-                                  "thread_id": thread_id,
-                                  "solved": is_solved,
-                                  "open": False
-                              },
-                              GRAPHQL_HEADERS)
+        solved_writer.add({"thread_id": thread_id, "solved": is_solved, "open": False}, urgent=True)
+        thread_index.update(thread_id, solved=is_solved, open=False)
         if interaction.channel.archived:
             await interaction.channel.edit(archived=False)
         if is_solved:
@@ -234,18 +426,12 @@ async def handle_toggle(interaction: discord.Interaction.response,
             discord.Embed(title=CLOSED_MESSAGE,
                           color=discord.Color.red())
         )
-        await controller.edit(embeds=embeds)
+        await edit_controller(interaction.channel, thread["thread_controller_id"], embeds)
         if not interaction.channel.archived:
             await interaction.channel.edit(archived=True)
     elif not is_solved and command == "solve":
-        await execute_graphql(GRAPHQL_URL,
-                              MARK_THREAD_SOLVED,
-                              {
-                                  "thread_id": thread_id,
-                                  "solved": True,
-                                  "open": is_open
-                              },
-                              GRAPHQL_HEADERS)
+        solved_writer.add({"thread_id": thread_id, "solved": True, "open": is_open}, urgent=True)
+        thread_index.update(thread_id, solved=True, open=is_open)
         re_archive = False
         if interaction.channel.archived:
             re_archive = True
@@ -259,18 +445,12 @@ async def handle_toggle(interaction: discord.Interaction.response,
                 discord.Embed(title=CLOSED_MESSAGE,
                               color=discord.Color.red())
             )
-        await controller.edit(embeds=embeds)
+        await edit_controller(interaction.channel, thread["thread_controller_id"], embeds)
         if re_archive:
             await interaction.channel.edit(archived=True)
     elif is_solved and command == "unsolve":
-        await execute_graphql(GRAPHQL_URL,
-                              MARK_THREAD_SOLVED,
-                              {
-                                  "thread_id": thread_id,
-                                  "solved": False,
-                                  "open": True
-                              },
-                              GRAPHQL_HEADERS)
+        solved_writer.add({"thread_id": thread_id, "solved": False, "open": True}, urgent=True)
+        thread_index.update(thread_id, solved=False, open=True)
         unarchived = False
         if interaction.channel.archived:
             unarchived = True
@@ -284,7 +464,7 @@ async def handle_toggle(interaction: discord.Interaction.response,
                 discord.Embed(title=OPENED_MESSAGE,
                               color=discord.Color.red())
             )
-        await controller.edit(embeds=embeds)
+        await edit_controller(interaction.channel, thread["thread_controller_id"], embeds)
 
-    status_embed = await build_thread_status_embed(thread_id)
-    await interaction.followup.send(embed=status_embed)
+    status_embed = await build_thread_status_embed(interaction.guild_id, thread_id)
+    await send_followup(interaction, embed=status_embed)
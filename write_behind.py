@@ -0,0 +1,215 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from constants import *
+from spool import WriteSpool, SpoolWriter
+
+
+async def insert_threads(rows: list[dict]) -> Any:
+    return await execute_graphql(GRAPHQL_URL,
+                                 INSERT_THREADS_GRAPHQL,
+                                 {"objects": rows},
+                                 GRAPHQL_HEADERS)
+
+
+async def insert_messages(rows: list[dict]) -> Any:
+    return await execute_graphql(GRAPHQL_URL,
+                                 INSERT_MESSAGES_GRAPHQL,
+                                 {"objects": rows},
+                                 GRAPHQL_HEADERS)
+
+
+async def update_message_edits(rows: list[dict]) -> Any:
+    # Only the latest content of each message matters, and messages that were never stored are left alone.
+    contents = {row["message_id"]: row["content"] for row in rows}
+    return await execute_graphql(GRAPHQL_URL,
+                                 UPDATE_MESSAGE_EDITS_MANY,
+                                 {"updates": [{"where": {"message_id": {"_eq": message_id}},
+                                               "_set": {"content": content}}
+                                              for message_id, content in contents.items()]},
+                                 GRAPHQL_HEADERS)
+
+
+async def mark_threads_solved(rows: list[dict]) -> Any:
+    # Only the latest state of each thread matters.
+    states = {row["thread_id"]: {"solved": row["solved"], "open": row["open"]} for row in rows}
+    return await execute_graphql(GRAPHQL_URL,
+                                 MARK_THREADS_SOLVED_MANY,
+                                 {"updates": [{"where": {"thread_id": {"_eq": thread_id}}, "_set": state}
+                                              for thread_id, state in states.items()]},
+                                 GRAPHQL_HEADERS)
+
+
+class EditDebouncer:
+    """
+    Holds the latest content of each edited message until it hasn't been edited for quiet_period seconds, then writes
+    every message that has gone quiet in one batch. A burst of edits to a message is a single write of its final content.
+
+    Once max_rows messages have pending edits they are all written right away, so the buffer stays bounded.
+    """
+
+    def __init__(self,
+                 write: Callable[[list[dict]], Awaitable[bool]],
+                 quiet_period: float = 2,
+                 max_rows: int = 50):
+        """
+        :param write: Writes a batch of rows, returning whether it succeeded
+        :param quiet_period: How long a message has to go without edits before it is written, in seconds
+        :param max_rows: The number of messages with pending edits that triggers a flush
+        """
+        self.write = write
+        self.quiet_period = quiet_period
+        self.max_rows = max_rows
+        # The latest row for each message and when it is due, in the order they are due.
+        self.pending: dict[str, tuple[float, dict]] = {}
+        self.edits = 0
+        self.unchanged = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self._timer: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def add(self, row: dict):
+        """
+        Buffers the latest content of an edited message, replacing any pending edit to the same message.
+
+        :param row: The message row, with its message_id and new content
+        """
+        previous = self.pending.pop(row["message_id"], None)
+        if previous is not None and previous[1]["content"] == row["content"]:
+            # Nothing changed since the pending edit, so keep its deadline.
+            self.unchanged += 1
+            self.pending[row["message_id"]] = previous
+            return
+        self.edits += 1
+        self.pending[row["message_id"]] = (asyncio.get_running_loop().time() + self.quiet_period, row)
+        if len(self.pending) >= self.max_rows:
+            self._schedule(0, everything=True)
+        else:
+            self._schedule(self._next_due())
+
+    async def flush(self, everything: bool = False) -> bool:
+        """
+        Writes every message that has gone quiet in one batch. If the write fails the rows are retried after another
+        quiet period, unless the message has been edited again since.
+
+        :param everything: Whether to write every pending edit, quiet or not
+        :return: Whether the write succeeded
+        """
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            due = [message_id for message_id, (deadline, _) in self.pending.items() if everything or deadline <= now]
+            rows = [self.pending.pop(message_id)[1] for message_id in due]
+            succeeded = True
+            if rows:
+                if await self.write(rows):
+                    self.flushes += 1
+                    self.rows_written += len(rows)
+                else:
+                    print(f"Failed to write {len(rows)} edited messages, they will be retried.")
+                    succeeded = False
+                    retry_at = asyncio.get_running_loop().time() + self.quiet_period
+                    for row in rows:
+                        self.pending.setdefault(row["message_id"], (retry_at, row))
+            if self.pending:
+                self._schedule(self._next_due())
+            return succeeded
+
+    async def close(self):
+        """
+        Cancels the flush timer and writes every pending edit.
+        """
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+        await self.flush(everything=True)
+
+    def _next_due(self) -> float:
+        return max(0.0, min(deadline for deadline, _ in self.pending.values()) - asyncio.get_running_loop().time())
+
+    def _schedule(self, delay: float, everything: bool = False):
+        if self._timer is not None and not self._timer.done():
+            if not everything:
+                return
+            self._timer.cancel()
+        self._timer = asyncio.create_task(self._flush_after(delay, everything))
+
+    async def _flush_after(self, delay: float, everything: bool):
+        await asyncio.sleep(delay)
+        self._timer = None
+        await self.flush(everything=everything)
+
+
+class VoteCoalescer:
+    """
+    Folds buffered vote events into one _inc per thread and writes them all in a single update_thread_many mutation,
+    so a burst of reactions on a thread costs one write instead of one per click.
+    """
+
+    def __init__(self):
+        self.events = 0
+        self.writes = 0
+        self.last_folded = 0
+
+    async def write(self, rows: list[dict]) -> Any:
+        """
+        :param rows: Vote events with a thread_id and a failed_votes and solved_votes delta
+        :return: The GraphQL result, or True if the votes cancelled out and nothing was written
+        """
+        deltas: dict[str, dict] = {}
+        for row in rows:
+            delta = deltas.setdefault(row["thread_id"], {"failed_votes": 0, "solved_votes": 0})
+            delta["failed_votes"] += row["failed_votes"]
+            delta["solved_votes"] += row["solved_votes"]
+        updates = [{"where": {"thread_id": {"_eq": thread_id}}, "_inc": delta}
+                   for thread_id, delta in deltas.items() if delta["failed_votes"] or delta["solved_votes"]]
+        if updates:
+            result = await execute_graphql(GRAPHQL_URL,
+                                           UPDATE_THREAD_VOTES_MANY,
+                                           {"updates": updates},
+                                           GRAPHQL_HEADERS)
+            if not result or "errors" in result:
+                return result
+            self.writes += 1
+        self.events += len(rows)
+        self.last_folded = len(rows)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "events": self.events,
+            "writes": self.writes,
+            "last_folded": self.last_folded,
+            "events_per_write": self.events / self.writes if self.writes else 0,
+        }
+
+
+vote_coalescer = VoteCoalescer()
+
+# Every write on the gateway event path goes through the spool, in the order it was made, so a thread is always written
+# before its messages and votes.
+write_spool = WriteSpool(path=WRITE_SPOOL_PATH,
+                         batch_size=WRITE_SPOOL_BATCH_SIZE,
+                         max_retry_interval=WRITE_SPOOL_MAX_RETRY_SECONDS)
+thread_writer = SpoolWriter(write_spool, "threads", insert_threads)
+message_writer = SpoolWriter(write_spool, "messages", insert_messages,
+                             flush_interval=MESSAGE_FLUSH_INTERVAL_MS / 1000,
+                             max_rows=MESSAGE_FLUSH_MAX_ROWS)
+vote_writer = SpoolWriter(write_spool, "votes", vote_coalescer.write,
+                          flush_interval=VOTE_FLUSH_INTERVAL_MS / 1000,
+                          max_rows=VOTE_FLUSH_MAX_EVENTS)
+# Both ✅ reactions and the /open, /close, /solve and /unsolve commands write solved and open through here, so they
+# land in the order they were made.
+solved_writer = SpoolWriter(write_spool, "solved", mark_threads_solved)
+# Edits are already debounced, so they are replayed as soon as they reach the spool.
+spooled_edit_writer = SpoolWriter(write_spool, "edits", update_message_edits, flush_interval=0)
+
+
+async def spool_message_edits(rows: list[dict]) -> bool:
+    for row in rows:
+        spooled_edit_writer.add(row)
+    return True
+
+
+edit_writer = EditDebouncer(write=spool_message_edits,
+                            quiet_period=EDIT_DEBOUNCE_MS / 1000,
+                            max_rows=EDIT_FLUSH_MAX_ROWS)